@@ -0,0 +1,372 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+# Own imports
+from blockexport import export_blocks, save_blocks
+from blocklogic import Blockchain
+from blockgraph import FullNode, Client, flush_gossip, reset_network
+from blockmining import MiningEngine
+from blockstats import Metrics, dump_metrics, fork_stats
+from blockvalidation import ChainValidator
+from blockwire import LocalCluster
+
+'''
+Network benchmark area
+
+    python blockbench.py run --nodes 4 --seed 1 --out a.json
+    python blockbench.py run --nodes 32 --processes --out c.json
+    python blockbench.py compare a.json b.json
+'''
+
+# Metrics where a higher value is better, used
+# to flag regressions when comparing two runs
+higher_is_better = {
+    "confirmed_tx_per_sec": True,
+    "blocks_per_sec": True,
+    "hash_rate": True,
+    "stale_rate": False,
+    "mean_reorg_depth": False,
+    "time_to_consensus": False,
+    "wasted_time": False,
+}
+
+def run_benchmark(
+    nodes=4, clients=1, txs_per_client=100, difficulty=4,
+    block_capacity=3, sprints=5, sprint_time=5, workers=1,
+    seed=0, metrics_path=None, metrics_format="json",
+    block_interval=10.0, retarget_interval=16, validation_workers=1,
+    export_path=None
+):
+    '''
+    Run one mining scenario on a fresh network and
+    return its configuration and measurements as a
+    JSON-able dict. The seed fixes the transactions
+    and peer choices, mining times still vary.
+    :param metrics_path: instrument the nodes and dump
+        their metrics there in metrics_format
+    :param validation_workers: processes of the validator
+        the nodes share
+    :param export_path: save the nodes' blocks there, see
+        blockexport.save_blocks
+    '''
+    config = dict(
+        nodes=nodes, clients=clients, txs_per_client=txs_per_client,
+        difficulty=difficulty, block_capacity=block_capacity,
+        sprints=sprints, sprint_time=sprint_time, workers=workers,
+        seed=seed, block_interval=block_interval,
+        retarget_interval=retarget_interval,
+        validation_workers=validation_workers
+    )
+    random.seed(seed)
+    reset_network()
+    Blockchain.difficulty = difficulty
+    Blockchain.block_capacity = block_capacity
+    Blockchain.block_interval = block_interval
+    Blockchain.retarget_interval = retarget_interval
+
+    validator = ChainValidator(validation_workers)
+    full_nodes = [
+        FullNode(
+            miner=MiningEngine(workers), validator=validator,
+            metrics=(
+                Metrics({"node": f"n{idx}"}) if metrics_path else None
+            )
+        )
+        for idx in range(nodes)
+    ]
+    # Distinct transactions, numbered per client
+    for client_idx in range(clients):
+        client = Client()
+        tx_ids = random.sample(range(10 ** 6), txs_per_client)
+        client.send_transactions(
+            f"Tx #{client_idx}:{tx_id:06}" for tx_id in tx_ids
+        )
+    flush_gossip()
+
+    # Mining phase, same scenario as main.py
+    start = time.time()
+    threads = [
+        threading.Thread(
+            target=node.longest_mine, args=(sprints, sprint_time)
+        )
+        for node in full_nodes
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    # Let everyone catch up with the deepest node
+    for node in full_nodes:
+        node.external_consensus()
+    for node in full_nodes:
+        node.miner.close()
+    validator.close()
+
+    if export_path:
+        save_blocks(export_blocks(full_nodes), export_path)
+    if metrics_path:
+        dump_metrics(
+            [node.metrics for node in full_nodes],
+            metrics_path, metrics_format
+        )
+    result = dict(config=config)
+    result["metrics"] = measure(full_nodes, start, duration)
+    return result
+
+def run_cluster_benchmark(
+    nodes=4, clients=1, txs_per_client=100, difficulty=4,
+    block_capacity=3, sprints=5, sprint_time=5, workers=1,
+    seed=0, block_interval=10.0, retarget_interval=16,
+    family="unix", peers=None
+):
+    '''
+    Same scenario as run_benchmark, with every node in a
+    process of its own, see blockwire.LocalCluster
+    :param family: "unix" or "tcp" sockets
+    :param peers: peers per node, all other nodes if None
+    '''
+    config = dict(
+        nodes=nodes, clients=clients, txs_per_client=txs_per_client,
+        difficulty=difficulty, block_capacity=block_capacity,
+        sprints=sprints, sprint_time=sprint_time, workers=workers,
+        seed=seed, block_interval=block_interval,
+        retarget_interval=retarget_interval,
+        processes=True, family=family, peers=peers
+    )
+    random.seed(seed)
+    chain_config = dict(
+        difficulty=difficulty, block_capacity=block_capacity,
+        block_interval=block_interval,
+        retarget_interval=retarget_interval
+    )
+    cluster = LocalCluster(
+        nodes, family=family, workers=workers, num_peers=peers,
+        chain_config=chain_config, seed=seed
+    )
+    with cluster:
+        for client_idx in range(clients):
+            tx_ids = random.sample(range(10 ** 6), txs_per_client)
+            cluster.send_transactions(
+                f"Tx #{client_idx}:{tx_id:06}" for tx_id in tx_ids
+            )
+        cluster.flush_gossip()
+        start = time.time()
+        cluster.mine(sprints, sprint_time)
+        cluster.wait()
+        duration = time.time() - start
+        # Let everyone catch up with the deepest node,
+        # over several hops when nodes have few peers
+        while any(r["changed"] for r in cluster.command_all("sync")):
+            pass
+        statuses = cluster.statuses()
+    result = dict(config=config)
+    result["metrics"] = measure_statuses(statuses, start, duration)
+    return result
+
+def run_metrics(
+    duration, confirmed, blocks, hashes, stale, reorg_depths,
+    converged, time_to_consensus, wasted_time
+):
+    '''
+    Throughput and fork statistics of a finished run,
+    whatever its nodes ran in, see blockstats.fork_stats
+    '''
+    return dict(
+        duration=duration,
+        confirmed_txs=confirmed,
+        confirmed_tx_per_sec=confirmed / duration,
+        blocks=blocks,
+        blocks_per_sec=blocks / duration,
+        hashes=hashes,
+        hash_rate=hashes / duration,
+        **fork_stats(blocks, stale, reorg_depths),
+        converged=converged,
+        time_to_consensus=time_to_consensus,
+        wasted_time=wasted_time,
+    )
+
+def measure(full_nodes, start, duration):
+    '''
+    Throughput and fork statistics of a finished run
+    '''
+    deepest = max(full_nodes, key=lambda node: node.tip.depth)
+    consensus = deepest.blockchain.chain
+    consensus_hashes = set(blk.hash for blk in consensus)
+    # Every block any node has seen, genesis excluded
+    seen = set()
+    for node in full_nodes:
+        seen.update(node.blockchain.blocks)
+    seen.discard(consensus[0].hash)
+    return run_metrics(
+        duration,
+        confirmed=sum(len(blk.transactions) for blk in consensus),
+        blocks=len(consensus) - 1,
+        hashes=sum(node.miner.hashes for node in full_nodes),
+        stale=len(seen - consensus_hashes),
+        reorg_depths=[node.blockchain.reorg_depths for node in full_nodes],
+        converged=len(set(node.tip for node in full_nodes)) == 1,
+        time_to_consensus=max(
+            node.tip_changed_at for node in full_nodes
+        ) - start,
+        wasted_time=sum(node.wasted_time for node in full_nodes),
+    )
+
+def measure_statuses(statuses, start, duration):
+    '''
+    Same as measure, from the status replies of the
+    nodes of a blockwire.LocalCluster
+    '''
+    deepest = max(statuses, key=lambda status: status["depth"])
+    seen = set()
+    for status in statuses:
+        seen.update(status["blocks"])
+    # The tree of the deepest node holds its whole chain
+    # above the store, nodes here keep no store
+    mined = deepest["depth"]
+    seen.discard(deepest["genesis"])
+    return run_metrics(
+        duration,
+        confirmed=deepest["confirmed_txs"],
+        blocks=mined,
+        hashes=sum(status["hashes"] for status in statuses),
+        stale=max(0, len(seen) - mined),
+        reorg_depths=[status["reorg_depths"] for status in statuses],
+        converged=len(set(status["hash"] for status in statuses)) == 1,
+        time_to_consensus=max(
+            status["tip_changed_at"] for status in statuses
+        ) - start,
+        wasted_time=sum(status["wasted_time"] for status in statuses),
+    )
+
+def compare(base, new, tolerance=0.05):
+    '''
+    Compare the metrics of two runs, returns a dict of
+    metric -> (base, new, relative change, regression)
+    :param tolerance: relative change in the bad direction
+        tolerated before flagging a regression
+    '''
+    report = {}
+    for name, better_up in higher_is_better.items():
+        old_val = base["metrics"][name]
+        new_val = new["metrics"][name]
+        change = (new_val - old_val) / old_val if old_val else None
+        if change is None:
+            regression = (
+                new_val < old_val if better_up else new_val > old_val
+            )
+        elif better_up:
+            regression = change < -tolerance
+        else:
+            regression = change > tolerance
+        report[name] = dict(
+            base=old_val, new=new_val,
+            change=change, regression=regression
+        )
+    return report
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the mining network"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run one scenario")
+    run.add_argument("--nodes", type=int, default=4)
+    run.add_argument("--clients", type=int, default=1)
+    run.add_argument("--txs-per-client", type=int, default=100)
+    run.add_argument("--difficulty", type=int, default=4,
+                     help="initial difficulty, in leading hex zeros")
+    run.add_argument("--block-capacity", type=int, default=3)
+    run.add_argument("--sprints", type=int, default=5)
+    run.add_argument("--sprint-time", type=float, default=5)
+    run.add_argument("--block-interval", type=float, default=10.0,
+                     help="seconds per block retargeting aims for")
+    run.add_argument("--retarget-interval", type=int, default=16,
+                     help="blocks between two retargets")
+    run.add_argument("--workers", type=int, default=1,
+                     help="mining processes per node")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--export",
+                     help="save the blocks of every node to this "
+                     ".npy or .npz file")
+    run.add_argument("--validation-workers", type=int, default=1,
+                     help="processes checking the proofs of synced blocks")
+    run.add_argument("--processes", action="store_true",
+                     help="one process per node, over local sockets")
+    run.add_argument("--family", default="unix", choices=["unix", "tcp"],
+                     help="socket family with --processes")
+    run.add_argument("--peers", type=int,
+                     help="peers per node with --processes, default all")
+    run.add_argument("--out", help="JSON file, stdout if omitted")
+    run.add_argument("--metrics", help="dump node metrics to this file")
+    run.add_argument("--metrics-format", default="json",
+                     choices=["json", "prometheus"])
+    cmp = commands.add_parser("compare", help="compare two runs")
+    cmp.add_argument("base")
+    cmp.add_argument("new")
+    cmp.add_argument("--tolerance", type=float, default=0.05)
+    args = parser.parse_args(argv)
+    if args.command == "run" and args.processes:
+        # Node processes keep their blocks, metrics and
+        # validator to themselves
+        unsupported = [
+            flag for flag, given in (
+                ("--export", args.export is not None),
+                ("--metrics", args.metrics is not None),
+                ("--validation-workers", args.validation_workers != 1),
+            )
+            if given
+        ]
+        if unsupported:
+            run.error(
+                f"{', '.join(unsupported)} not supported with --processes"
+            )
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        report = compare(base, new, args.tolerance)
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        # Non-zero exit status on any regression
+        return int(any(m["regression"] for m in report.values()))
+    scenario = dict(
+        nodes=args.nodes, clients=args.clients,
+        txs_per_client=args.txs_per_client,
+        difficulty=args.difficulty,
+        block_capacity=args.block_capacity,
+        sprints=args.sprints, sprint_time=args.sprint_time,
+        workers=args.workers, seed=args.seed,
+        block_interval=args.block_interval,
+        retarget_interval=args.retarget_interval
+    )
+    if args.processes:
+        result = run_cluster_benchmark(
+            family=args.family, peers=args.peers, **scenario
+        )
+    else:
+        result = run_benchmark(
+            metrics_path=args.metrics, metrics_format=args.metrics_format,
+            validation_workers=args.validation_workers,
+            export_path=args.export, **scenario
+        )
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
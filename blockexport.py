@@ -0,0 +1,179 @@
+import numpy as np
+
+'''
+Columnar export area
+
+Every node's blocks, consensus chain and stale ones, go in
+one NumPy structured array, a row per node and block. It is
+saved as .npy, which np.load can memory-map, or as a
+compressed .npz, and the summaries below work on whole
+columns at once.
+
+    blocks = export_blocks(nodes)
+    save_blocks(blocks, "run.npy")
+    summary(load_blocks("run.npy"))
+'''
+
+block_dtype = np.dtype([
+    ('node', '<u4'),
+    ('depth', '<u8'),
+    ('timestamp', '<f8'),
+    ('nonce', '<u8'),
+    # Raw hash bytes, V keeps trailing zero bytes that S drops
+    ('hash', 'V32'),
+    ('previous_hash', 'V32'),
+    ('tx_count', '<u4'),
+    ('main', '?'),
+])
+
+def node_blocks(node):
+    '''
+    (consensus chain, stale blocks) of a node: from its
+    known_blocks() if it has one, e.g. blocksim.SimNode
+    whose blocks live in a tree shared with other nodes,
+    from its blockchain otherwise, e.g. FullNode
+    '''
+    known_blocks = getattr(node, 'known_blocks', None)
+    if known_blocks is not None:
+        return known_blocks()
+    blockchain = node.blockchain
+    stale = [
+        blk for blk in blockchain.blocks.values()
+        if not blockchain.on_main_chain(blk)
+    ]
+    return blockchain.chain, stale
+
+def export_blocks(nodes):
+    '''
+    Structured array of the blocks of nodes, see
+    node_blocks, node ids being their position in nodes
+    '''
+    columns = {name: [] for name in block_dtype.names}
+    for node_id, node in enumerate(nodes):
+        chain, stale = node_blocks(node)
+        for main, blocks in ((True, chain), (False, stale)):
+            for blk in blocks:
+                columns['node'].append(node_id)
+                columns['depth'].append(blk.depth)
+                columns['timestamp'].append(blk.timestamp)
+                columns['nonce'].append(blk.nonce)
+                columns['hash'].append(blk.hash)
+                columns['previous_hash'].append(blk.previous_hash)
+                columns['tx_count'].append(len(blk.transactions))
+                columns['main'].append(main)
+    blocks = np.empty(len(columns['node']), dtype=block_dtype)
+    for name in ('hash', 'previous_hash'):
+        blocks[name] = np.frombuffer(b''.join(columns.pop(name)), dtype='V32')
+    for name, values in columns.items():
+        blocks[name] = values
+    return blocks
+
+def save_blocks(blocks, path):
+    '''
+    .npz paths get a compressed archive, anything
+    else a plain .npy that can be memory-mapped
+    '''
+    if str(path).endswith('.npz'):
+        np.savez_compressed(path, blocks=blocks)
+    else:
+        np.save(path, blocks)
+
+def load_blocks(path, mmap=True):
+    '''
+    Load an export, memory-mapped and read-only when
+    it is a .npy and mmap is set
+    '''
+    if str(path).endswith('.npz'):
+        with np.load(path) as archive:
+            return archive['blocks']
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+'''
+Vectorized summaries
+'''
+
+def main_chain(blocks, node=None):
+    '''
+    Consensus chain rows of node, the deepest node by
+    default, sorted by depth
+    '''
+    if node is None:
+        main = blocks[blocks['main']]
+        node = main['node'][np.argmax(main['depth'])]
+    rows = blocks[(blocks['node'] == node) & blocks['main']]
+    return rows[np.argsort(rows['depth'], kind='stable')]
+
+def block_intervals(blocks, node=None):
+    '''
+    Seconds between consecutive blocks of a consensus
+    chain, see main_chain, genesis left out
+    '''
+    chain = main_chain(blocks, node)
+    return np.diff(chain['timestamp'][chain['depth'] > 0])
+
+def nonce_histogram(blocks, bins=32):
+    '''
+    (counts, bin edges) of the nonces of distinct blocks
+    '''
+    distinct = unique_blocks(blocks)
+    return np.histogram(distinct['nonce'][distinct['depth'] > 0], bins=bins)
+
+def hash_keys(hashes):
+    '''
+    Hash column viewed as S32, which sorts faster than V32
+    and is as exact, all values being 32 bytes long
+    '''
+    return hashes.view('S32')
+
+def unique_blocks(blocks):
+    '''
+    One row per distinct block hash
+    '''
+    _, first = np.unique(hash_keys(blocks['hash']), return_index=True)
+    return blocks[np.sort(first)]
+
+def fork_rates(blocks):
+    '''
+    Share of stale blocks among the blocks each node
+    knows, genesis left out, indexed by node id
+    '''
+    mined = blocks[blocks['depth'] > 0]
+    total = np.bincount(mined['node'])
+    stale = np.bincount(
+        mined['node'], weights=~mined['main'], minlength=len(total)
+    )
+    return np.divide(
+        stale, total, out=np.zeros(len(total)), where=total > 0
+    )
+
+def stale_hashes(blocks):
+    '''
+    Hashes of blocks on no node's consensus chain
+    '''
+    keys = hash_keys(blocks['hash'])
+    main = blocks['main']
+    return np.setdiff1d(keys[~main], keys[main]).view('V32')
+
+def summary(blocks):
+    '''
+    JSON-able overview of an export
+    '''
+    chain = main_chain(blocks)
+    intervals = block_intervals(blocks)
+    distinct = unique_blocks(blocks)
+    mined = int(np.count_nonzero(distinct['depth'] > 0))
+    stale = len(stale_hashes(blocks))
+    def stat(values, fn):
+        return float(fn(values)) if len(values) else 0.0
+    return dict(
+        nodes=int(blocks['node'].max()) + 1 if len(blocks) else 0,
+        depth=int(chain['depth'].max()) if len(chain) else 0,
+        blocks=mined,
+        stale_blocks=stale,
+        stale_rate=stale / max(1, mined),
+        mean_interval=stat(intervals, np.mean),
+        median_interval=stat(intervals, np.median),
+        p90_interval=stat(intervals, lambda v: np.percentile(v, 90)),
+        mean_tx_count=stat(chain['tx_count'][chain['depth'] > 0], np.mean),
+        fork_rates=fork_rates(blocks).tolist(),
+    )
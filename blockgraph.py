@@ -1,8 +1,16 @@
 import random
+import sys
 import time
 import threading
-from copy import deepcopy
-from blocklogic import Block, Blockchain
+from collections import OrderedDict, deque, namedtuple
+from blocklogic import (
+    Block, Blockchain, CancelToken, HeaderChain, TxStatus, block_work,
+    transaction_id
+)
+from blockmining import MiningEngine
+from blockstats import null_metrics
+from blockstore import BlockStore
+from blockvalidation import ChainValidator
 
 '''
 Network management area
@@ -11,18 +19,133 @@ Network management area
 # Network participants
 full_nodes = []
 clients = []
-# Thread lock
+# Thread lock, only guards changes to the participant
+# lists, every full node guards its own state
 lock = threading.Lock()
 
-def register_transaction(tx):
+# Immutable summary of a node's consensus tip, replaced
+# as a whole so that peers can read it without locking.
+# work is the cumulative work of its chain, see block_work
+TipSummary = namedtuple('TipSummary', ['depth', 'hash', 'work'])
+
+# Callbacks told about every new consensus tip
+tip_subscribers = []
+
+def subscribe_tips(callback):
+    '''
+    Register callback(node, tip) for tip announcements.
+    Callbacks run on the announcing node's thread and
+    should return quickly.
+    '''
+    with lock:
+        tip_subscribers.append(callback)
+
+def announce_tip(node, tip):
+    '''
+    Publish a node's new consensus tip to subscribers
+    '''
+    for callback in list(tip_subscribers):
+        callback(node, tip)
+
+def reset_network():
     '''
-    Connect with all full nodes and
-    send them the new transaction
+    Forget all participants and subscribers, e.g.
+    between two runs in the same interpreter
     '''
     with lock:
-        for node in full_nodes:
-            node.blockchain.add_new_transaction(tx)
-        return True
+        full_nodes.clear()
+        clients.clear()
+        tip_subscribers.clear()
+
+def register_peer(peer):
+    '''
+    Add a full node living in another process, e.g. a
+    blockwire.RemotePeer, to the participants. It is used
+    like a local full node from then on.
+    '''
+    with lock:
+        full_nodes.append(peer)
+
+def network_nodes():
+    '''
+    Snapshot of the full nodes, copying the list
+    is atomic so no lock is needed to read it
+    '''
+    return list(full_nodes)
+
+def register_transactions(txs):
+    '''
+    Hand a batch of transactions to the network. The batch
+    goes to the inbox of one random full node, which gossips
+    it on to its peers, so the cost does not grow with the
+    number of nodes. Nodes whose inbox is full pass the rest
+    on to the next one. Returns how many were accepted,
+    fewer than len(txs) when every inbox is full.
+    '''
+    txs = list(txs)
+    nodes = network_nodes()
+    random.shuffle(nodes)
+    accepted = 0
+    for node in nodes:
+        if accepted == len(txs):
+            break
+        accepted += node.inbox.offer(txs[accepted:])
+    return accepted
+
+def register_transaction(tx):
+    '''
+    Hand one transaction to the network, see
+    register_transactions
+    '''
+    return register_transactions([tx]) == 1
+
+def flush_gossip():
+    '''
+    Let the nodes process their inboxes until no gossip is
+    left in flight, e.g. before mining starts. Returns the
+    number of transactions processed.
+    '''
+    processed = 0
+    while True:
+        done = sum(node.process_inbox() for node in network_nodes())
+        if not done:
+            return processed
+        processed += done
+
+class Inbox:
+    '''
+    Bounded queue of transactions sent to a node, drained
+    by the node itself between mining sprints
+    :param capacity: transactions held at most, offers
+        beyond it are refused, see offer
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.queue = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def offer(self, txs):
+        '''
+        Queue as many of txs as there is room for, in order.
+        Returns how many were queued, the caller keeps the
+        rest, as backpressure.
+        '''
+        with self.lock:
+            room = self.capacity - len(self.queue)
+            batch = txs[:max(0, room)]
+            self.queue.extend(batch)
+        return len(batch)
+
+    def drain(self, limit):
+        '''
+        Take up to limit transactions off the front
+        '''
+        with self.lock:
+            num = min(limit, len(self.queue))
+            return [self.queue.popleft() for _ in range(num)]
 
 '''
 Network participant classes
@@ -30,30 +153,197 @@ Network participant classes
 
 class Client:
     '''
-    Sends transactions.
+    Sends transactions and checks they were mined,
+    keeping only the block headers.
     '''
     def __init__(self):
-        pass
+        self.headers = HeaderChain()
+        # Tells apart identical transfers of this client
+        self.transfer_nonce = random.getrandbits(32) << 32
+
+    def sync_headers(self, node=None):
+        '''
+        Catch up with the headers of node, a random
+        full node by default. Returns whether our
+        header chain changed.
+        '''
+        if node is None:
+            nodes = network_nodes()
+            if not nodes:
+                return False
+            node = random.choice(nodes)
+        return self.headers.extend(
+            node.send_headers(self.headers.locator())
+        )
+
+    def verify_transaction(self, tx, node=None):
+        '''
+        Ask a full node for a proof that tx was mined and
+        check it against our headers, syncing them first.
+        Returns the number of confirmations, 0 if tx could
+        not be proven mined.
+        '''
+        if node is None:
+            nodes = network_nodes()
+            if not nodes:
+                return 0
+            node = random.choice(nodes)
+        self.sync_headers(node)
+        answer = node.send_inclusion_proof(tx)
+        if answer is None:
+            return 0
+        depth = self.headers.verify_inclusion(tx, *answer)
+        if depth is None:
+            return 0
+        return self.headers.last_header.depth - depth + 1
+
+    def transaction_statuses(self, tx_ids, node=None):
+        '''
+        Ask a full node, a random one by default, where
+        transactions stand, in one request: dict of tx id
+        -> TxStatus, ids being those of transaction_id.
+        Unlike verify_transaction, the answer is trusted.
+        '''
+        tx_ids = list(tx_ids)
+        if node is None:
+            nodes = network_nodes()
+            if not nodes:
+                return {
+                    tx_id: TxStatus("unknown", None, None, 0)
+                    for tx_id in tx_ids
+                }
+            node = random.choice(nodes)
+        return node.send_tx_statuses(tx_ids)
+
+    def transaction_status(self, tx_id, node=None):
+        '''
+        TxStatus of one transaction, see transaction_statuses
+        '''
+        return self.transaction_statuses([tx_id], node)[tx_id]
+
+    def confirmations(self, tx_id, node=None):
+        '''
+        Confirmations of a transaction as reported by
+        node, 0 if it is not mined
+        '''
+        return self.transaction_status(tx_id, node).confirmations
 
     def send_transaction(self, tx):
         '''
-        FIXME: (just an idea, not necessary)
-        Send transaction to network. Currently dummy txs,
-        no financial data, therefore cannot fail to have
-        enough funds. Always return True for now.
+        Send transaction to network. Returns False if no
+        node had room for it. Transfers the sender can't
+        pay for are dropped by the nodes, see transfer.
         '''
         return register_transaction(tx)
 
+    def balance(self, account, node=None):
+        '''
+        Balance of account at the consensus tip of node,
+        a random full node by default
+        '''
+        if node is None:
+            nodes = network_nodes()
+            if not nodes:
+                return 0
+            node = random.choice(nodes)
+        return node.send_balance(account)
+
+    def transfer(self, sender, recipient, amount, node=None):
+        '''
+        Send a transfer of amount from sender to recipient,
+        see blockledger. Returns False without sending it
+        if sender can't pay for it, as seen by node.
+        '''
+        if self.balance(sender, node) < amount:
+            return False
+        self.transfer_nonce += 1
+        return self.send_transaction({
+            "from": sender, "to": recipient, "amount": amount,
+            "nonce": self.transfer_nonce
+        })
+
+    def send_transactions(self, txs):
+        '''
+        Send a batch of transactions to the network in one
+        go, returns how many were accepted, see
+        register_transactions
+        '''
+        return register_transactions(txs)
+
 class FullNode:
     '''
     Stores all available block data and
     also mines. They are mining full nodes.
     Currently we do not support stand-alone
     miners.
+    :param miner: MiningEngine doing the proof of work,
+        defaults to a single in-process worker
+    :param store_path: directory of a BlockStore keeping
+        the consensus chain on disk across restarts
+    :param metrics: blockstats.Metrics to instrument the
+        node with, disabled by default
+    :param validator: blockvalidation.ChainValidator checking
+        the blocks of peers, nodes of a process can share one
+        along with its cache
     '''
-    def __init__(self):
+
+    # Transactions waiting in the inbox at most
+    inbox_capacity = 1 << 16
+    # Transactions taken from the inbox per process_inbox
+    inbox_batch = 4096
+    # Transaction ids remembered to drop duplicates
+    seen_capacity = 1 << 18
+    # Random peers every new transaction is relayed to
+    gossip_fanout = 8
+    # Sprint lengths chosen by sprint_length, in seconds,
+    # sprints lasting sprint_share of the expected time
+    # to find a block
+    min_sprint_time = 0.5
+    max_sprint_time = 30.0
+    sprint_share = 0.5
+    # Seconds between looks at the mempool when idle,
+    # or at the controls when paused
+    idle_poll = 0.1
+    # Blocks asked for per request when syncing, see
+    # block_pages
+    sync_batch = 512
+
+    def __init__(
+        self, miner=None, store_path=None, metrics=None, validator=None
+    ):
+        if metrics is None:
+            metrics = null_metrics
+        self.metrics = metrics
+        # Guards self.blockchain, never held while
+        # waiting on another node's lock
+        self.lock = threading.RLock()
+        # Token of the proof of work in progress and
+        # work of the chain ending in the block being mined
+        self.mining_token = None
+        self.mining_work = None
+        # Control of mine(), see pause, resume and stop
+        self.running = threading.Event()
+        self.running.set()
+        self.stop_event = threading.Event()
+        # Seconds spent hashing on blocks already beaten
+        # by a competitor's announced tip
+        self.wasted_time = 0.0
+        # Gossiped transactions, see process_inbox
+        self.inbox = Inbox(FullNode.inbox_capacity)
+        self.seen_txs = OrderedDict()
+        if miner is None:
+            miner = MiningEngine(workers=1)
+        self.miner = miner
+        if validator is None:
+            validator = ChainValidator()
+        self.validator = validator
+        self.store = None
+        if store_path is not None:
+            self.store = BlockStore(store_path)
         self.blockchain = self.download_blockchain()
+        self.publish_tip()
         self.register_on_network()
+        subscribe_tips(self.on_tip_announced)
 
     def register_on_network(self):
         '''
@@ -62,97 +352,276 @@ class FullNode:
         with lock:
             full_nodes.append(self)
 
+    def publish_tip(self):
+        '''
+        Replace the tip summary peers read lock-free,
+        to be called whenever the consensus chain changes
+        '''
+        last_block = self.blockchain.last_block
+        tip = TipSummary(
+            last_block.depth, last_block.hash,
+            self.blockchain.chain_work(last_block)
+        )
+        changed = getattr(self, 'tip', None) != tip
+        self.tip = tip
+        if changed:
+            self.tip_changed_at = time.time()
+            announce_tip(self, tip)
+
+    def on_tip_announced(self, node, tip):
+        '''
+        Drop the block being mined as soon as some other
+        node has a tip with at least as much work, our
+        block could not make the best chain anymore
+        '''
+        token = self.mining_token
+        if (
+            node is not self and token is not None and
+            tip.work >= self.mining_work
+        ):
+            token.cancel()
+
+    def mark_seen(self, txs):
+        '''
+        Remember transactions as known, pending or mined, so
+        that gossip about them is dropped. Returns the ones
+        that were not known yet.
+        '''
+        fresh = []
+        seen = self.seen_txs
+        for tx in txs:
+            tx_id = transaction_id(tx)
+            if tx_id in seen:
+                continue
+            seen[tx_id] = None
+            fresh.append(tx)
+        while len(seen) > FullNode.seen_capacity:
+            seen.popitem(last=False)
+        return fresh
+
+    def process_inbox(self):
+        '''
+        Take a batch of gossiped transactions from the inbox,
+        add the unseen ones to the mempool and relay them to
+        our peers. Returns the number of transactions taken.
+
+        [1]     Only new transactions are relayed, to
+                gossip_fanout random peers, so gossip dies out
+                once every node has seen them. Relays refused
+                by a full peer inbox are dropped, the peer
+                hears about them from the other nodes.
+        '''
+        batch = self.inbox.drain(FullNode.inbox_batch)
+        if not batch:
+            return 0
+        with self.lock:
+            fresh = self.mark_seen(batch)
+            self.blockchain.add_new_transactions(fresh)
+        metrics = self.metrics
+        metrics.inc("txs_received", len(fresh), labels={"new": "true"})
+        metrics.inc(
+            "txs_received", len(batch) - len(fresh), labels={"new": "false"}
+        )
+        # See process_inbox.[1]
+        if fresh:
+            peers = [node for node in network_nodes() if node is not self]
+            if len(peers) > FullNode.gossip_fanout:
+                peers = random.sample(peers, FullNode.gossip_fanout)
+            for node in peers:
+                relayed = node.inbox.offer(fresh)
+                metrics.inc("gossip_relayed", relayed)
+                metrics.inc("gossip_dropped", len(fresh) - relayed)
+        metrics.set("inbox_size", len(self.inbox))
+        return len(batch)
+
     def send_chain(self):
         '''
         Allow requests for longest chain
         '''
-        return self.blockchain.chain
+        with self.lock:
+            return list(self.blockchain.chain)
+
+    def send_blocks(self, locator, limit=None):
+        '''
+        Allow requests for the blocks following
+        the common ancestor with a locator, at most
+        limit of them
+        '''
+        with self.lock:
+            return self.blockchain.blocks_after(locator, limit)
+
+    def send_headers(self, locator):
+        '''
+        Allow requests for headers following
+        the common ancestor with a locator
+        '''
+        with self.lock:
+            return self.blockchain.headers_after(locator)
+
+    def send_inclusion_proof(self, tx):
+        '''
+        Allow requests for a proof that tx was mined:
+        (block hash, Merkle proof), None if not mined
+        '''
+        with self.lock:
+            blk = self.blockchain.find_transaction(tx)
+            if blk is None:
+                return None
+            return blk.hash, blk.inclusion_proof(tx)
+
+    def send_tx_statuses(self, tx_ids):
+        '''
+        Allow requests for where transactions stand:
+        dict of tx id -> TxStatus, see
+        Blockchain.transaction_status
+        '''
+        with self.lock:
+            return self.blockchain.transaction_statuses(tx_ids)
+
+    def send_balance(self, account):
+        '''
+        Allow requests for the balance of an account
+        '''
+        with self.lock:
+            return self.blockchain.ledger.balance(account)
+
+    def send_transactions(self):
+        '''
+        Allow requests for our pending transactions
+        '''
+        with self.lock:
+            return self.blockchain.outstanding_transactions
 
     def download_blockchain(self):
         '''
         Function to download a consensus chain first
         time the Full Node joins the network.
         '''
-        with lock:
-            # Number of existing full nodes in network
-            num_nodes = len(full_nodes)
-            # If empty network, we're first node
-            # so just create a brand new blockchain
-            if num_nodes == 0:
-                return Blockchain()
-            # Else, fetch blocks from existing node
-            node_idx = random.randint(0, num_nodes-1)
-            return deepcopy(full_nodes[node_idx].blockchain)
-
-    def match_outstanding_transactions(self, consensus_bc):
-        '''
-        Take a consensus chain and update self.blockchain's 
-        outstanding transactions, returning the good list.
-        Assuming consensus_chain is always longer.
-        :param consensus_bc: of class Blockchain
-        '''
-        # If shorter consensus, complain
-        if len(self.blockchain.chain) >= len(consensus_bc.chain):
-            raise Exception(
-                "Trying to match transactions with shorter \
-                 or equal length consensus chain."
+        # Reopen our own stored chain, only the missing
+        # tail is synced later by external_consensus
+        if self.store is not None and len(self.store) > 0:
+            return Blockchain(store=self.store, metrics=self.metrics)
+        # Existing full nodes in network
+        nodes = network_nodes()
+        # If empty network, we're first node
+        # so just create a brand new blockchain
+        blockchain = Blockchain(store=self.store, metrics=self.metrics)
+        if not nodes:
+            return blockchain
+        # Else, fetch blocks and pending transactions
+        # from existing node, sharing its blocks
+        peer = random.choice(nodes)
+        pending = peer.send_transactions()
+        for page in self.block_pages(peer, blockchain):
+            blocks, reason = self.validator.validate(blockchain, page)
+            if reason is not None:
+                blockchain.reject_block(reason)
+            blockchain.adopt_chain(blocks, validated=True)
+            self.mark_seen(tx for blk in blocks for tx in blk.transactions)
+            if reason is not None:
+                break
+        # Funds are checked against the adopted chain
+        blockchain.add_new_transactions(pending)
+        self.mark_seen(pending)
+        return blockchain
+
+    def block_pages(self, peer, blockchain):
+        '''
+        Blocks of peer past the common ancestor with
+        blockchain, as lists of at most sync_batch blocks.
+        The caller adopts each one before the next request.
+
+        [1]     Every request carries a fresh locator of
+                blockchain, behind the last block received.
+                The peer goes on after that block even while
+                its branch has less work than our chain and
+                was not switched to yet.
+        '''
+        metrics = self.metrics
+        last = []
+        while True:
+            wait_start = time.perf_counter()
+            with self.lock:
+                metrics.observe(
+                    "sync_lock_wait_seconds",
+                    time.perf_counter() - wait_start
+                )
+                # See block_pages.[1]
+                locator = last + blockchain.locator()
+            wait_start = time.perf_counter()
+            page = peer.send_blocks(locator, FullNode.sync_batch)
+            metrics.observe(
+                "sync_request_seconds", time.perf_counter() - wait_start
             )
-        # List of good transactions
-        matched_tx = self.blockchain.outstanding_transactions
-        # Find out what's the most recent common block
-        # Offset positions by how many blocks consensus is longer
-        offset = len(consensus_bc.chain) - len(self.blockchain.chain)
-        local_pos = -1
-        other_pos = -1-offset
-        while self.blockchain.chain[local_pos] != consensus_bc.chain[other_pos]:
-            local_pos = local_pos - 1
-            other_pos = other_pos - 1
-        # We know the most recent common block
-        # Want to add back the tx executed on our chain
-        add_back_tx = []
-        for local_idx in range(local_pos+1, 0):
-            for tx in self.blockchain.chain[local_idx].transactions:
-                add_back_tx.append(tx)
-        matched_tx = matched_tx + add_back_tx
-        # Want to remove the tx execute on outside consensus chain
-        remove_tx = []
-        for other_idx in range(other_pos+1, 0):
-            for tx in consensus_bc.chain[other_idx].transactions:
-                remove_tx.append(tx)
-        for tx in remove_tx:
-            matched_tx.remove(tx)
-        # Have the matched transactions ready
-        return matched_tx
-        
+            # Nothing new, or the same blocks again
+            if not page or [page[-1].hash] == last:
+                return
+            yield page
+            if page[-1].hash == peer.tip.hash:
+                return
+            last = [page[-1].hash]
+
     def external_consensus(self):
         '''
         Check other nodes in the network for the
-        longest internal consensus chain
+        internal consensus chain with the most work
+
+        [1]     Peer tips are read without locking, only the
+                chosen peer's lock is taken to get its blocks,
+                and ours afterwards to adopt them. Both are
+                never held together.
         '''
-        with lock:
-            # Current depth of own chain
-            curr_depth = self.blockchain.last_block.depth
-            # Max depth found already
-            max_depth = -1
-            # Node to request form
-            request_node = None
-            for node in full_nodes:
-                if (
-                    node.blockchain.last_block.depth > curr_depth and
-                    node.blockchain.last_block.depth > max_depth
-                ):
-                    request_node = node
-                    max_depth = node.blockchain.last_block.depth
-            # Set our chain to request_node's chain
-            if request_node is not None:
-                # Update transactions to not lose own tx's
-                self.blockchain.outstanding_transactions = self.match_outstanding_transactions(
-                        request_node.blockchain
-                    )
-                self.blockchain.chain = deepcopy(request_node.blockchain.chain)
-                return True
-            # Return False if nothing changed
+        # Current work of own chain
+        curr_work = self.tip.work
+        # Max work found already
+        max_work = -1
+        # Node to request form, see [1]
+        request_node = None
+        for node in network_nodes():
+            tip = node.tip
+            if tip.work > curr_work and tip.work > max_work:
+                request_node = node
+                max_work = tip.work
+        # Return False if nothing changed
+        if request_node is None:
             return False
+        metrics = self.metrics
+        changed = False
+        # Only the blocks after the common ancestor
+        # are sent, see Blockchain.locator
+        for blocks in self.block_pages(request_node, self.blockchain):
+            # Blocks are shared, the list holding them is
+            # the only thing copied
+            metrics.inc("sync_blocks_received", len(blocks))
+            metrics.inc("sync_bytes_copied", sys.getsizeof(blocks))
+            # Only the new blocks are validated, up to the
+            # first invalid one, and proofs without our lock
+            with metrics.timer("sync_validation_seconds"):
+                blocks, reason = self.validator.validate(
+                    self.blockchain, blocks, self.lock
+                )
+            if reason is not None:
+                metrics.inc("blocks_rejected", labels={"reason": reason})
+            # Set our chain to request_node's chain, the
+            # reorganization puts our orphaned tx's back
+            # in the mempool and drops the ones mined there
+            wait_start = time.perf_counter()
+            with self.lock:
+                metrics.observe(
+                    "sync_lock_wait_seconds",
+                    time.perf_counter() - wait_start
+                )
+                if self.blockchain.adopt_chain(blocks, validated=True):
+                    changed = True
+                # Late gossip about these is stale
+                self.mark_seen(
+                    tx for blk in blocks for tx in blk.transactions
+                )
+                self.publish_tip()
+            if reason is not None:
+                break
+        metrics.inc("syncs", labels={"changed": str(changed).lower()})
+        return changed
 
     def longest_mine(
         self, num_sprints = 5, sprint_time = 10
@@ -160,61 +629,196 @@ class FullNode:
         '''
         Function to do mining work to longest chain
         and stop when there's news about a longer chain.
-        Runs for a certain amout of time, default 60s.
-        Current version does short mining sprints with
-        broadcast reading in between.
+        Runs for num_sprints sprints of sprint_time
+        seconds, sprints cut short by news not counting,
+        and stops early once there are no transactions.
         Returns number of successes during work.
         '''
-        # If non-positive number of sprints, no work needed
-        if num_sprints <= 0:
-            return 0
-        # Establish initial consensus with network
-        self.external_consensus()
-        # Do nothing if no trasactions
-        if not self.blockchain.outstanding_transactions:
-            return 0
-        # Choose transactions to mine, call it bucket
-        mine_bucket = self.blockchain.get_outstanding_transactions()[
-            :Blockchain.block_capacity
-        ]
-        # Create new block on top of base block
-        new_block = Block(
-            depth=self.blockchain.last_block.depth + 1,
-            transactions=mine_bucket,
-            timestamp=time.time(),
-            previous_hash=self.blockchain.last_block.hash
+        return self.mine(
+            max_sprints=num_sprints, sprint_time=sprint_time,
+            stop_when_idle=True
         )
-        # Do proof of work in sprints
-        proof = None
-        for spr in range(num_sprints):
-            # Before sprint, check for external consensus
-            # and do that every sprint
+
+    def mine(
+        self, until_blocks=None, until_txs=None, deadline=None,
+        max_sprints=None, sprint_time=None, stop_when_idle=False
+    ):
+        '''
+        Mine on the longest chain until a limit is reached or
+        stop() is called, indefinitely without limits. A
+        stop() holds until clear_stop(), see stop. Returns
+        the number of blocks mined.
+        :param until_blocks: blocks to mine
+        :param until_txs: transactions to get mined in our blocks
+        :param deadline: time.time() to stop at
+        :param max_sprints: sprints to run, see longest_mine
+        :param sprint_time: fixed sprint length in seconds,
+            adaptive by default, see sprint_length
+        :param stop_when_idle: return when there is nothing
+            to mine instead of waiting for transactions
+
+        [1]     Every sprint starts from fresh news: gossip,
+                peers' chains and a new block template, so
+                a sprint cut short by a competitor's tip is
+                simply followed by the next one.
+        '''
+        mined_blocks = 0
+        mined_txs = 0
+        sprints = 0
+        while not self.stop_event.is_set():
+            # Sleep while paused, waking up for stop()
+            if not self.running.is_set():
+                self.running.wait(FullNode.idle_poll)
+                continue
+            if (
+                (until_blocks is not None and mined_blocks >= until_blocks) or
+                (until_txs is not None and mined_txs >= until_txs) or
+                (deadline is not None and time.time() >= deadline) or
+                (max_sprints is not None and sprints >= max_sprints)
+            ):
+                break
+            # See mine.[1]
+            self.process_inbox()
             if self.external_consensus():
-                # If updated blockchain, start mining again
-                # for the remaining time with the fresh consensus
-                return self.longest_mine(
-                    num_sprints=num_sprints-spr,
-                    sprint_time=sprint_time
-                )
-            # Perform PoW sprint
-            proof = Blockchain.proof_of_work(
-                new_block, work_time=sprint_time
+                continue
+            new_block = self.block_template()
+            if new_block is None:
+                if stop_when_idle:
+                    break
+                self.stop_event.wait(FullNode.idle_poll)
+                continue
+            work_time = sprint_time
+            if work_time is None:
+                work_time = self.sprint_length(new_block)
+            if deadline is not None:
+                work_time = max(0.0, min(work_time, deadline - time.time()))
+            mined, cancelled = self.mining_sprint(new_block, work_time)
+            if mined is None and cancelled:
+                # Cut short, mine again on the fresh consensus
+                continue
+            sprints += 1
+            # If proof was found, add block, the mined
+            # transactions leave the mempool once the
+            # block is on the consensus chain
+            if mined:
+                with self.lock:
+                    self.blockchain.add_block(
+                        mined, mined.hash,
+                        self.blockchain.get_block(mined.previous_hash)
+                    )
+                    # In case fork becomes larger, consensus
+                    self.blockchain.internal_consensus()
+                    self.publish_tip()
+                mined_blocks += 1
+                mined_txs += len(mined.transactions)
+        return mined_blocks
+
+    def block_template(self):
+        '''
+        New block on our consensus tip with the oldest
+        payable pending transactions, None if there are none
+        '''
+        with self.lock:
+            # Choose transactions to mine, call it bucket,
+            # leaving out transfers that can't be paid yet
+            mine_bucket = self.blockchain.select_transactions(
+                Blockchain.block_capacity
             )
-            # If proof was found, add block and return True
-            if proof:
-                add_res = self.blockchain.add_block(
-                    new_block, proof, 
-                    self.blockchain.last_block
-                )
-                # Only remove transactions once block was successful
-                if add_res:
-                    self.blockchain.remove_front_transactions()
-                # In case fork becomes larger, consensus
-                self.blockchain.internal_consensus()
-                # Since already
-                return (1 + self.longest_mine(
-                    num_sprints=num_sprints-spr-1,
-                    sprint_time=sprint_time
-                ))
-        # If nothing found
-        return 0
\ No newline at end of file
+            if not mine_bucket:
+                return None
+            # Create new block on top of base block, with
+            # the target due at its height
+            base_block = self.blockchain.last_block
+            return Block(
+                depth=base_block.depth + 1,
+                transactions=mine_bucket,
+                timestamp=time.time(),
+                previous_hash=base_block.hash,
+                target=self.blockchain.next_target(base_block)
+            )
+
+    def sprint_length(self, block):
+        '''
+        Seconds to mine block for: a share of the time our
+        measured hash rate takes to find a block at its
+        target, shorter when the block is not full so that
+        new transactions get in soon, within min_sprint_time
+        and max_sprint_time
+        '''
+        hash_rate = self.miner.hash_rate
+        if hash_rate <= 0:
+            return FullNode.min_sprint_time
+        expected = 2 ** 256 / (block.target + 1) / hash_rate
+        fill = len(block.transactions) / Blockchain.block_capacity
+        length = FullNode.sprint_share * expected * min(1.0, fill)
+        return min(
+            max(length, FullNode.min_sprint_time), FullNode.max_sprint_time
+        )
+
+    def mining_sprint(self, block, work_time):
+        '''
+        One proof of work sprint on block, cancelled when a
+        competitor announces a tip with as much work, or by
+        pause() and stop(). Returns (mined block or None,
+        whether the sprint was cut short).
+        '''
+        token = CancelToken()
+        with self.lock:
+            parent = self.blockchain.get_block(block.previous_hash)
+            parent_work = (
+                0 if parent is None else self.blockchain.chain_work(parent)
+            )
+        self.mining_work = parent_work + block_work(block.target)
+        self.mining_token = token
+        # pause() or stop() may have come in meanwhile
+        if self.stop_event.is_set() or not self.running.is_set():
+            token.cancel()
+        mined = self.miner.proof_of_work(
+            block, work_time=work_time, cancel=token
+        )
+        self.mining_token = None
+        self.metrics.inc("pow_hashes", self.miner.last_hashes)
+        self.metrics.observe("pow_sprint_seconds", self.miner.last_elapsed)
+        self.metrics.set("pow_hash_rate", self.miner.last_hash_rate)
+        # Time lost to competitors, pause() and stop()
+        # cut sprints short on purpose
+        own = self.stop_event.is_set() or not self.running.is_set()
+        if token.cancelled and not own:
+            wasted = time.time() - token.cancelled_at
+            self.wasted_time += wasted
+            self.metrics.observe("pow_wasted_seconds", wasted)
+        return mined, token.cancelled
+
+    def pause(self):
+        '''
+        Suspend mine() after the current sprint, which is
+        cut short, until resume()
+        '''
+        self.running.clear()
+        self._cancel_own_sprint()
+
+    def resume(self):
+        self.running.set()
+
+    def stop(self):
+        '''
+        Make mine() return, the current sprint being cut
+        short. It holds until clear_stop(), so a stop()
+        coming in before a mine() started on another thread
+        got going still stops it.
+        '''
+        self.stop_event.set()
+        self.running.set()
+        self._cancel_own_sprint()
+
+    def clear_stop(self):
+        '''
+        Forget earlier stop() calls, by whoever starts a
+        new mine() and before starting it
+        '''
+        self.stop_event.clear()
+
+    def _cancel_own_sprint(self):
+        token = self.mining_token
+        if token is not None:
+            token.cancel()
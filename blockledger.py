@@ -0,0 +1,169 @@
+from collections import OrderedDict
+
+'''
+Account state area
+
+Transactions can be transfers between accounts, dicts
+
+    {"from": "alice", "to": "bob", "amount": 5, "nonce": 1}
+
+with a positive integer amount, the nonce only telling
+identical transfers apart: a transaction is mined at most
+once on a chain, see Blockchain.connect_block. Any other
+transaction, e.g. the plain strings of the original
+network, moves no funds.
+
+The ledger follows the consensus chain block by block.
+Connecting a block records, for every account it touches,
+the balance before it. Disconnecting the block puts those
+back, so a reorganization costs the blocks between the fork
+point and the tips, not a replay from genesis. Records are
+only kept for the last undo_depth blocks, no reorganization
+goes deeper.
+'''
+
+def is_transfer(tx):
+    return isinstance(tx, dict)
+
+def transfer_error(tx):
+    '''
+    Reason a transaction is malformed, None if it is a
+    well-formed transfer or not a transfer at all
+    '''
+    if not is_transfer(tx):
+        return None
+    sender = tx.get("from")
+    recipient = tx.get("to")
+    amount = tx.get("amount")
+    if not isinstance(sender, str) or not isinstance(recipient, str):
+        return "account"
+    if (
+        not isinstance(amount, int) or isinstance(amount, bool) or
+        amount <= 0
+    ):
+        return "amount"
+    return None
+
+class Ledger:
+    '''
+    Balances at the tip of the consensus chain, and the
+    undo records of the blocks on it
+    '''
+
+    # Balances before the first block, e.g. {"alice": 100}
+    genesis_balances = {}
+    # Blocks at the tip whose undo records are kept
+    undo_depth = 1024
+
+    def __init__(self):
+        self.balances = dict(Ledger.genesis_balances)
+        # Block hash -> [(account, balance before the block)],
+        # in chain order
+        self.undo = OrderedDict()
+
+    def balance(self, account):
+        return self.balances.get(account, 0)
+
+    def can_pay(self, tx):
+        '''
+        Whether tx could be connected on top of the tip
+        on its own
+        '''
+        if transfer_error(tx) is not None:
+            return False
+        if not is_transfer(tx):
+            return True
+        return self.balance(tx["from"]) >= tx["amount"]
+
+    def payable(self, txs, limit):
+        '''
+        Up to limit of txs, in order, that can be connected
+        together on top of the tip, e.g. to fill a block
+        '''
+        spent = {}
+        chosen = []
+        for tx in txs:
+            if len(chosen) == limit:
+                break
+            if transfer_error(tx) is not None:
+                continue
+            if is_transfer(tx):
+                sender = tx["from"]
+                left = self.balance(sender) - spent.get(sender, 0)
+                if left < tx["amount"]:
+                    continue
+                spent[sender] = spent.get(sender, 0) + tx["amount"]
+                recipient = tx["to"]
+                spent[recipient] = spent.get(recipient, 0) - tx["amount"]
+            chosen.append(tx)
+        return chosen
+
+    def connect(self, block):
+        '''
+        Apply the transfers of block, all or nothing.
+        Returns False, the ledger being left as it was,
+        if one of them overdraws its sender.
+        '''
+        balances = self.balances
+        undo = []
+        for tx in block.transactions:
+            if not is_transfer(tx):
+                continue
+            sender, recipient, amount = tx["from"], tx["to"], tx["amount"]
+            if transfer_error(tx) is not None or balances.get(sender, 0) < amount:
+                self._restore(undo)
+                return False
+            undo.append((sender, balances.get(sender)))
+            balances[sender] = balances.get(sender, 0) - amount
+            undo.append((recipient, balances.get(recipient)))
+            balances[recipient] = balances.get(recipient, 0) + amount
+        self.undo[block.hash] = undo
+        while len(self.undo) > Ledger.undo_depth:
+            self.undo.popitem(last=False)
+        return True
+
+    def disconnect(self, block):
+        '''
+        Undo connect for the block at the tip
+        '''
+        self._restore(self.undo.pop(block.hash))
+
+    def can_undo(self, num_blocks):
+        '''
+        Whether the last num_blocks connected blocks can
+        all be disconnected
+        '''
+        return num_blocks <= len(self.undo)
+
+    def to_state(self):
+        '''
+        JSON-able copy of balances and undo records
+        '''
+        return {
+            "balances": self.balances,
+            "undo": [
+                [block_hash.hex(), undo]
+                for block_hash, undo in self.undo.items()
+            ],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        '''
+        Inverse of to_state
+        '''
+        ledger = cls()
+        ledger.balances = dict(state["balances"])
+        ledger.undo = OrderedDict(
+            (bytes.fromhex(block_hash), [tuple(entry) for entry in undo])
+            for block_hash, undo in state["undo"]
+        )
+        return ledger
+
+    def _restore(self, undo):
+        balances = self.balances
+        for account, before in reversed(undo):
+            if before is None:
+                del balances[account]
+            else:
+                balances[account] = before
@@ -1,33 +1,545 @@
 from hashlib import sha256
 import json
+import struct
+from collections import OrderedDict, namedtuple
+from itertools import count, islice
 import time
 import multiprocessing
 import time
 import numpy as np
+from blockledger import Ledger
+from blockstats import depth_buckets, null_metrics
+
+# Fixed binary header layout, little-endian but for the
+# target: version, depth, previous hash, timestamp, Merkle
+# root of the transactions, big-endian 256-bit target.
+# The nonce is appended as 8 more bytes, see Block.midstate
+header_format = struct.Struct('<IQ32sd32s32s')
+nonce_format = struct.Struct('<Q')
+
+# Hashes are 32 raw bytes, the genesis block's
+# previous hash being all zeros
+hash_size = 32
+null_hash = bytes(hash_size)
+# Easiest possible proof of work target
+max_target = (1 << 256) - 1
+
+def hash_to_hex(block_hash):
+    '''
+    Hex form of a hash, "0" for the null hash
+    as in the original genesis block
+    '''
+    if block_hash == null_hash:
+        return "0"
+    return block_hash.hex()
+
+def hash_from_hex(hex_hash):
+    '''
+    Inverse of hash_to_hex, also accepts bytes as is
+    '''
+    if isinstance(hex_hash, bytes):
+        return hex_hash
+    return bytes.fromhex(hex_hash.rjust(2 * hash_size, '0'))
+
+def transaction_digest(tx):
+    '''
+    Hash of the JSON form of a transaction, leaf of
+    the Merkle tree of a block
+    '''
+    return sha256(json.dumps(tx, sort_keys=True).encode()).digest()
+
+def transaction_id(tx):
+    '''
+    Identifier of a transaction, the hash of its JSON form
+    '''
+    return transaction_digest(tx).hex()
+
+def merkle_parent(left, right):
+    '''
+    Inner node of a Merkle tree, prefixed so that it
+    can't be mistaken for a leaf
+    '''
+    return sha256(b'\x01' + left + right).digest()
+
+def merkle_level_up(level):
+    '''
+    Next level of a Merkle tree: nodes paired two by two,
+    the last node of an odd level carried up as it is
+
+    [1]     Pairing the odd node with itself instead would
+            give [a, b, c] and [a, b, c, c] the same root,
+            so a block could be altered by repeating its
+            last transactions without changing its hash.
+    '''
+    # See merkle_level_up.[1]
+    parents = [
+        merkle_parent(level[idx], level[idx + 1])
+        for idx in range(0, len(level) - 1, 2)
+    ]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+def compute_merkle_root(leaves):
+    '''
+    Merkle root of a list of leaf hashes, see
+    merkle_level_up. The root of no leaves is the
+    null hash.
+    '''
+    if not leaves:
+        return null_hash
+    level = list(leaves)
+    while len(level) > 1:
+        level = merkle_level_up(level)
+    return level[0]
+
+def merkle_proof(leaves, index):
+    '''
+    Inclusion proof of leaves[index]: the sibling hashes
+    from the leaf up to the root, as (hash, sibling_is_left)
+    pairs, levels where the node is carried up having no
+    sibling. Its length is O(log n).
+    '''
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append((level[sibling], sibling < index))
+        level = merkle_level_up(level)
+        index //= 2
+    return proof
+
+def verify_merkle_proof(leaf, proof, root):
+    '''
+    Check a merkle_proof of leaf against a Merkle root
+    '''
+    node = leaf
+    for sibling, sibling_is_left in proof:
+        if sibling_is_left:
+            node = merkle_parent(sibling, node)
+        else:
+            node = merkle_parent(node, sibling)
+    return node == root
+
+def pack_header(version, depth, previous_hash, timestamp, root, target):
+    '''
+    Binary header without the nonce
+    '''
+    return header_format.pack(
+        version, depth, previous_hash, timestamp, root,
+        target.to_bytes(hash_size, 'big')
+    )
+
+def retarget(target, first, last, interval):
+    '''
+    Target following a retargeting window, scaled by how
+    long the window took compared to interval seconds per
+    block, by at most max_retarget_factor either way
+    :param first, last: first and last block (or header)
+        of the window
+    '''
+    blocks = last.depth - first.depth
+    if blocks <= 0:
+        return target
+    # Integer milliseconds keep 256-bit arithmetic exact
+    expected = int(interval * blocks * 1000)
+    actual = int((last.timestamp - first.timestamp) * 1000)
+    factor = Blockchain.max_retarget_factor
+    actual = min(max(actual, expected // factor), expected * factor)
+    return min(target * actual // expected, max_target)
+
+def expected_target(parent, ancestor_at):
+    '''
+    Target a child of parent has to meet: the parent's one,
+    but on the first block of every retarget_interval
+    blocks, where it is recomputed from the timestamps of
+    the previous window
+    :param ancestor_at: function giving the block (or
+        header) of parent's chain at a depth
+    '''
+    depth = parent.depth + 1
+    interval = Blockchain.retarget_interval
+    if depth % interval != 0:
+        return parent.target
+    # Genesis has a dummy timestamp, keep it out
+    first = ancestor_at(max(1, depth - interval))
+    return retarget(
+        parent.target, first, parent, Blockchain.block_interval
+    )
+
+def block_work(target):
+    '''
+    Expected number of hashes to find a block at target,
+    chains are compared by the sum of it over their blocks
+    '''
+    return (1 << 256) // (target + 1)
+
+def timestamp_in_bounds(block, parent, ancestor_at, now=None):
+    '''
+    Whether block (or header) is later than the median
+    timestamp of the median_time_span blocks ending with
+    parent, and at most max_future_time seconds ahead of
+    now, time.time() by default. Legacy blocks predate
+    the median rule, they only get the second check.
+    :param ancestor_at: function giving the block (or
+        header) of parent's chain at a depth
+    '''
+    if now is None:
+        now = time.time()
+    if block.timestamp > now + Blockchain.max_future_time:
+        return False
+    if block.version == Block.legacy_version:
+        return True
+    first = max(0, parent.depth - Blockchain.median_time_span + 1)
+    times = sorted(
+        ancestor_at(depth).timestamp
+        for depth in range(first, parent.depth + 1)
+    )
+    return block.timestamp > times[len(times) // 2]
+
+def target_due(block, parent, ancestor_at):
+    '''
+    Target block (or header) has to carry as a child of
+    parent: the initial one for legacy blocks, mined before
+    retargeting existed, see expected_target otherwise
+    '''
+    if block.version == Block.legacy_version:
+        return Blockchain.initial_target()
+    return expected_target(parent, ancestor_at)
+
+def chain_locator(hash_at, tip_depth):
+    '''
+    Block locator for chain sync: hashes of a chain going
+    back from the tip, one by one for the last ten blocks
+    and then with doubling steps, always ending with
+    genesis. Its length is O(log depth).
+    :param hash_at: function giving the hash at a depth
+    '''
+    hashes = []
+    depth = tip_depth
+    step = 1
+    while depth > 0:
+        hashes.append(hash_at(depth))
+        if len(hashes) >= 10:
+            step *= 2
+        depth -= step
+    hashes.append(hash_at(0))
+    return hashes
+
+class BlockHeader(namedtuple('BlockHeader', [
+    'depth', 'previous_hash', 'timestamp',
+    'merkle_root', 'nonce', 'version', 'hash', 'target'
+])):
+    '''
+    Header of a block, enough to check its proof of
+    work and the inclusion of its transactions
+    '''
+    __slots__ = ()
+
+    def compute_hash(self):
+        '''
+        Hash of the header, None for legacy blocks whose
+        hash covers the whole transaction list
+        '''
+        if self.version == Block.legacy_version:
+            return None
+        return sha256(pack_header(
+            self.version, self.depth, self.previous_hash,
+            self.timestamp, self.merkle_root, self.target
+        ) + nonce_format.pack(self.nonce)).digest()
 
 class Block:
+    '''
+    Block class;
+    version 1 blocks are hashed as a JSON dump of their
+    fields (legacy chains), version 2 blocks through the
+    compact binary header.
+
+    [1]     Blocks are immutable once built, so that nodes can
+            share them without copying. The hash is computed
+            at construction unless given, e.g. when decoding
+            a block received from elsewhere; is_valid_proof
+            always recomputes it. Equality and hashing go by
+            block hash.
+    '''
+
+    legacy_version = 1
+    header_version = 2
+
+    __slots__ = (
+        'depth', 'transactions', 'timestamp', 'previous_hash',
+        'nonce', 'version', 'hash', 'merkle_root', 'target'
+    )
+
     def __init__(
         self, depth, transactions, timestamp,
-        previous_hash, nonce=0
+        previous_hash, nonce=0, version=header_version,
+        hash=None, merkle_root=None, target=None
     ):
-        self.depth = depth
-        self.transactions = transactions
-        self.timestamp = timestamp
-        self.previous_hash = previous_hash
-        self.nonce = nonce
+        # See Block.[1]
+        init = object.__setattr__
+        init(self, 'depth', depth)
+        init(self, 'transactions', tuple(transactions))
+        init(self, 'timestamp', timestamp)
+        init(self, 'previous_hash', hash_from_hex(previous_hash))
+        init(self, 'nonce', nonce)
+        init(self, 'version', version)
+        if merkle_root is None:
+            merkle_root = compute_merkle_root(self.tx_digests())
+        init(self, 'merkle_root', merkle_root)
+        # Proof of work target, the initial one by default
+        if target is None:
+            target = Blockchain.initial_target()
+        init(self, 'target', target)
+        if hash is None:
+            hash = self.compute_hash()
+        init(self, 'hash', hash_from_hex(hash))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Block is immutable, can't set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Block is immutable, can't delete {name}")
+
+    def __reduce__(self):
+        # Pickled through the constructor, see Block.[1]
+        return (Block, (
+            self.depth, self.transactions, self.timestamp,
+            self.previous_hash, self.nonce, self.version, self.hash,
+            self.merkle_root, self.target
+        ))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def with_nonce(self, nonce, block_hash=None):
+        '''
+        Same block with another nonce, e.g. once the proof
+        of work found one
+        '''
+        return Block(
+            self.depth, self.transactions, self.timestamp,
+            self.previous_hash, nonce, self.version, block_hash,
+            self.merkle_root, self.target
+        )
 
     def compute_hash(self):
         '''
         A function that return the hash of the block contents.
         '''
-        block_str = json.dumps(self.__dict__, sort_keys=True)
-        return sha256(block_str.encode()).hexdigest()
+        if self.version == Block.legacy_version:
+            return self.compute_legacy_hash()
+        block_hash = self.midstate()
+        block_hash.update(nonce_format.pack(self.nonce))
+        return block_hash.digest()
+
+    def compute_legacy_hash(self):
+        '''
+        Hash of the JSON dump of the block contents, as
+        done before the binary header was introduced.
+        '''
+        block_str = json.dumps({
+            "depth": self.depth,
+            "nonce": self.nonce,
+            "previous_hash": hash_to_hex(self.previous_hash),
+            "timestamp": self.timestamp,
+            "transactions": self.transactions
+        }, sort_keys=True)
+        return sha256(block_str.encode()).digest()
+
+    def tx_digests(self):
+        '''
+        Merkle leaves of the block's transactions
+        '''
+        return [transaction_digest(tx) for tx in self.transactions]
+
+    def header_prefix(self):
+        '''
+        Binary header without the nonce. It commits to the
+        transactions through their Merkle root, so its size
+        does not depend on the number of transactions.
+        '''
+        return pack_header(
+            self.version, self.depth, self.previous_hash,
+            self.timestamp, self.merkle_root, self.target
+        )
+
+    def header(self):
+        return BlockHeader(
+            self.depth, self.previous_hash, self.timestamp,
+            self.merkle_root, self.nonce, self.version, self.hash,
+            self.target
+        )
+
+    def inclusion_proof(self, tx):
+        '''
+        Merkle proof that tx is in the block, None if not
+        '''
+        if tx not in self.transactions:
+            return None
+        return merkle_proof(
+            self.tx_digests(), self.transactions.index(tx)
+        )
+
+    def midstate(self):
+        '''
+        SHA-256 object fed with the constant header prefix.
+        Callers copy() it and only add the nonce bytes.
+        '''
+        return sha256(self.header_prefix())
+
+    def to_dict(self):
+        '''
+        Plain dict form of the block, JSON friendly,
+        hashes in hex
+        '''
+        return {
+            "depth": self.depth,
+            "transactions": list(self.transactions),
+            "timestamp": self.timestamp,
+            "previous_hash": hash_to_hex(self.previous_hash),
+            "nonce": self.nonce,
+            "version": self.version,
+            "hash": hash_to_hex(self.hash),
+            "target": f"{self.target:064x}",
+        }
+
+    @classmethod
+    def from_dict(cls, blk_dict):
+        '''
+        Inverse of to_dict, dicts without a version
+        are legacy blocks dumped before it existed
+        '''
+        return cls(
+            blk_dict["depth"], blk_dict["transactions"],
+            blk_dict["timestamp"], blk_dict["previous_hash"],
+            blk_dict["nonce"],
+            blk_dict.get("version", Block.legacy_version),
+            blk_dict.get("hash"),
+            target=(
+                int(blk_dict["target"], 16) if "target" in blk_dict
+                else None
+            )
+        )
 
     def __eq__(self, other):
         '''
-        Overloading the equality operator
+        Overloading the equality operator, see Block.[1]
+        '''
+        if not isinstance(other, Block):
+            return NotImplemented
+        return self.hash == other.hash
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    def __repr__(self):
+        return f"Block(depth={self.depth}, hash={self.hash.hex()[:16]}...)"
+
+TxStatus = namedtuple('TxStatus', [
+    'state', 'block_hash', 'depth', 'confirmations'
+])
+TxStatus.__doc__ = '''
+Where a transaction stands for a node: state is "confirmed"
+with the consensus block holding it, "pending" in the
+mempool or "unknown", block fields being None but for
+confirmed ones
+'''
+
+class Mempool:
+    '''
+    Outstanding transactions keyed by transaction id,
+    in insertion order. Adding, removing and membership
+    are O(1), so updating it for every block stays cheap
+    whatever the number of pending transactions.
+    '''
+    def __init__(self, transactions=()):
+        self.pending = OrderedDict()
+        self.add_many(transactions)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __iter__(self):
+        return iter(self.pending.values())
+
+    def __contains__(self, tx):
+        return transaction_id(tx) in self.pending
+
+    def add(self, tx):
+        '''
+        Queue a transaction at the back, return False
+        if it was already pending
+        '''
+        tx_id = transaction_id(tx)
+        if tx_id in self.pending:
+            return False
+        self.pending[tx_id] = tx
+        return True
+
+    def add_many(self, transactions):
+        '''
+        Queue several transactions, return how many were new
+        '''
+        return sum(self.add(tx) for tx in transactions)
+
+    def discard(self, tx):
+        '''
+        Drop a transaction if pending, return whether it was
+        '''
+        return self.pending.pop(transaction_id(tx), None) is not None
+
+    def remove_many(self, transactions):
+        '''
+        Drop the transactions of a mined block, missing
+        ones are ignored
+        '''
+        for tx in transactions:
+            self.pending.pop(transaction_id(tx), None)
+
+    def readd_many(self, transactions, confirmed=()):
+        '''
+        Put transactions of an orphaned block back at the
+        front, keeping their order, since they are older
+        than anything still pending
+        :param confirmed: ids of transactions mined on the
+            consensus chain, left out
         '''
-        return self.__dict__ == other.__dict__
+        for tx in reversed(transactions):
+            tx_id = transaction_id(tx)
+            if tx_id in confirmed:
+                continue
+            self.pending[tx_id] = tx
+            self.pending.move_to_end(tx_id, last=False)
+
+    def peek(self, num):
+        '''
+        First num pending transactions, oldest first
+        '''
+        return list(islice(self.pending.values(), num))
+
+class CancelToken:
+    '''
+    Cancellation flag handed to the proof of work. Checking
+    it is a plain attribute read, so the nonce loop can poll
+    it often. Quacks like the stop_event of search_nonces.
+    '''
+    def __init__(self):
+        self.cancelled = False
+        # When cancel was first called, None before that
+        self.cancelled_at = None
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled_at = time.time()
+            self.cancelled = True
+
+    def is_set(self):
+        return self.cancelled
 
 class Blockchain:
     '''
@@ -35,41 +547,358 @@ class Blockchain:
     Inspired from IBM version at the moment.
     '''
 
+    # Initial difficulty, in leading hex zeros
     difficulty = 4
     block_capacity = 3
+    # Retargeting: every retarget_interval blocks the
+    # target moves toward block_interval seconds per block
+    retarget_interval = 16
+    block_interval = 10.0
+    max_retarget_factor = 4
+    # Timestamps have to be later than the median of the
+    # last median_time_span blocks, and at most
+    # max_future_time seconds ahead of the clock
+    median_time_span = 11
+    max_future_time = 2 * 60 * 60.0
+    # Nonces tried between clock checks in search_nonces
+    check_interval = 256
+    # Consensus blocks between two ledger checkpoints
+    # saved to the store, see restore_state
+    checkpoint_interval = 256
+    # Consensus blocks below the tip kept in the tree when
+    # a store holds them, see prune_tree
+    tree_depth = 64
 
-    def __init__(self):
+    def __init__(
+        self, store=None, metrics=None, legacy=False, verify_proofs=True
+    ):
         '''
         Choose initial difficulty and 
         create the genesis block
+        :param store: optional BlockStore persisting the
+            consensus chain, reopened as is when not empty
+        :param metrics: optional blockstats.Metrics of the
+            owning node, disabled by default
+        :param legacy: start from the version 1 genesis
+            block of legacy chains, see
+            blockvalidation.load_legacy_chain
+        :param verify_proofs: check proofs of work of added
+            blocks, only skipped by simulations whose blocks
+            are not really mined, see blocksim
 
-        [1]     They are the orphans and stale blocks
-                It's a list of lists where we also
-                store the block leading to the orphan.
-                That block is stored multiple time (also
-                in the longest chain)
+        [1]     Every known block lives in a tree indexed by
+                hash, children point back to their parent
+                through previous_hash. The consensus chain is
+                kept as a list from genesis to the best tip,
+                only touched by appends and by reorganizations.
+                Blocks off that list are the orphans and
+                stale blocks, see extensions. The consensus
+                chain is the one with the most work, see
+                block_work, not the deepest one.
+        [2]     A store replaces the consensus chain list.
+                Its blocks are loaded lazily, only the tip
+                goes in the tree, older ones are looked up
+                in the store by get_block. The tree only
+                keeps the last tree_depth consensus blocks,
+                see prune_tree. Stale branches are not
+                persisted. The ledger is saved to the store
+                every checkpoint_interval blocks, reopening
+                only replays the blocks after the checkpoint.
+                Transactions are looked up in the store
+                instead of tx_index, see tx_depth. The work
+                of stored blocks is known by subtracting
+                from the tip's, see chain_work.
         '''
+        if metrics is None:
+            metrics = null_metrics
+        self.metrics = metrics
+        self.verify_proofs = verify_proofs
         # Transactions to be mined
-        self.outstanding_transactions = []
-        # Consensus chain and extensions, see [1]
-        self.chain = []
-        self.extensions = []
-        # Create genesis block
-        self.create_genesis_block()
+        self.mempool = Mempool()
+        # Block tree, see [1]
+        self.blocks = {}
+        self.children = {}
+        # Hash -> cumulative work of the chain ending in
+        # every block of the tree, see chain_work
+        self.work = {}
+        # Hash -> cumulative work of every block without
+        # children
+        self.tips = {}
+        # Hash of the tip with the most work, first seen
+        # wins ties
+        self.best_tip = None
+        # Blocks disconnected by each reorganization
+        self.reorg_depths = []
+        # Hashes of blocks whose transfers could not be
+        # connected, and of their descendants
+        self.invalid = set()
+        # Balances at the consensus tip
+        self.ledger = Ledger()
+        # Transaction id -> depth of the consensus block
+        # holding it, see connect_block, None with a store,
+        # see [2]
+        self.tx_index = {}
+        # Depth of the last ledger checkpoint, see [2]
+        self.checkpoint_height = 0
+        # Depth of the tip when the tree was last pruned
+        self.pruned_height = 0
+        # Consensus chain, see [1] and [2]
+        self.store = store
+        if store is None:
+            self.main_chain = []
+        else:
+            self.main_chain = store
+            self.tx_index = None
+        if self.main_chain:
+            self.restore_state()
+            tip = self.main_chain[-1]
+            self.blocks[tip.hash] = tip
+            self.children[tip.hash] = []
+            self.tips[tip.hash] = self.work[tip.hash]
+            self.best_tip = tip.hash
+        else:
+            # Create genesis block
+            self.create_genesis_block(legacy)
 
-    def create_genesis_block(self):
+    def create_genesis_block(self, legacy=False):
         """
         A function to generate genesis block and appends it to
         the chain. The block has index 0, previous_hash as 0, and
         a valid hash.
         """
-        genesis_block = Block(0, [], 0, "0")
-        genesis_block.hash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
+        if legacy:
+            version = Block.legacy_version
+        else:
+            version = Block.header_version
+        genesis_block = Block(0, [], 0, null_hash, version=version)
+        self.insert_block(genesis_block)
+        self.main_chain.append(genesis_block)
+
+    def restore_state(self):
+        '''
+        Rebuild the ledger of a reopened store, from its
+        checkpoint if it is still on the stored chain, from
+        genesis otherwise, see [2]. The stored chain ends
+        before a block whose transfers can't be applied.
+        '''
+        store = self.store
+        start = 1
+        work = block_work(store[0].target)
+        checkpoint = store.load_checkpoint()
+        if checkpoint is not None:
+            height, state = checkpoint
+            self.ledger = Ledger.from_state(state["ledger"])
+            work = state["work"]
+            self.checkpoint_height = height
+            start = height + 1
+        for depth in range(start, len(store)):
+            blk = store[depth]
+            if not self.ledger.connect(blk):
+                del store[depth:]
+                break
+            work += block_work(blk.target)
+        self.work[store.hash_at(len(store) - 1)] = work
+
+    def save_checkpoint(self, fork_depth):
+        '''
+        Save the ledger to the store every checkpoint_interval
+        blocks, or once blocks above fork_depth replaced the
+        checkpointed one
+        '''
+        if self.store is None:
+            return
+        depth = self.last_block.depth
+        if (
+            fork_depth < self.checkpoint_height or
+            depth - self.checkpoint_height >= Blockchain.checkpoint_interval
+        ):
+            self.store.save_checkpoint(depth, {
+                "ledger": self.ledger.to_state(),
+                "work": self.chain_work(self.last_block),
+            })
+            self.checkpoint_height = depth
+
+    def prune_tree(self):
+        '''
+        Drop consensus blocks more than tree_depth blocks
+        below the tip from the tree when a store holds them,
+        see [2]. Stale branches stay. The tree is scanned
+        every tree_depth blocks only.
+        '''
+        depth = self.last_block.depth
+        if (
+            self.store is None or
+            depth - self.pruned_height < Blockchain.tree_depth
+        ):
+            return
+        bottom = depth - Blockchain.tree_depth
+        for block_hash, blk in list(self.blocks.items()):
+            if blk.depth < bottom and self.on_main_chain(blk):
+                del self.blocks[block_hash]
+                self.children.pop(block_hash, None)
+        # Including the work chain_work found for stored blocks
+        for block_hash in list(self.work):
+            if block_hash not in self.blocks:
+                del self.work[block_hash]
+        self.pruned_height = depth
+
+    def tx_depth(self, tx_id):
+        '''
+        Depth of the consensus block holding the transaction
+        with id tx_id, None if it is not mined, see [2]
+        '''
+        if self.tx_index is None:
+            return self.store.tx_height(bytes.fromhex(tx_id))
+        return self.tx_index.get(tx_id)
+
+    @property
+    def chain(self):
+        '''
+        Consensus chain, genesis first. This is the live
+        list, callers should not modify it.
+        '''
+        return self.main_chain
+
+    @property
+    def outstanding_transactions(self):
+        '''
+        Snapshot of the mempool as a list, oldest first
+        '''
+        return list(self.mempool)
 
     @property
     def last_block(self):
-        return self.chain[-1]
+        return self.main_chain[-1]
+
+    @property
+    def extensions(self):
+        '''
+        Stale branches as lists starting with the block
+        of the consensus chain they fork from, the way
+        they used to be stored before the block tree.
+        '''
+        extensions = []
+        for tip_hash in self.tips:
+            ext = []
+            blk = self.get_block(tip_hash)
+            while not self.on_main_chain(blk):
+                ext.append(blk)
+                blk = self.get_block(blk.previous_hash)
+            if ext:
+                ext.append(blk)
+                extensions.append(ext[::-1])
+        return extensions
+
+    def on_main_chain(self, block):
+        '''
+        Whether block is part of the consensus chain
+        '''
+        if block.depth >= len(self.main_chain):
+            return False
+        return self.hash_at(block.depth) == block.hash
+
+    def hash_at(self, depth):
+        '''
+        Hash of the consensus block at depth
+        '''
+        if self.store is not None:
+            return self.store.hash_at(depth)
+        return self.main_chain[depth].hash
+
+    def get_block(self, block_hash):
+        '''
+        Block with block_hash from the tree, or from the
+        store for older consensus blocks, None if unknown
+        '''
+        blk = self.blocks.get(block_hash)
+        if blk is None and self.store is not None:
+            height = self.store.find(block_hash)
+            if height is not None:
+                blk = self.store[height]
+        return blk
+
+    def chain_work(self, block):
+        '''
+        Cumulative work of the chain ending in block, which
+        has to be in the tree or on the consensus chain.
+        Consensus blocks only kept in the store get it from
+        the closest block above them whose work is known.
+        '''
+        work = self.work.get(block.hash)
+        if work is None:
+            depth = block.depth + 1
+            above = 0
+            while self.hash_at(depth) not in self.work:
+                above += block_work(self.main_chain[depth].target)
+                depth += 1
+            child = self.main_chain[depth]
+            work = (
+                self.work[child.hash] - above - block_work(child.target)
+            )
+            self.work[block.hash] = work
+        return work
+
+    def has_block(self, block_hash):
+        if block_hash in self.blocks:
+            return True
+        return (
+            self.store is not None and
+            self.store.find(block_hash) is not None
+        )
+
+    def insert_block(self, block):
+        '''
+        Link an already validated block (hash set) into
+        the block tree and update the tips.
+        '''
+        work = block_work(block.target)
+        parent = self.get_block(block.previous_hash)
+        if parent is not None:
+            work += self.chain_work(parent)
+        # Parents only in the store are consensus blocks below
+        # the tip, never tips, see prune_tree
+        if block.previous_hash in self.blocks:
+            self.children.setdefault(
+                block.previous_hash, []
+            ).append(block.hash)
+            self.tips.pop(block.previous_hash, None)
+        self.blocks[block.hash] = block
+        self.children[block.hash] = []
+        self.work[block.hash] = work
+        self.tips[block.hash] = work
+        if self.best_tip is None or work > self.work[self.best_tip]:
+            self.best_tip = block.hash
+
+    def invalidate(self, block):
+        '''
+        Drop block and its descendants from the tree, they
+        can never be on the consensus chain, and choose the
+        best tip among the remaining ones
+        '''
+        stack = [block.hash]
+        while stack:
+            block_hash = stack.pop()
+            self.invalid.add(block_hash)
+            self.blocks.pop(block_hash, None)
+            self.work.pop(block_hash, None)
+            self.tips.pop(block_hash, None)
+            stack.extend(self.children.pop(block_hash, ()))
+        siblings = self.children.get(block.previous_hash)
+        if siblings is not None and block.hash in siblings:
+            siblings.remove(block.hash)
+            if not siblings:
+                parent = self.get_block(block.previous_hash)
+                self.tips[parent.hash] = self.chain_work(parent)
+        # max keeps the first seen of tips with equal work
+        self.best_tip = max(self.tips, key=self.tips.get)
+
+    def reject_block(self, reason):
+        '''
+        Count a rejected block by reason, returns False
+        so that callers can return it directly
+        '''
+        self.metrics.inc("blocks_rejected", labels={"reason": reason})
+        return False
 
     def add_block_longest(self, block, proof):
         """
@@ -78,12 +907,32 @@ class Blockchain:
         """
         # Reject if previous hash not accurate
         if self.last_block.hash != block.previous_hash:
-            return False
+            return self.reject_block("previous_hash")
+        # Reject if the target is not the one due at its height
+        if not self.valid_target(block, self.last_block):
+            return self.reject_block("target")
+        # Reject if its timestamp is out of bounds
+        if not self.valid_timestamp(block, self.last_block):
+            return self.reject_block("timestamp")
         # Reject if proof is not valid hash
-        if not Blockchain.is_valid_proof(block, proof):
-            return False
-        block.hash = proof
-        self.chain.append(block)
+        if block.hash != proof or not self.valid_proof(block, proof):
+            return self.reject_block("proof")
+        # Reject if already known
+        if self.has_block(proof):
+            return self.reject_block("duplicate")
+        if proof in self.invalid:
+            return self.reject_block("invalid")
+        self.insert_block(block)
+        # Reject if it replays a transaction of the chain
+        # or its transfers overdraw an account
+        reason = self.connect_block(block)
+        if reason is not None:
+            self.invalidate(block)
+            return self.reject_block(reason)
+        self.main_chain.append(block)
+        self.save_checkpoint(block.depth - 1)
+        self.prune_tree()
+        self.metrics.inc("blocks_accepted", labels={"branch": "longest"})
         return True
 
     def add_block(
@@ -95,107 +944,531 @@ class Blockchain:
         :param base_block: the base block receiving the potential new block
         
         [1]     If base_block is not last block in longest chain, 
-                check all extensions for their last block. If again, none
-                of the extensions have the base_block as their last, create
-                another extension. You could have nested extensions because of
-                this, but shouldn't care.
+                the block goes in the tree as a child of base_block
+                and stays off the consensus chain until
+                internal_consensus picks its branch.
         """
         # If the base block is the last block 
         # in longest chain, just use regular add
-        if base_block == self.last_block:
+        if base_block.hash == self.last_block.hash:
             return self.add_block_longest(block, proof)
         
         # Previous hash should be accurate, reject otherwise
         if base_block.hash != block.previous_hash:
-            return False    
+            return self.reject_block("previous_hash")
+        # Base block has to be known
+        if not self.has_block(base_block.hash):
+            return self.reject_block("unknown_base")
+        # Reject if the target is not the one due on its branch
+        if not self.valid_target(block, base_block):
+            return self.reject_block("target")
+        # Reject if its timestamp is out of bounds
+        if not self.valid_timestamp(block, base_block):
+            return self.reject_block("timestamp")
         # Reject if proof is not valid hash of block
-        if not Blockchain.is_valid_proof(block, proof):
-            return False
-        # If checks passed, update the block's hash
-        block.hash = proof
-
-        # Check all extensions for the base block
-        # See add_block.[1] 
-        for ext_idx in range(self.extensions):
-            # Check each last block in extensions
-            if base_block == self.extensions[ext_idx][-1]:
-                # If found, proceed there
-                self.extensions[ext_idx].append(block)
-                return True
-        # If not found there, create extension
-        self.extensions.append([base_block, block])
+        if block.hash != proof or not self.valid_proof(block, proof):
+            return self.reject_block("proof")
+        # Reject if already known
+        if self.has_block(proof):
+            return self.reject_block("duplicate")
+        # Reject if known to be invalid, or its parent is
+        if proof in self.invalid or base_block.hash in self.invalid:
+            return self.reject_block("invalid")
+        # See add_block.[1]
+        self.insert_block(block)
+        self.metrics.inc("blocks_accepted", labels={"branch": "fork"})
         return True
 
     def internal_consensus(self):
         '''
         Method to update to longest chain using possibly
-        larger extensions. So it checks if any extension
-        is longer than current chain. In case of a change,
-        the tail of the current chain becomes a new extension.
-        
-        [1]     If any update happens, return True and stop
-                since another one is impossible. This is because
-                we are calling this at each mine, so changes are
-                continuously updated.
-        '''
-        for ext in self.extensions:
-            if ext[-1].depth > self.last_block.depth:
-                fork_depth = ext[0].depth
-                # Create new extension with chain to be
-                # dumped
-                self.extensions.append(
-                    self.chain[fork_depth:]
-                )
-                # Remove and store chain tail until 
-                # depth of fork node, then add extension
-                # tail to now have longest chain
-                while self.last_block.depth >= fork_depth:
-                    self.chain.pop()
-                self.chain = self.chain + ext
-                # See internal_consensus.[1]
-                return True
+        larger extensions. So it checks if the best tip of
+        the tree has more work than the current chain. In
+        case of a change, the tail of the current chain
+        becomes a stale branch.
+        '''
+        changed = False
+        with self.metrics.timer("internal_consensus_seconds"):
+            # A branch failing to connect is dropped, the
+            # next best one is tried, see reorganize
+            while True:
+                best = self.blocks[self.best_tip]
+                if self.work[self.best_tip] <= self.chain_work(
+                    self.last_block
+                ):
+                    break
+                if self.reorganize(best) is not None:
+                    changed = True
         # If no internal consensus update, return False
-        return False
+        return changed
+
+    def locator(self):
+        '''
+        Block locator of the consensus chain, see chain_locator
+        '''
+        return chain_locator(self.hash_at, self.last_block.depth)
+
+    def blocks_after(self, locator, limit=None):
+        '''
+        Answer a locator from another node: the consensus
+        blocks after the first locator hash that is on our
+        consensus chain, i.e. after the common ancestor.
+        The blocks are shared, not copied.
+        :param limit: maximum number of blocks returned
+        '''
+        start = 1
+        for block_hash in locator:
+            blk = self.get_block(block_hash)
+            if blk is not None and self.on_main_chain(blk):
+                start = blk.depth + 1
+                break
+        stop = None if limit is None else start + limit
+        return self.main_chain[start:stop]
+
+    def headers_after(self, locator, limit=None):
+        '''
+        Same as blocks_after, with headers only
+        '''
+        return [blk.header() for blk in self.blocks_after(locator, limit)]
+
+    def find_transaction(self, tx):
+        '''
+        Consensus block holding tx, None if not mined
+        '''
+        depth = self.tx_depth(transaction_id(tx))
+        if depth is None:
+            return None
+        return self.main_chain[depth]
+
+    def transaction_status(self, tx_id):
+        '''
+        TxStatus of the transaction with id tx_id, see
+        transaction_id, without scanning any block
+        '''
+        depth = self.tx_depth(tx_id)
+        if depth is not None:
+            return TxStatus(
+                "confirmed", self.hash_at(depth), depth,
+                self.last_block.depth - depth + 1
+            )
+        if tx_id in self.mempool.pending:
+            return TxStatus("pending", None, None, 0)
+        return TxStatus("unknown", None, None, 0)
+
+    def transaction_statuses(self, tx_ids):
+        '''
+        Dict of tx id -> TxStatus, see transaction_status
+        '''
+        return {tx_id: self.transaction_status(tx_id) for tx_id in tx_ids}
+
+    def adopt_chain(self, chain, validated=False):
+        '''
+        Take blocks of a longer consensus chain from
+        elsewhere, link the ones we don't know yet and
+        switch to it. Blocks are shared with the sender,
+        they must not be modified once they have a hash.
+        :param chain: list of blocks in chain order, the
+            parent of the first one must be known already
+        :param validated: targets and proofs were checked
+            already, e.g. by blockvalidation.ChainValidator
+        '''
+        for blk in chain:
+            if self.has_block(blk.hash):
+                continue
+            if blk.hash in self.invalid or blk.previous_hash in self.invalid:
+                return self.reject_block("invalid")
+            parent = self.get_block(blk.previous_hash)
+            if parent is None:
+                return self.reject_block("unknown_base")
+            if not validated:
+                # Historical targets, see expected_target
+                if not self.valid_target(blk, parent):
+                    return self.reject_block("target")
+                if not self.valid_timestamp(blk, parent):
+                    return self.reject_block("timestamp")
+                if not self.valid_proof(blk, blk.hash):
+                    return self.reject_block("proof")
+            self.insert_block(blk)
+            self.metrics.inc("blocks_accepted", labels={"branch": "sync"})
+        return self.internal_consensus()
+
+    def reorganize(self, tip):
+        '''
+        Make the branch ending in tip the consensus chain.
+        Only the blocks above the fork point are touched.
+        Returns (disconnected, connected) block lists, both
+        in chain order, None if the branch is invalid.
+
+        [1]     A block that can't be connected, see
+                connect_block, makes the whole switch fail:
+                the branch is rolled back, the old chain
+                connected again and the block dropped, see
+                invalidate.
+        [2]     The ledger can only undo its last undo_depth
+                blocks. A branch forking below them is never
+                switched to, it is dropped the same way.
+        '''
+        # Walk back from the new tip to the consensus chain
+        connected = []
+        blk = tip
+        while not self.on_main_chain(blk):
+            connected.append(blk)
+            blk = self.get_block(blk.previous_hash)
+        connected.reverse()
+        fork_depth = blk.depth
+        # See reorganize.[2]
+        if not self.ledger.can_undo(self.last_block.depth - fork_depth):
+            self.invalidate(connected[0])
+            self.reject_block("reorg_depth")
+            return None
+        # Pop the old tail down to the fork point
+        disconnected = self.main_chain[fork_depth + 1:]
+        for blk in reversed(disconnected):
+            # Stored blocks may only have lived in the store,
+            # keep the now stale ones in the tree
+            self.chain_work(blk)
+            self.blocks.setdefault(blk.hash, blk)
+        # Off the chain before being disconnected, so that a
+        # store doesn't find their transactions anymore
+        del self.main_chain[fork_depth + 1:]
+        for blk in reversed(disconnected):
+            self.disconnect_block(blk)
+        for idx, blk in enumerate(connected):
+            reason = self.connect_block(blk)
+            if reason is not None:
+                # See reorganize.[1]
+                del self.main_chain[fork_depth + 1:]
+                for done in reversed(connected[:idx]):
+                    self.disconnect_block(done)
+                for old in disconnected:
+                    self.connect_block(old)
+                    self.main_chain.append(old)
+                self.invalidate(blk)
+                self.reject_block(reason)
+                return None
+            self.main_chain.append(blk)
+        self.save_checkpoint(fork_depth)
+        self.prune_tree()
+        if disconnected:
+            self.reorg_depths.append(len(disconnected))
+            self.metrics.inc("reorgs")
+            self.metrics.inc("blocks_replaced", len(disconnected))
+            self.metrics.observe(
+                "reorg_depth", len(disconnected), buckets=depth_buckets
+            )
+        return disconnected, connected
+
+    def connect_block(self, block):
+        '''
+        Update the state that follows the consensus chain
+        as block becomes its tip. Returns None, or the
+        reason it can't be connected, nothing being changed
+        then: "duplicate_tx" if it holds a transaction twice,
+        "replay" if it holds a transaction mined before,
+        "ledger" if a transfer overdraws an account.
+
+        [1]     A transaction is mined once per chain, a
+                transfer mined again would move its amount
+                twice. Its first block is on the consensus
+                chain when the second one is connected, so
+                it is found by tx_depth, unless both are in
+                the block itself.
+        '''
+        # See connect_block.[1]
+        tx_ids = [transaction_id(tx) for tx in block.transactions]
+        if len(set(tx_ids)) != len(tx_ids):
+            return "duplicate_tx"
+        if any(self.tx_depth(tx_id) is not None for tx_id in tx_ids):
+            return "replay"
+        if not self.ledger.connect(block):
+            return "ledger"
+        self.index_block(block)
+        self.mempool.remove_many(block.transactions)
+        self.metrics.set("mempool_size", len(self.mempool))
+        return None
+
+    def disconnect_block(self, block):
+        '''
+        Undo connect_block for a block leaving the
+        consensus chain, its transactions are pending again
+        '''
+        self.ledger.disconnect(block)
+        tx_ids = [transaction_id(tx) for tx in block.transactions]
+        if self.tx_index is not None:
+            for tx_id in tx_ids:
+                self.tx_index.pop(tx_id, None)
+        confirmed = [
+            tx_id for tx_id in tx_ids if self.tx_depth(tx_id) is not None
+        ]
+        self.mempool.readd_many(block.transactions, confirmed)
+        self.metrics.set("mempool_size", len(self.mempool))
+
+    def index_block(self, block):
+        '''
+        Add the transactions of a block joining the
+        consensus chain to tx_index. A store indexes them
+        as the block is appended, see [2].
+        '''
+        if self.tx_index is None:
+            return
+        for tx in block.transactions:
+            self.tx_index[transaction_id(tx)] = block.depth
 
     @staticmethod
-    def proof_of_work(block, work_time = None):
+    def proof_of_work(block, work_time = None, cancel = None):
         """
         Do proof of work and stop after a work_time seconds.
-        :param starting_nonce: can store progress
+        :param block: template, its nonce is ignored
         :param work_time: storing progress requires early stopping
             and we're using a potentially pre-set time
+        :param cancel: optional CancelToken, the work stops
+            within check_interval nonces once it is cancelled
+        Returns the mined block, with good nonce and hash.
+        """
+        # Start from 0, flexibility here to be debated
+        mined, _ = Blockchain.search_nonces(
+            block, 0, work_time=work_time, stop_event=cancel
+        )
+        # Return mined block, None if out of time or cancelled
+        return mined
+
+    @staticmethod
+    def search_nonces(
+        block, start, stop=None, work_time=None, stop_event=None
+    ):
+        """
+        Hot loop of the proof of work, shared by the serial
+        path and the worker processes of the mining engine.
+        Tries nonces in [start, stop) and returns a pair
+        (mined block or None, number of hashes tried).
+        :param stop: None means an unbounded nonce range
+        :param work_time: seconds before giving up, None for inf
+        :param stop_event: optional event set by whoever wants
+            the search cancelled, e.g. a sibling worker that won
+
+        [1]     Clock and event are only polled every
+                check_interval nonces, they cost more than
+                a hash attempt otherwise.
         """
         # Parse work_time None to inf
         if work_time is None:
             work_time = float('inf')
-        start = time.time()
-        # Start from 0, flexibility here to be debated
-        block.nonce = 0
-        # Do computational work
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * Blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
-            # Return if out of time
-            if (time.time() - start) > work_time:
-                return
-        # Return good hash
-        return computed_hash
+        start_time = time.time()
+        nonces = count(start) if stop is None else range(start, stop)
+        target = block.target.to_bytes(hash_size, 'big')
+        # Legacy blocks have no binary header to reuse
+        if block.version == Block.legacy_version:
+            midstate = None
+        else:
+            midstate = block.midstate()
+        pack_nonce = nonce_format.pack
+        tried = 0
+        for nonce in nonces:
+            if midstate is None:
+                computed_hash = block.with_nonce(nonce).hash
+            else:
+                attempt = midstate.copy()
+                attempt.update(pack_nonce(nonce))
+                computed_hash = attempt.digest()
+            tried += 1
+            # Same length big-endian bytes compare like integers
+            if computed_hash <= target:
+                return block.with_nonce(nonce, computed_hash), tried
+            # See search_nonces.[1]
+            if tried % Blockchain.check_interval == 0:
+                # Return if out of time
+                if (time.time() - start_time) > work_time:
+                    return None, tried
+                # Return if someone else called it off
+                if stop_event is not None and stop_event.is_set():
+                    return None, tried
+        # Nonce range exhausted
+        return None, tried
 
     def add_new_transaction(self, transaction):
-        self.outstanding_transactions.append(transaction)
+        '''
+        Queue a transaction, refused if malformed, if it
+        is mined already or if its sender can't pay for it
+        at the consensus tip
+        '''
+        if (
+            self.tx_depth(transaction_id(transaction)) is not None or
+            not self.ledger.can_pay(transaction)
+        ):
+            self.metrics.inc("transactions_rejected")
+            return False
+        added = self.mempool.add(transaction)
+        self.metrics.set("mempool_size", len(self.mempool))
+        return added
+
+    def add_new_transactions(self, transactions):
+        '''
+        Same as add_new_transaction for several, returns
+        how many were queued
+        '''
+        return sum(self.add_new_transaction(tx) for tx in transactions)
+
+    def select_transactions(self, limit):
+        '''
+        Up to limit pending transactions, oldest first, that
+        can go in a block on the consensus tip together
+        '''
+        return self.ledger.payable(self.mempool, limit)
 
     def remove_front_transactions(self):
-        self.outstanding_transactions = self.outstanding_transactions[Blockchain.block_capacity:]
+        self.mempool.remove_many(
+            self.mempool.peek(Blockchain.block_capacity)
+        )
 
     def get_outstanding_transactions(self):
         return self.outstanding_transactions
 
+    @classmethod
+    def initial_target(cls):
+        """
+        Target of the genesis block and of the first retarget
+        window: hashes with difficulty leading hex zeros
+        """
+        return (1 << (256 - 4 * cls.difficulty)) - 1
+
+    def next_target(self, parent):
+        """
+        Target the child of parent has to meet, see
+        expected_target
+        """
+        return expected_target(
+            parent, lambda depth: self.ancestor(parent, depth)
+        )
+
+    def ancestor(self, block, depth):
+        """
+        Block at depth on the branch of block. Walks back
+        until the consensus chain, then indexes it.
+        """
+        while block.depth > depth and not self.on_main_chain(block):
+            block = self.get_block(block.previous_hash)
+        if block.depth == depth:
+            return block
+        return self.main_chain[depth]
+
     @classmethod
     def is_valid_proof(cls, block, block_hash):
         """
         Check if block_hash is valid hash of block and satisfies
-        the difficulty criteria.
+        the block's target. Whether that target is the right
+        one for its height is checked by valid_target.
         """
-        return (block_hash.startswith('0' * Blockchain.difficulty) and
+        return (int.from_bytes(block_hash, 'big') <= block.target and
                 block_hash == block.compute_hash())
+
+    def valid_proof(self, block, block_hash):
+        """
+        is_valid_proof, unless this blockchain does not
+        verify proofs, see verify_proofs
+        """
+        return (
+            not self.verify_proofs or
+            Blockchain.is_valid_proof(block, block_hash)
+        )
+
+    def valid_timestamp(self, block, parent):
+        """
+        Check the block's timestamp against the median of
+        its branch and the clock, see timestamp_in_bounds
+        """
+        return timestamp_in_bounds(
+            block, parent, lambda depth: self.ancestor(parent, depth)
+        )
+
+    def valid_target(self, block, parent):
+        """
+        Check the block carries the target expected at its
+        height on parent's branch, see target_due
+        """
+        return block.target == target_due(
+            block, parent, lambda depth: self.ancestor(parent, depth)
+        )
+
+class HeaderChain:
+    '''
+    Header-only consensus chain, as kept by clients to check
+    transaction inclusion proofs without the blocks
+    '''
+    def __init__(self):
+        genesis_block = Block(0, [], 0, null_hash)
+        self.headers = [genesis_block.header()]
+        # Hash -> depth of every header of the chain
+        self.depths = {genesis_block.hash: 0}
+        # Cumulative work up to every header, see block_work
+        self.work = [block_work(genesis_block.target)]
+
+    @property
+    def last_header(self):
+        return self.headers[-1]
+
+    def locator(self):
+        return chain_locator(
+            lambda depth: self.headers[depth].hash,
+            self.last_header.depth
+        )
+
+    def extend(self, headers):
+        '''
+        Switch to a chain with more work given the headers
+        after our common ancestor with it. Links, timestamps
+        and proofs of work are checked, nothing changes if
+        any of them is wrong or if the result does not have
+        more work. Returns whether it switched.
+        '''
+        if not headers:
+            return False
+        fork_depth = self.depths.get(headers[0].previous_hash)
+        if fork_depth is None:
+            return False
+        parent = self.headers[fork_depth]
+        work = [self.work[fork_depth]]
+
+        def ancestor_at(depth):
+            if depth <= fork_depth:
+                return self.headers[depth]
+            return headers[depth - fork_depth - 1]
+
+        for header in headers:
+            if (
+                header.previous_hash != parent.hash or
+                header.depth != parent.depth + 1 or
+                header.target != target_due(header, parent, ancestor_at) or
+                not timestamp_in_bounds(header, parent, ancestor_at) or
+                int.from_bytes(header.hash, 'big') > header.target or
+                header.compute_hash() != header.hash
+            ):
+                return False
+            work.append(work[-1] + block_work(header.target))
+            parent = header
+        if work[-1] <= self.work[-1]:
+            return False
+        for header in self.headers[fork_depth + 1:]:
+            del self.depths[header.hash]
+        del self.headers[fork_depth + 1:]
+        del self.work[fork_depth + 1:]
+        for header in headers:
+            self.headers.append(header)
+            self.depths[header.hash] = header.depth
+        self.work.extend(work[1:])
+        return True
+
+    def verify_inclusion(self, tx, block_hash, proof):
+        '''
+        Check that tx is in the block block_hash of our chain
+        with a Merkle proof, returns the block depth, or None
+        if the check fails
+        '''
+        depth = self.depths.get(block_hash)
+        if depth is None:
+            return None
+        header = self.headers[depth]
+        if not verify_merkle_proof(
+            transaction_digest(tx), proof, header.merkle_root
+        ):
+            return None
+        return depth
@@ -0,0 +1,163 @@
+import multiprocessing
+import time
+from blocklogic import Blockchain
+
+'''
+Mining engine area
+'''
+
+# Nonce space split between the workers, each worker
+# gets a disjoint contiguous range of it. Nonces are
+# packed as u64, see blocklogic.nonce_format
+nonce_space = 2 ** 64
+
+# Seconds between two looks at a cancel token
+# while waiting on the workers
+cancel_poll = 0.002
+
+# Set in every worker process by the pool initializer
+_stop_event = None
+
+def _init_worker(stop_event):
+    '''
+    Pool initializer, keeps the shared stop event
+    around for the lifetime of the worker process
+    '''
+    global _stop_event
+    _stop_event = stop_event
+
+def _search_range(block, start, stop, work_time):
+    '''
+    Worker side of the engine. Search [start, stop)
+    and call everyone else off if we win.
+    Returns (mined block or None, hashes tried).
+    '''
+    mined, tried = Blockchain.search_nonces(
+        block, start, stop,
+        work_time=work_time, stop_event=_stop_event
+    )
+    if mined is not None:
+        _stop_event.set()
+    return mined, tried
+
+class MiningEngine:
+    '''
+    Proof of work backed by a process pool, so
+    that mining threads are not bound by the GIL.
+    The nonce space is split into disjoint ranges,
+    one per worker, and the first valid proof wins.
+    With a single worker everything runs in-process.
+    '''
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = max(1, workers)
+        # Hashing statistics, cumulative and last sprint
+        self.hashes = 0
+        self.elapsed = 0.0
+        self.last_hashes = 0
+        self.last_elapsed = 0.0
+        self.pool = None
+        self.stop_event = None
+        if self.workers > 1:
+            self.stop_event = multiprocessing.Event()
+            self.pool = multiprocessing.Pool(
+                self.workers,
+                initializer=_init_worker,
+                initargs=(self.stop_event,)
+            )
+
+    @property
+    def hash_rate(self):
+        '''
+        Average hashes per second over all sprints
+        '''
+        if self.elapsed == 0:
+            return 0.0
+        return self.hashes / self.elapsed
+
+    @property
+    def last_hash_rate(self):
+        '''
+        Hashes per second during the last sprint
+        '''
+        if self.last_elapsed == 0:
+            return 0.0
+        return self.last_hashes / self.last_elapsed
+
+    def proof_of_work(self, block, work_time=None, cancel=None):
+        '''
+        Same contract as Blockchain.proof_of_work: return
+        the mined block, or None once work_time seconds
+        went by or once the cancel token was cancelled.
+        '''
+        start = time.time()
+        if self.pool is None:
+            mined, tried = Blockchain.search_nonces(
+                block, 0, work_time=work_time, stop_event=cancel
+            )
+        else:
+            mined, tried = self._parallel_search(
+                block, work_time, cancel
+            )
+        self._record(tried, time.time() - start)
+        return mined
+
+    def _parallel_search(self, block, work_time, cancel=None):
+        '''
+        Hand one nonce range to each worker, wait for
+        the first proof or for all of them to give up.
+
+        [1]     Results are collected from every worker,
+                the losers return shortly after the stop
+                event is set, and their hash counts are
+                needed for the statistics.
+        [2]     Workers can't see the cancel token, it is
+                polled here and relayed through the stop event.
+        '''
+        self.stop_event.clear()
+        span = nonce_space // self.workers
+        pending = [
+            self.pool.apply_async(
+                _search_range,
+                (block, idx * span, (idx + 1) * span, work_time)
+            )
+            for idx in range(self.workers)
+        ]
+        # See _parallel_search.[2]
+        if cancel is not None:
+            for res in pending:
+                while not res.ready():
+                    if cancel.is_set():
+                        self.stop_event.set()
+                        break
+                    res.wait(cancel_poll)
+        # See _parallel_search.[1]
+        results = [res.get() for res in pending]
+        tried = sum(result[1] for result in results)
+        for mined, _ in results:
+            if mined is not None:
+                return mined, tried
+        return None, tried
+
+    def _record(self, tried, elapsed):
+        self.last_hashes = tried
+        self.last_elapsed = elapsed
+        self.hashes += tried
+        self.elapsed += elapsed
+
+    def close(self):
+        '''
+        Stop the worker processes
+        '''
+        if self.pool is not None:
+            self.stop_event.set()
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
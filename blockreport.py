@@ -0,0 +1,185 @@
+import csv
+import json
+from itertools import zip_longest
+from blocklogic import Blockchain, hash_to_hex
+
+'''
+Chain report area
+
+Reports are streamed: rows of blocks come from a generator
+over the nodes' chains, blocks are read in place and every
+line goes straight to a buffered file.
+'''
+
+# Column width of the side-by-side report
+column_width = 35
+# Write buffer of report files
+buffer_size = 1 << 16
+
+def tx_text(tx):
+    '''
+    One-line form of a transaction: plain strings as they
+    are, anything else, e.g. transfers, as compact JSON
+    '''
+    if isinstance(tx, str):
+        return tx
+    return json.dumps(tx, sort_keys=True, separators=(',', ':'))
+
+def iter_rows(chains):
+    '''
+    Yield, for every depth, the tuple of blocks the chains
+    have at that depth, None for chains that are shorter
+    '''
+    return zip_longest(*chains)
+
+class ColumnWriter:
+    '''
+    Side-by-side text columns, one per node, blocks shown
+    as indented JSON with truncated hashes
+    '''
+    def __init__(self, f, num_nodes):
+        self.f = f
+        self.num_nodes = num_nodes
+        self.hash_lim = Blockchain.difficulty + 10
+        # {, fields, transactions opening and closing, }
+        self.block_lines = 11 + Blockchain.block_capacity
+        self.blank = "".ljust(column_width)
+
+    def write_line(self, cells):
+        self.f.write(
+            "".join(cell.ljust(column_width) + "\t|\t" for cell in cells)
+            + "\n"
+        )
+
+    def block_lines_of(self, blk):
+        '''
+        Lines of a block, same text as the pretty-printed
+        sorted-keys JSON of its fields
+        '''
+        if blk is None:
+            return []
+        fields = blk.to_dict()
+        fields["hash"] = str(fields["hash"])[:self.hash_lim]
+        fields["previous_hash"] = str(fields["previous_hash"])[:self.hash_lim]
+        fields["target"] = fields["target"][:self.hash_lim]
+        keys = sorted(fields)
+        lines = ["{"]
+        for idx, key in enumerate(keys):
+            sep = "," if idx < len(keys) - 1 else ""
+            value = fields[key]
+            if isinstance(value, (list, tuple)):
+                if not value:
+                    lines.append(f'  "{key}": []{sep}')
+                    continue
+                lines.append(f'  "{key}": [')
+                for tx_idx, tx in enumerate(value):
+                    tx_sep = "," if tx_idx < len(value) - 1 else ""
+                    lines.append(f"    {json.dumps(tx)}{tx_sep}")
+                lines.append(f"  ]{sep}")
+            else:
+                lines.append(f'  "{key}": {json.dumps(value)}{sep}')
+        lines.append("}")
+        return lines
+
+    def write_header(self):
+        self.write_line(f"Node {n}" for n in range(self.num_nodes))
+
+    def write_row(self, blocks):
+        columns = [self.block_lines_of(blk) for blk in blocks]
+        for line_num in range(self.block_lines):
+            self.write_line(
+                col[line_num] if line_num < len(col) else self.blank
+                for col in columns
+            )
+        # Append horizontal space
+        self.f.write("\n")
+
+    def write_footer(self, mempools):
+        # Horizontal space and _ separator line
+        self.f.write("_" * (43 * self.num_nodes) + "\n")
+        # Print transaction leftovers
+        self.write_line(str(len(txs)) for txs in mempools)
+        texts = [map(tx_text, txs) for txs in mempools]
+        for row in zip_longest(*texts, fillvalue=""):
+            self.write_line(row)
+
+class JsonlWriter:
+    '''
+    One compact JSON object per line: every block with
+    its node index, then every node's pending transactions
+    '''
+    def __init__(self, f, num_nodes):
+        self.f = f
+        self.num_nodes = num_nodes
+
+    def write_header(self):
+        pass
+
+    def write_row(self, blocks):
+        for node_idx, blk in enumerate(blocks):
+            if blk is None:
+                continue
+            record = blk.to_dict()
+            record["node"] = node_idx
+            self.f.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def write_footer(self, mempools):
+        for node_idx, txs in enumerate(mempools):
+            self.f.write(json.dumps(
+                {"node": node_idx, "mempool": list(txs)},
+                separators=(',', ':')
+            ) + "\n")
+
+class CsvWriter:
+    '''
+    One CSV row per block and node, transactions joined
+    with ";". Pending transactions are not part of it.
+    '''
+
+    columns = [
+        "node", "depth", "hash", "previous_hash", "nonce",
+        "timestamp", "version", "target", "tx_count", "transactions"
+    ]
+
+    def __init__(self, f, num_nodes):
+        self.writer = csv.writer(f)
+        self.num_nodes = num_nodes
+
+    def write_header(self):
+        self.writer.writerow(CsvWriter.columns)
+
+    def write_row(self, blocks):
+        for node_idx, blk in enumerate(blocks):
+            if blk is None:
+                continue
+            self.writer.writerow([
+                node_idx, blk.depth, hash_to_hex(blk.hash),
+                hash_to_hex(blk.previous_hash), blk.nonce, blk.timestamp,
+                blk.version, f"{blk.target:064x}", len(blk.transactions),
+                ";".join(map(tx_text, blk.transactions))
+            ])
+
+    def write_footer(self, mempools):
+        pass
+
+writers = {
+    "columns": ColumnWriter,
+    "jsonl": JsonlWriter,
+    "csv": CsvWriter,
+}
+
+def write_report(nodes, path, fmt="columns"):
+    '''
+    Stream the chains and mempools of nodes to path
+    :param fmt: "columns" (side by side, as in
+        blocks_result.txt), "jsonl" or "csv"
+    '''
+    chains = [node.blockchain.chain for node in nodes]
+    with open(path, 'w', buffering=buffer_size, newline="") as f:
+        writer = writers[fmt](f, len(nodes))
+        writer.write_header()
+        for blocks in iter_rows(chains):
+            writer.write_row(blocks)
+        writer.write_footer(
+            [node.blockchain.mempool for node in nodes]
+        )
@@ -0,0 +1,377 @@
+import argparse
+import heapq
+import json
+import random
+import sys
+import time
+
+# Own imports
+from blockexport import export_blocks, save_blocks
+from blocklogic import Block, Blockchain
+from blockstats import fork_stats
+
+'''
+Network simulation area
+
+Consensus runs under a virtual clock instead of wall-clock
+mining. All nodes share one Blockchain holding every block
+found, so targets, retargeting, timestamps and chain work
+are the ones of the real network; a node only keeps its
+consensus tip and the tips of the stale branches it heard
+of, what it knows is their ancestry in the shared tree.
+Blocks are not mined: a node finds its next block after an
+exponential time of rate
+
+    hash rate * (target + 1) / 2 ** 256
+
+and messages between peers arrive after a random delay.
+Everything is drawn from one seeded generator, so a run is
+reproduced by its seed. Every node still hears of every
+block, so a run takes about one event per node and block
+found.
+
+    python blocksim.py --nodes 1000 --blocks 2000 --seed 1
+'''
+
+# Event kinds, ordered in the heap after time and sequence
+found_event = 0
+deliver_event = 1
+
+class SimNode:
+    '''
+    Simulated full node: its consensus tip and the tips of
+    the stale branches it knows in the block tree shared by
+    all nodes, a modeled hash rate and a list of peers
+    '''
+    def __init__(self, index, hash_rate, tree):
+        self.index = index
+        self.hash_rate = hash_rate
+        self.tree = tree
+        self.tip = tree.last_block
+        self.tip_work = tree.chain_work(self.tip)
+        # Hash -> tip of a branch we heard of that is off
+        # our chain, see known_blocks
+        self.stale_tips = {}
+        # Blocks disconnected by each tip switch
+        self.reorg_depths = []
+        self.peers = []
+        # Version and target of the pending block
+        # discovery, see Simulator.schedule_mining
+        self.mining_seq = 0
+        self.mining_target = None
+        # Arrival time and work of the best delivery on its
+        # way to us, see Simulator.[1]
+        self.pending_at = 0.0
+        self.pending_work = -1
+        self.mined = 0
+        self.tip_changed_at = 0.0
+
+    def known_blocks(self):
+        '''
+        (consensus chain, stale blocks), the way
+        blockexport.export_blocks reads a node
+        '''
+        chain = [self.tip]
+        while chain[-1].depth > 0:
+            chain.append(self.tree.get_block(chain[-1].previous_hash))
+        chain.reverse()
+        main = {blk.hash for blk in chain}
+        stale = {}
+        for blk in self.stale_tips.values():
+            while blk.hash not in main and blk.hash not in stale:
+                stale[blk.hash] = blk
+                blk = self.tree.get_block(blk.previous_hash)
+        return chain, list(stale.values())
+
+class Simulator:
+    '''
+    Discrete-event simulation of a mining network
+    :param num_nodes: number of nodes
+    :param hash_rate: hashes per second of every node, or
+        a list of one rate per node
+    :param num_peers: random peers each node picks, links
+        go both ways
+    :param latency: fixed part of a message delay, seconds
+    :param jitter: mean of the exponential part of a
+        message delay, seconds
+    :param seed: seed of every random draw of the run
+
+    [1]     A node relays its tip block to its peers whenever
+            its consensus tip changes, but to peers whose tip
+            has at least as much work already or that have
+            a delivery of as much work arriving sooner on
+            its way. A peer missing
+            ancestors of the block takes them from the shared
+            tree at the time the message arrives, standing
+            for the locator sync FullNode.external_consensus
+            does with the sender, and switches to the block
+            if its chain has more work than the peer's tip,
+            the first seen winning ties as in Blockchain.
+    '''
+    def __init__(
+        self, num_nodes=16, hash_rate=1e6, num_peers=8,
+        latency=0.05, jitter=0.05, seed=0
+    ):
+        self.rng = random.Random(seed)
+        if isinstance(hash_rate, (int, float)):
+            hash_rate = [hash_rate] * num_nodes
+        # Blocks are not mined, their proofs are not checked
+        self.tree = Blockchain(verify_proofs=False)
+        self.nodes = [
+            SimNode(idx, rate, self.tree)
+            for idx, rate in enumerate(hash_rate)
+        ]
+        self.connect(min(num_peers, num_nodes - 1))
+        self.latency = latency
+        self.jitter = jitter
+        self.now = 0.0
+        self.queue = []
+        self.seq = 0
+        self.events = 0
+        self.mined = 0
+        self.mining = True
+
+    def connect(self, num_peers):
+        '''
+        Random symmetric peer graph, every node
+        picking num_peers of the others
+        '''
+        nodes = self.nodes
+        links = [set() for _ in nodes]
+        for node in nodes:
+            for _ in range(num_peers):
+                other = self.rng.randrange(len(nodes) - 1)
+                # Skip ourselves
+                if other >= node.index:
+                    other += 1
+                links[node.index].add(other)
+                links[other].add(node.index)
+        for node, peers in zip(nodes, links):
+            node.peers = [nodes[idx] for idx in sorted(peers)]
+
+    def schedule(self, delay, kind, *args):
+        self.seq += 1
+        heapq.heappush(
+            self.queue, (self.now + delay, self.seq, kind) + args
+        )
+
+    def delay(self):
+        if self.jitter:
+            return self.latency + self.rng.expovariate(1 / self.jitter)
+        return self.latency
+
+    def schedule_mining(self, node):
+        '''
+        Draw the time until node finds a block on its tip.
+        Discovery is memoryless, so the draw pending on its
+        previous tip stays good, it is only dropped when
+        the target changed.
+        '''
+        if not self.mining or node.hash_rate <= 0:
+            return
+        target = self.tree.next_target(node.tip)
+        if target == node.mining_target:
+            return
+        node.mining_seq += 1
+        node.mining_target = target
+        rate = node.hash_rate * ((target + 1) / 2 ** 256)
+        self.schedule(
+            self.rng.expovariate(rate), found_event, node, node.mining_seq
+        )
+
+    def switch_tip(self, node, tip):
+        '''
+        Make tip node's consensus tip, counting the blocks
+        of its old chain that are not on the new one, relay
+        it, see Simulator.[1], and mine on it
+        '''
+        old, new = node.tip, tip
+        while old.hash != new.hash:
+            if old.depth >= new.depth:
+                old = self.tree.get_block(old.previous_hash)
+            else:
+                new = self.tree.get_block(new.previous_hash)
+        if node.tip.depth > old.depth:
+            node.reorg_depths.append(node.tip.depth - old.depth)
+            node.stale_tips[node.tip.hash] = node.tip
+        work = self.tree.chain_work(tip)
+        node.tip = tip
+        node.tip_work = work
+        node.tip_changed_at = self.now
+        # No delay is shorter than latency
+        soonest = self.now + self.latency
+        for peer in node.peers:
+            if peer.tip_work >= work:
+                continue
+            if peer.pending_work >= work and peer.pending_at <= soonest:
+                continue
+            delay = self.delay()
+            arrival = self.now + delay
+            if peer.pending_work >= work and peer.pending_at <= arrival:
+                continue
+            peer.pending_at = arrival
+            peer.pending_work = work
+            self.schedule(delay, deliver_event, peer, tip)
+        self.schedule_mining(node)
+
+    def on_found(self, node, seq):
+        if seq != node.mining_seq:
+            return
+        tree = self.tree
+        parent = node.tip
+        # A random nonce keeps blocks of different
+        # nodes apart, they hold no transactions
+        block = Block(
+            parent.depth + 1, (), self.now, parent.hash,
+            nonce=self.rng.getrandbits(64),
+            target=tree.next_target(parent)
+        )
+        tree.add_block(block, block.hash, parent)
+        # Keeps the shared consensus chain on the best
+        # branch, so ancestors are found by index
+        tree.internal_consensus()
+        # The draw is used up, see schedule_mining
+        node.mining_target = None
+        node.mined += 1
+        self.mined += 1
+        self.switch_tip(node, block)
+
+    def on_deliver(self, node, block):
+        '''
+        A block node knows is never heavier than its tip, so
+        the work alone tells whether to switch, see
+        Simulator.[1]. A lighter block off node's chain is
+        the tip of a stale branch it knows.
+        '''
+        tree = self.tree
+        if tree.chain_work(block) > node.tip_work:
+            self.switch_tip(node, block)
+        elif (
+            block.depth > node.tip.depth or
+            tree.ancestor(node.tip, block.depth).hash != block.hash
+        ):
+            node.stale_tips[block.hash] = block
+
+    def run(self, until_time=None, until_blocks=None):
+        '''
+        Run until until_time virtual seconds or until_blocks
+        blocks were found, then let the messages in flight
+        arrive. Returns the measurements, see measure.
+        '''
+        start = time.perf_counter()
+        for node in self.nodes:
+            self.schedule_mining(node)
+        queue = self.queue
+        while queue:
+            event = heapq.heappop(queue)
+            if self.mining and (
+                (until_time is not None and event[0] > until_time) or
+                (until_blocks is not None and self.mined >= until_blocks)
+            ):
+                # Mining is over, only deliveries are left
+                self.mining = False
+            if event[2] == found_event and not self.mining:
+                # Not a step of the run, the clock stays
+                continue
+            self.now = event[0]
+            self.events += 1
+            if event[2] == found_event:
+                self.on_found(*event[3:])
+            else:
+                self.on_deliver(*event[3:])
+        return self.measure(time.perf_counter() - start)
+
+    def measure(self, wall_time):
+        '''
+        Fork statistics of a finished run, same names as
+        blockbench.measure where they mean the same
+        '''
+        best = max(self.nodes, key=lambda node: node.tip_work)
+        tip = best.tip
+        blocks = tip.depth
+        last_time = tip.timestamp if blocks else 0.0
+        # Genesis has a dummy timestamp, intervals start at 1
+        first_time = (
+            self.tree.ancestor(tip, 1).timestamp if blocks > 1 else last_time
+        )
+        return dict(
+            virtual_time=self.now,
+            wall_time=wall_time,
+            events=self.events,
+            blocks=blocks,
+            mined=self.mined,
+            mean_block_interval=(
+                (last_time - first_time) / (blocks - 1) if blocks > 1 else 0.0
+            ),
+            **fork_stats(
+                blocks, self.mined - blocks,
+                [node.reorg_depths for node in self.nodes]
+            ),
+            converged=len(set(node.tip.hash for node in self.nodes)) == 1,
+            time_to_consensus=max(
+                node.tip_changed_at for node in self.nodes
+            ),
+        )
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Simulate the mining network under a virtual clock"
+    )
+    parser.add_argument("--nodes", type=int, default=16)
+    parser.add_argument("--hash-rate", type=float,
+                        help="hashes per second of every node, by default "
+                        "the network finds blocks every block interval "
+                        "at the initial difficulty")
+    parser.add_argument("--peers", type=int, default=8,
+                        help="random peers every node picks")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--blocks", type=int,
+                        help="stop mining after this many blocks")
+    parser.add_argument("--time", type=float,
+                        help="stop mining after this many virtual seconds")
+    parser.add_argument("--difficulty", type=int, default=4,
+                        help="initial difficulty, in leading hex zeros")
+    parser.add_argument("--block-interval", type=float, default=10.0)
+    parser.add_argument("--retarget-interval", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="JSON file, stdout if omitted")
+    parser.add_argument("--export",
+                        help="save the blocks of every node to this "
+                        ".npy or .npz file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.blocks is None and args.time is None:
+        args.blocks = 1000
+    Blockchain.difficulty = args.difficulty
+    Blockchain.block_interval = args.block_interval
+    Blockchain.retarget_interval = args.retarget_interval
+    if args.hash_rate is None:
+        network_rate = (
+            2 ** 256 / (Blockchain.initial_target() + 1) /
+            Blockchain.block_interval
+        )
+        args.hash_rate = network_rate / args.nodes
+    sim = Simulator(
+        num_nodes=args.nodes, hash_rate=args.hash_rate,
+        num_peers=args.peers, latency=args.latency,
+        jitter=args.jitter, seed=args.seed
+    )
+    result = dict(config=vars(args))
+    result["metrics"] = sim.run(
+        until_time=args.time, until_blocks=args.blocks
+    )
+    if args.export:
+        save_blocks(export_blocks(sim.nodes), args.export)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
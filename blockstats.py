@@ -0,0 +1,266 @@
+import json
+import time
+from bisect import bisect_left
+from collections import Counter
+
+'''
+Instrumentation area
+
+Counters, gauges and latency histograms kept per node.
+A node's metrics are only updated from that node, under
+its lock or from its own mining thread, so no locking
+happens here.
+'''
+
+# Upper bounds in seconds of the latency histogram buckets
+latency_buckets = (
+    1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3,
+    0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0
+)
+# Upper bounds of buckets counting blocks, e.g. reorg depths
+depth_buckets = (1, 2, 3, 4, 6, 8, 12, 16, 32, 64, 128)
+
+class Histogram:
+    '''
+    Cumulative-bucket histogram, Prometheus style
+    '''
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        '''
+        (upper bound, observations <= bound) pairs,
+        the last bound being +Inf
+        '''
+        total = 0
+        pairs = []
+        for bound, num in zip(self.buckets + (float('inf'),), self.counts):
+            total += num
+            pairs.append((bound, total))
+        return pairs
+
+class _Timer:
+    '''
+    Context manager observing its duration
+    '''
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(
+            self.name, time.perf_counter() - self.start, self.labels
+        )
+
+class Metrics:
+    '''
+    Metrics of one node. Series are identified by a name
+    and optional labels, e.g. the reason a block was
+    rejected.
+    :param labels: constant labels of every series,
+        e.g. {"node": "n1"}
+    '''
+
+    enabled = True
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return (name, ())
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, labels=None):
+        key = Metrics._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        self.gauges[Metrics._key(name, labels)] = value
+
+    def observe(self, name, value, labels=None, buckets=latency_buckets):
+        key = Metrics._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+    def timer(self, name, labels=None):
+        '''
+        with metrics.timer("name"): ... observes the
+        block's duration in seconds
+        '''
+        return _Timer(self, name, labels)
+
+    def to_dict(self):
+        '''
+        JSON-able snapshot of every series
+        '''
+        def series(key, value):
+            name, labels = key
+            return dict(name=name, labels=dict(labels), value=value)
+        return dict(
+            labels=self.labels,
+            counters=[series(k, v) for k, v in self.counters.items()],
+            gauges=[series(k, v) for k, v in self.gauges.items()],
+            histograms=[
+                series(k, dict(
+                    count=h.count, sum=h.sum,
+                    buckets=[
+                        [str(bound), num] for bound, num in h.cumulative()
+                    ]
+                ))
+                for k, h in self.histograms.items()
+            ],
+        )
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix="blockchain_"):
+        '''
+        Prometheus text exposition of every series
+        '''
+        return prometheus_text([self], prefix)
+
+    def dump(self, path, fmt="json"):
+        '''
+        Write the metrics to path, fmt being
+        "json" or "prometheus"
+        '''
+        dump_metrics([self], path, fmt)
+
+def prometheus_text(metrics_list, prefix="blockchain_"):
+    '''
+    Prometheus text exposition of several nodes' metrics,
+    series of the same name grouped under one TYPE line
+    and told apart by the nodes' constant labels
+    '''
+    families = {}
+    for metrics in metrics_list:
+        const = tuple(metrics.labels.items())
+        for kind, series in (
+            ("counter", metrics.counters),
+            ("gauge", metrics.gauges),
+            ("histogram", metrics.histograms),
+        ):
+            for (name, labels), value in series.items():
+                families.setdefault((name, kind), []).append(
+                    (const + labels, value)
+                )
+
+    def fmt_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    lines = []
+    for (name, kind), entries in sorted(families.items()):
+        full_name = prefix + name
+        if kind == "counter":
+            full_name += "_total"
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in entries:
+            if kind != "histogram":
+                lines.append(f"{full_name}{fmt_labels(labels)} {value}")
+                continue
+            for bound, num in value.cumulative():
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(
+                    f"{full_name}_bucket"
+                    f"{fmt_labels(labels + (('le', le),))} {num}"
+                )
+            lines.append(f"{full_name}_sum{fmt_labels(labels)} {value.sum}")
+            lines.append(
+                f"{full_name}_count{fmt_labels(labels)} {value.count}"
+            )
+    return "\n".join(lines) + "\n"
+
+def dump_metrics(metrics_list, path, fmt="json"):
+    '''
+    Write several nodes' metrics to path, fmt being
+    "json" (a list of Metrics.to_dict) or "prometheus"
+    '''
+    if fmt == "json":
+        text = json.dumps([m.to_dict() for m in metrics_list], indent=2)
+    elif fmt == "prometheus":
+        text = prometheus_text(metrics_list)
+    else:
+        raise ValueError(f"Unknown metrics format: {fmt}")
+    with open(path, 'w') as f:
+        f.write(text)
+
+def fork_stats(blocks, stale, reorg_depths):
+    '''
+    Fork statistics of a run, the same for blockbench and
+    blocksim runs
+    :param blocks: blocks of the consensus chain, genesis
+        excluded
+    :param stale: blocks found off it
+    :param reorg_depths: one list of reorganization depths
+        per node
+    '''
+    reorgs = Counter()
+    for depths in reorg_depths:
+        reorgs.update(depths)
+    num_reorgs = sum(reorgs.values())
+    return dict(
+        stale_blocks=stale,
+        stale_rate=stale / max(1, blocks + stale),
+        reorgs=num_reorgs,
+        reorg_depths={
+            str(depth): reorgs[depth] for depth in sorted(reorgs)
+        },
+        mean_reorg_depth=(
+            sum(d * n for d, n in reorgs.items()) / num_reorgs
+            if num_reorgs else 0.0
+        ),
+    )
+
+class NullMetrics(Metrics):
+    '''
+    Disabled metrics, every update is a no-op
+    '''
+
+    enabled = False
+
+    def inc(self, name, value=1, labels=None):
+        pass
+
+    def set(self, name, value, labels=None):
+        pass
+
+    def observe(self, name, value, labels=None, buckets=latency_buckets):
+        pass
+
+    def timer(self, name, labels=None):
+        return _null_timer
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_null_timer = _NullTimer()
+
+# Shared default for nodes without metrics
+null_metrics = NullMetrics()
@@ -0,0 +1,517 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from blocklogic import Block, hash_size
+
+'''
+On-disk block store area
+
+A store is a directory holding these files:
+
+    blocks.dat      append-only segment of block records,
+                    each one [length u32][crc32 u32][payload]
+                    with a compact JSON payload
+    index.dat       memory-mapped fixed-width index, a header
+                    followed by one entry per height
+                    [hash 32 bytes][offset u64][length u32][pad]
+    txs.dat         transactions of the blocks, one record
+                    [digest 32 bytes][height u64] each, in
+                    height order
+    txindex.dat     memory-mapped hash table of txs.dat, a
+                    header followed by open addressing slots
+                    [digest 32 bytes][record number + 1 u64],
+                    see tx_height
+    checkpoint.json state of the chain's owner at a height,
+                    see save_checkpoint
+
+Heights are looked up by hash in a dict, read from the index
+the first time one is needed, and transactions in the hash
+table, so opening stays a constant amount of work.
+
+Reorganizations only shrink the logical height in the index
+header, records of stale blocks stay in the segment.
+'''
+
+index_magic = b'BIDX'
+# magic, entry size, number of entries, end of the segment
+index_header = struct.Struct('<4sIQQ')
+index_header_size = 32
+# block hash, record offset, payload length
+index_entry = struct.Struct('<32sQI4x')
+record_header = struct.Struct('<II')
+# transaction digest, height of its block
+tx_record = struct.Struct('<32sQ')
+tx_table_magic = b'BTXT'
+# magic, slot size, number of slots, used slots
+tx_table_header = struct.Struct('<4sIQQ')
+tx_table_header_size = 32
+# transaction digest, record number + 1 in txs.dat, 0 if empty
+tx_slot = struct.Struct('<32sQ')
+
+class BlockStore:
+    '''
+    Persistent consensus chain. Behaves like the list
+    Blockchain keeps its consensus chain in (len, indexing,
+    slicing, append, extend, del of a tail), so it can be
+    used in its place. Blocks are decoded lazily on access
+    and a few recent ones are cached.
+    :param path: directory of the store, created if needed
+    :param sync: fsync after every append, slower but
+        survives power loss and not only process crashes
+    '''
+
+    cache_size = 1024
+
+    def __init__(self, path, sync=False):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.sync = sync
+        self.cache = OrderedDict()
+        # Hash -> height, see find
+        self.heights = None
+        self.segment = self._open(os.path.join(path, 'blocks.dat'))
+        self.index_file = self._open(self._index_path())
+        if os.fstat(self.index_file.fileno()).st_size == 0:
+            self._init_index()
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        magic, entry_size, self.count, self.segment_end = (
+            index_header.unpack_from(self.index, 0)
+        )
+        if magic != index_magic or entry_size != index_entry.size:
+            raise ValueError(f"Not a block index: {self._index_path()}")
+        self.recover()
+        self._open_txs()
+
+    @staticmethod
+    def _open(file_path):
+        '''
+        Open for reading and writing, creating if needed
+        '''
+        if not os.path.exists(file_path):
+            open(file_path, 'wb').close()
+        return open(file_path, 'r+b')
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index.dat')
+
+    def _open_txs(self):
+        '''
+        Open txs.dat, written from the blocks for stores
+        older than it, and drop records a crash left past
+        the last height, see recover
+        '''
+        txs_path = os.path.join(self.path, 'txs.dat')
+        if not os.path.exists(txs_path) and self.count:
+            tmp_path = txs_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for height in range(self.count):
+                    f.write(b''.join(
+                        tx_record.pack(digest, height)
+                        for digest in self[height].tx_digests()
+                    ))
+            os.replace(tmp_path, txs_path)
+        self.txs = self._open(txs_path)
+        # Torn final record first, then unindexed ones
+        size = os.fstat(self.txs.fileno()).st_size
+        self.txs.truncate(size - size % tx_record.size)
+        self._truncate_txs(self.count)
+        self.tx_table_file = self._open(self._tx_table_path())
+        if os.fstat(self.tx_table_file.fileno()).st_size == 0:
+            self._build_tx_table()
+        self.tx_table = mmap.mmap(self.tx_table_file.fileno(), 0)
+        magic, slot_size, _, _ = tx_table_header.unpack_from(self.tx_table, 0)
+        if magic != tx_table_magic or slot_size != tx_slot.size:
+            raise ValueError(
+                f"Not a transaction table: {self._tx_table_path()}"
+            )
+
+    def _tx_table_path(self):
+        return os.path.join(self.path, 'txindex.dat')
+
+    def _build_tx_table(self):
+        '''
+        Write the hash table of every record of txs.dat, at
+        most a quarter full. Done when the table is missing,
+        e.g. for stores older than it, and once it is half
+        full, see _index_tx.
+        '''
+        self.txs.seek(0)
+        records = self.txs.read()
+        num_records = len(records) // tx_record.size
+        capacity = 1024
+        while capacity < 4 * num_records:
+            capacity *= 2
+        table = bytearray(tx_table_header_size + capacity * tx_slot.size)
+        tx_table_header.pack_into(
+            table, 0, tx_table_magic, tx_slot.size, capacity, num_records
+        )
+        mask = capacity - 1
+        for record, (digest, _) in enumerate(tx_record.iter_unpack(records)):
+            slot = int.from_bytes(digest[:8], 'little') & mask
+            while tx_slot.unpack_from(
+                table, tx_table_header_size + slot * tx_slot.size
+            )[1]:
+                slot = (slot + 1) & mask
+            tx_slot.pack_into(
+                table, tx_table_header_size + slot * tx_slot.size,
+                digest, record + 1
+            )
+        self.tx_table_file.seek(0)
+        self.tx_table_file.truncate()
+        self.tx_table_file.write(table)
+        self.tx_table_file.flush()
+
+    def _record_height(self, record, digest, end_height):
+        '''
+        Height of record number record of txs.dat if it is
+        still there, holds digest and is below end_height,
+        None otherwise
+        '''
+        offset = record * tx_record.size
+        if offset + tx_record.size > self.txs_end:
+            return None
+        self.txs.seek(offset)
+        record_digest, height = tx_record.unpack(
+            self.txs.read(tx_record.size)
+        )
+        if record_digest != digest or height >= end_height:
+            return None
+        return height
+
+    def _index_tx(self, digest, record):
+        '''
+        Point the first stale or empty slot from the
+        digest's one at record number record of txs.dat,
+        see tx_height.[1]
+        '''
+        _, _, capacity, used = tx_table_header.unpack_from(self.tx_table, 0)
+        mask = capacity - 1
+        slot = int.from_bytes(digest[:8], 'little') & mask
+        while True:
+            slot_digest, slot_record = tx_slot.unpack_from(
+                self.tx_table, tx_table_header_size + slot * tx_slot.size
+            )
+            if not slot_record:
+                used += 1
+                break
+            # Records of the block being appended are not stale
+            if self._record_height(
+                slot_record - 1, slot_digest, self.count + 1
+            ) is None:
+                break
+            slot = (slot + 1) & mask
+        tx_slot.pack_into(
+            self.tx_table, tx_table_header_size + slot * tx_slot.size,
+            digest, record + 1
+        )
+        tx_table_header.pack_into(
+            self.tx_table, 0, tx_table_magic, tx_slot.size, capacity, used
+        )
+
+    def _init_index(self, capacity=1024):
+        '''
+        Write the header of an empty index
+        '''
+        self.index_file.truncate(
+            index_header_size + capacity * index_entry.size
+        )
+        self.index_file.seek(0)
+        self.index_file.write(index_header.pack(
+            index_magic, index_entry.size, 0, 0
+        ))
+        self.index_file.flush()
+
+    @property
+    def capacity(self):
+        return (len(self.index) - index_header_size) // index_entry.size
+
+    def recover(self):
+        '''
+        Bring index and segment back in agreement after a
+        crash. Records are written before their index entry,
+        so a torn or unindexed final record shows up as
+        segment bytes past segment_end and is truncated.
+        Transaction records and their slots are written
+        before the index entry too, see _open_txs and
+        tx_height.[1]
+
+        [1]     Without fsync the OS may lose segment bytes
+                the index already points at. Entries whose
+                record is not fully there are dropped.
+        '''
+        size = os.fstat(self.segment.fileno()).st_size
+        if size > self.segment_end:
+            self.segment.truncate(self.segment_end)
+        elif size < self.segment_end:
+            # See recover.[1]
+            while self.count > 0:
+                _, offset, length = self._entry(self.count - 1)
+                if offset + record_header.size + length <= size:
+                    break
+                self.count -= 1
+            if self.count > 0:
+                _, offset, length = self._entry(self.count - 1)
+                self.segment_end = offset + record_header.size + length
+            else:
+                self.segment_end = 0
+            self.segment.truncate(self.segment_end)
+            self._write_header()
+
+    def _truncate_txs(self, height):
+        '''
+        Drop the transaction records of height and above,
+        read back from the end
+        '''
+        end = os.fstat(self.txs.fileno()).st_size
+        while end > 0:
+            self.txs.seek(end - tx_record.size)
+            _, tx_height = tx_record.unpack(self.txs.read(tx_record.size))
+            if tx_height < height:
+                break
+            end -= tx_record.size
+        self.txs.truncate(end)
+        self.txs_end = end
+
+    def _entry(self, height):
+        return index_entry.unpack_from(
+            self.index, index_header_size + height * index_entry.size
+        )
+
+    def _write_header(self):
+        index_header.pack_into(
+            self.index, 0,
+            index_magic, index_entry.size, self.count, self.segment_end
+        )
+
+    def _grow_index(self):
+        '''
+        Double the index capacity and map it again
+        '''
+        size = len(self.index)
+        self.index.close()
+        self.index_file.truncate(
+            index_header_size + 2 * (size - index_header_size)
+        )
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+
+    def _read(self, height):
+        '''
+        Decode the block at height from the segment
+        '''
+        _, offset, length = self._entry(height)
+        self.segment.seek(offset)
+        record = self.segment.read(record_header.size + length)
+        rec_length, crc = record_header.unpack_from(record, 0)
+        payload = record[record_header.size:]
+        if rec_length != length or zlib.crc32(payload) != crc:
+            raise ValueError(f"Corrupted block record at height {height}")
+        return Block.from_dict(json.loads(payload))
+
+    def hash_at(self, height):
+        '''
+        Hash at height straight from the index,
+        without decoding the block
+        '''
+        return self._entry(height)[0]
+
+    def find(self, block_hash):
+        '''
+        Height of the block with block_hash, None if it is
+        not stored
+        '''
+        if self.heights is None:
+            size = index_entry.size
+            entries = self.index[
+                index_header_size:index_header_size + self.count * size
+            ]
+            self.heights = {
+                entries[pos:pos + hash_size]: height
+                for height, pos in enumerate(range(0, len(entries), size))
+            }
+        return self.heights.get(block_hash)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[idx] for idx in range(*key.indices(self.count))]
+        if key < 0:
+            key += self.count
+        if not 0 <= key < self.count:
+            raise IndexError("block store index out of range")
+        blk = self.cache.get(key)
+        if blk is not None:
+            self.cache.move_to_end(key)
+        else:
+            blk = self._read(key)
+            self.cache[key] = blk
+            if len(self.cache) > BlockStore.cache_size:
+                self.cache.popitem(last=False)
+        return blk
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+    def __delitem__(self, key):
+        '''
+        Only tails can be deleted, as done by a reorganization
+        '''
+        if not isinstance(key, slice) or key.stop is not None:
+            raise TypeError("only del store[height:] is supported")
+        start = key.start or 0
+        if start < self.count:
+            for idx in range(start, self.count):
+                self.cache.pop(idx, None)
+                if self.heights is not None:
+                    del self.heights[self.hash_at(idx)]
+            self.count = start
+            self._write_header()
+            self._truncate_txs(start)
+
+    def append(self, block):
+        '''
+        Write block at the next height, record and
+        transactions first and index entry last, see recover
+        '''
+        payload = json.dumps(
+            block.to_dict(), separators=(',', ':')
+        ).encode()
+        self.segment.seek(self.segment_end)
+        self.segment.write(record_header.pack(
+            len(payload), zlib.crc32(payload)
+        ))
+        self.segment.write(payload)
+        self.segment.flush()
+        digests = block.tx_digests()
+        self.txs.seek(0, os.SEEK_END)
+        self.txs.write(b''.join(
+            tx_record.pack(digest, self.count) for digest in digests
+        ))
+        self.txs.flush()
+        first_record = self.txs_end // tx_record.size
+        self.txs_end += len(digests) * tx_record.size
+        _, _, capacity, used = tx_table_header.unpack_from(self.tx_table, 0)
+        if 2 * (used + len(digests)) > capacity:
+            # The table of txs.dat has the new records already
+            self.tx_table.close()
+            self._build_tx_table()
+            self.tx_table = mmap.mmap(self.tx_table_file.fileno(), 0)
+        else:
+            for record, digest in enumerate(digests, first_record):
+                self._index_tx(digest, record)
+        if self.sync:
+            os.fsync(self.segment.fileno())
+            os.fsync(self.txs.fileno())
+            self.tx_table.flush()
+        if self.count == self.capacity:
+            self._grow_index()
+        index_entry.pack_into(
+            self.index,
+            index_header_size + self.count * index_entry.size,
+            block.hash, self.segment_end, len(payload)
+        )
+        self.cache[self.count] = block
+        if self.heights is not None:
+            self.heights[block.hash] = self.count
+        self.count += 1
+        self.segment_end += record_header.size + len(payload)
+        self._write_header()
+        if self.sync:
+            self.index.flush()
+
+    def extend(self, blocks):
+        for blk in blocks:
+            self.append(blk)
+
+    def tx_height(self, digest):
+        '''
+        Height of the block holding the transaction with
+        digest, None if it is not stored. Only the slots from
+        the digest's one up to an empty one are read.
+
+        [1]     Slots are never emptied. One whose record was
+                truncated with its block, or written over by
+                another record since, is stale: lookups go on
+                past it and appends reuse it. So truncating
+                the store leaves the table alone, and slots a
+                crash left behind are stale the same way.
+        '''
+        _, _, capacity, _ = tx_table_header.unpack_from(self.tx_table, 0)
+        mask = capacity - 1
+        slot = int.from_bytes(digest[:8], 'little') & mask
+        while True:
+            slot_digest, record = tx_slot.unpack_from(
+                self.tx_table, tx_table_header_size + slot * tx_slot.size
+            )
+            if not record:
+                return None
+            if slot_digest == digest:
+                # See tx_height.[1]
+                height = self._record_height(record - 1, digest, self.count)
+                if height is not None:
+                    return height
+            slot = (slot + 1) & mask
+
+    def tx_heights(self):
+        '''
+        Transaction id -> height of its block, for every
+        stored block, see blocklogic.transaction_id. Reads
+        all of txs.dat, tx_height looks a single one up.
+        '''
+        self.txs.seek(0)
+        return {
+            digest.hex(): height
+            for digest, height in tx_record.iter_unpack(self.txs.read())
+        }
+
+    def _checkpoint_path(self):
+        return os.path.join(self.path, 'checkpoint.json')
+
+    def save_checkpoint(self, height, state):
+        '''
+        Keep JSON-able state of the chain up to height, e.g.
+        its ledger, replacing the previous checkpoint at once
+        '''
+        tmp_path = self._checkpoint_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "height": height,
+                "hash": self.hash_at(height).hex(),
+                "state": state,
+            }, f, separators=(',', ':'))
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self._checkpoint_path())
+
+    def load_checkpoint(self):
+        '''
+        (height, state) of the last checkpoint, None if there
+        is none or if its block is not stored anymore
+        '''
+        try:
+            with open(self._checkpoint_path()) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        height = checkpoint["height"]
+        if (
+            height >= self.count or
+            self.hash_at(height).hex() != checkpoint["hash"]
+        ):
+            return None
+        return height, checkpoint["state"]
+
+    def close(self):
+        self.index.flush()
+        self.index.close()
+        self.index_file.close()
+        self.segment.close()
+        self.txs.close()
+        self.tx_table.close()
+        self.tx_table_file.close()
@@ -0,0 +1,248 @@
+import contextlib
+import multiprocessing
+import threading
+from collections import OrderedDict
+from blocklogic import (
+    Block, Blockchain, compute_merkle_root, target_due,
+    timestamp_in_bounds, transaction_id
+)
+from blockledger import transfer_error
+
+'''
+Chain validation area
+
+Blocks received from peers go through two stages before
+they are adopted:
+
+    links       sequential, each block has to extend the one
+                before it: previous hash, depth, the target
+                due at its height, see target_due, and the
+                timestamp bounds, see timestamp_in_bounds
+    proofs      independent per block, so done in parallel:
+                transaction rules, Merkle root, proof of work
+
+Whether transfers are funded, and whether transactions were
+mined before, depends on the chain they are connected to,
+that is checked when they are, see Blockchain.connect_block.
+
+Both stop at the first invalid block, the blocks before it
+are still good to adopt. Hashes of blocks that passed are
+cached, so blocks seen again, e.g. by the next node of the
+same process, only have their links and hash checked.
+
+Legacy chains, of version 1 blocks dumped before blocks
+had a version, go through the same stages, starting from
+the legacy genesis block, see load_legacy_chain.
+'''
+
+def check_block(blk, capacity):
+    '''
+    Checks of a block that need nothing but the block:
+    reason it is invalid, None if it is valid
+    '''
+    txs = blk.transactions
+    if len(txs) > capacity:
+        return "capacity"
+    if len(set(map(transaction_id, txs))) != len(txs):
+        return "duplicate_tx"
+    if any(transfer_error(tx) is not None for tx in txs):
+        return "transaction"
+    if blk.merkle_root != compute_merkle_root(blk.tx_digests()):
+        return "merkle_root"
+    if not Blockchain.is_valid_proof(blk, blk.hash):
+        return "proof"
+    return None
+
+def _check_chunk(task):
+    '''
+    Worker side, task being (blocks, capacity): (index in
+    blocks, reason) of the first invalid block, None if
+    they are all valid
+    '''
+    chunk, capacity = task
+    for idx, blk in enumerate(chunk):
+        reason = check_block(blk, capacity)
+        if reason is not None:
+            return idx, reason
+    return None
+
+class ChainValidator:
+    '''
+    Validates blocks received from peers before a
+    Blockchain adopts them. Can be shared by the nodes
+    of a process, and by their threads.
+    :param workers: processes checking proofs, everything
+        runs in-process with one worker
+    '''
+
+    # Blocks per task handed to a worker
+    chunk_size = 64
+    # Blocks holding fewer transactions than this in total
+    # are checked in-process, shipping them to the workers
+    # would cost more than checking them
+    min_parallel = 4096
+    # Validated block hashes remembered at most
+    cache_size = 1 << 16
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.pool = None
+        if self.workers > 1:
+            self.pool = multiprocessing.Pool(self.workers)
+        self.validated = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def is_validated(self, block_hash):
+        with self.cache_lock:
+            return block_hash in self.validated
+
+    def remember(self, blocks):
+        with self.cache_lock:
+            for blk in blocks:
+                self.validated[blk.hash] = None
+                self.validated.move_to_end(blk.hash)
+            while len(self.validated) > ChainValidator.cache_size:
+                self.validated.popitem(last=False)
+
+    def validate(self, blockchain, blocks, lock=None):
+        '''
+        Validate blocks in chain order against blockchain.
+        Returns (valid blocks, reason the next one is
+        invalid or None), the valid blocks being the blocks
+        blockchain did not know yet, up to the first
+        invalid one.
+        :param lock: held while blockchain is read, proofs
+            are checked without it
+        '''
+        with lock if lock is not None else contextlib.nullcontext():
+            linked, reason = self.check_links(blockchain, blocks)
+        proven, proof_reason = self.check_proofs(linked)
+        return proven, proof_reason or reason
+
+    def check_links(self, blockchain, blocks):
+        '''
+        Sequential stage: (new blocks that extend each
+        other and blockchain, reason of the first that
+        does not or None)
+        '''
+        # Only the suffix blockchain does not know is checked
+        start = 0
+        while start < len(blocks) and blockchain.has_block(blocks[start].hash):
+            start += 1
+        new = blocks[start:]
+        if not new:
+            return [], None
+        fork = blockchain.get_block(new[0].previous_hash)
+        if fork is None:
+            return [], "unknown_base"
+        first_depth = new[0].depth
+
+        def ancestor_at(depth):
+            if depth >= first_depth:
+                return new[depth - first_depth]
+            return blockchain.ancestor(fork, depth)
+
+        parent = fork
+        for idx, blk in enumerate(new):
+            if blk.previous_hash != parent.hash:
+                return new[:idx], "previous_hash"
+            if blk.depth != parent.depth + 1:
+                return new[:idx], "depth"
+            if blk.target != target_due(blk, parent, ancestor_at):
+                return new[:idx], "target"
+            if not timestamp_in_bounds(blk, parent, ancestor_at):
+                return new[:idx], "timestamp"
+            parent = blk
+        return new, None
+
+    def check_proofs(self, blocks):
+        '''
+        Parallel stage: (blocks up to the first invalid one,
+        reason it is invalid or None). Blocks already
+        validated only have their hash recomputed, see
+        check_proofs.[1]
+
+        [1]     The cache is keyed by the hash a block claims.
+                Another block claiming a cached hash, e.g.
+                the same header with other transactions, must
+                not pass for it, so the hash of a cached block
+                is still recomputed, a single header hash.
+        '''
+        capacity = Blockchain.block_capacity
+        todo = []
+        failure = None
+        for idx, blk in enumerate(blocks):
+            if not self.is_validated(blk.hash):
+                todo.append((idx, blk))
+            elif blk.compute_hash() != blk.hash:
+                # See check_proofs.[1]
+                failure = idx, "hash"
+                break
+        work = sum(len(blk.transactions) + 1 for _, blk in todo)
+        if self.pool is None or work < ChainValidator.min_parallel:
+            for idx, blk in todo:
+                reason = check_block(blk, capacity)
+                if reason is not None:
+                    failure = idx, reason
+                    break
+        else:
+            size = ChainValidator.chunk_size
+            chunks = [todo[pos:pos + size] for pos in range(0, len(todo), size)]
+            results = self.pool.imap(
+                _check_chunk,
+                [([blk for _, blk in chunk], capacity) for chunk in chunks]
+            )
+            # Results come in chunk order, stop at the first
+            # invalid block
+            for chunk, result in zip(chunks, results):
+                if result is not None:
+                    pos, reason = result
+                    failure = chunk[pos][0], reason
+                    break
+        if failure is None:
+            self.remember(blocks)
+            return blocks, None
+        valid = blocks[:failure[0]]
+        self.remember(valid)
+        return valid, failure[1]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_legacy_chain(blocks, validator=None):
+    '''
+    Validate a legacy chain and load it in a Blockchain
+    started from the legacy genesis block. Returns
+    (blockchain, reason the first invalid block is invalid
+    or None), blockchain holding the blocks before it.
+    :param blocks: Blocks or dicts as dumped by to_dict,
+        genesis first
+    :param validator: ChainValidator to use, a single
+        worker one by default
+    '''
+    blocks = [
+        blk if isinstance(blk, Block) else Block.from_dict(blk)
+        for blk in blocks
+    ]
+    blockchain = Blockchain(legacy=True)
+    if not blocks or blocks[0].hash != blockchain.last_block.hash:
+        return blockchain, "genesis"
+    if validator is None:
+        with ChainValidator() as own:
+            valid, reason = own.validate(blockchain, blocks)
+    else:
+        valid, reason = validator.validate(blockchain, blocks)
+    blockchain.adopt_chain(valid, validated=True)
+    if valid and blockchain.last_block.hash != valid[-1].hash:
+        # Refused by the ledger, see Blockchain.connect_block
+        reason = "connect"
+    return blockchain, reason
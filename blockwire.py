@@ -0,0 +1,749 @@
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+from queue import Queue
+
+# Own imports
+from blocklogic import (
+    Block, Blockchain, TxStatus, hash_from_hex, hash_size, hash_to_hex,
+    header_format
+)
+from blockgraph import (
+    FullNode, TipSummary, register_peer, reset_network, subscribe_tips
+)
+from blockmining import MiningEngine
+
+'''
+Wire protocol area
+
+Full nodes can run in processes of their own and talk to
+their peers over local sockets, either TCP or Unix. Every
+message is a frame
+
+    [payload length u32][message type u8][payload]
+
+and every payload is packed binary, but for the control
+messages of the cluster launcher, which are JSON. Blocks go
+as their binary header, nonce, hash and transactions, each
+transaction as length-prefixed compact JSON.
+
+Addresses are strings, "unix:/path/to/socket" or
+"tcp:host:port".
+'''
+
+frame_header = struct.Struct('<IB')
+# Largest payload accepted, guards against garbage lengths
+max_payload = 1 << 26
+
+# Message types
+msg_tip = 1         # depth, hash, work, sender address, one-way
+msg_get_tip = 2     # -> msg_tip
+msg_get_blocks = 3  # limit, locator -> msg_blocks
+msg_blocks = 4
+msg_txs = 5         # transactions -> msg_ack
+msg_ack = 6         # number of transactions accepted
+msg_get_txs = 7     # -> msg_txs, pending transactions
+msg_command = 8     # JSON control -> msg_reply
+msg_reply = 9
+
+# Depth, hash and big-endian 256-bit work of a tip
+tip_format = struct.Struct('<Q32s32s')
+count_format = struct.Struct('<I')
+# Nonce, hash and transaction count following the header
+block_tail = struct.Struct('<Q32sI')
+# Failures of a request: network errors and garbled replies
+request_errors = (OSError, struct.error, ValueError)
+
+def parse_address(address):
+    '''
+    (socket family, socket address) of an address string
+    '''
+    kind, _, rest = address.partition(':')
+    if kind == "unix":
+        return socket.AF_UNIX, rest
+    if kind == "tcp":
+        host, _, port = rest.rpartition(':')
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"Unknown address: {address}")
+
+'''
+Payload encoding
+'''
+
+def pack_txs(txs):
+    parts = [count_format.pack(len(txs))]
+    for tx in txs:
+        data = json.dumps(tx, separators=(',', ':')).encode()
+        parts.append(count_format.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def unpack_txs(payload, offset=0):
+    '''
+    (transactions, offset after them)
+    '''
+    (num,) = count_format.unpack_from(payload, offset)
+    offset += count_format.size
+    txs = []
+    for _ in range(num):
+        (size,) = count_format.unpack_from(payload, offset)
+        offset += count_format.size
+        txs.append(json.loads(payload[offset:offset + size]))
+        offset += size
+    return txs, offset
+
+def pack_blocks(blocks, max_size=None):
+    '''
+    Encode blocks, only the first ones fitting in max_size
+    bytes if given, at least one
+    '''
+    parts = []
+    size = count_format.size
+    for blk in blocks:
+        part = b''.join([
+            blk.header_prefix(),
+            block_tail.pack(blk.nonce, blk.hash, len(blk.transactions)),
+            # Same layout as pack_txs, count written apart
+            pack_txs(blk.transactions)[count_format.size:],
+        ])
+        size += len(part)
+        if max_size is not None and size > max_size and parts:
+            break
+        parts.append(part)
+    return count_format.pack(len(parts)) + b''.join(parts)
+
+def unpack_blocks(payload):
+    '''
+    Decode blocks, the Merkle root is recomputed from
+    the transactions so that is_valid_proof covers them
+    '''
+    (num,) = count_format.unpack_from(payload, 0)
+    offset = count_format.size
+    blocks = []
+    for _ in range(num):
+        version, depth, previous_hash, timestamp, _, target = (
+            header_format.unpack_from(payload, offset)
+        )
+        offset += header_format.size
+        nonce, block_hash, num_txs = block_tail.unpack_from(payload, offset)
+        # Rewind onto the transaction count for unpack_txs
+        offset += block_tail.size - count_format.size
+        txs, offset = unpack_txs(payload, offset)
+        if len(txs) != num_txs:
+            raise ConnectionError("malformed block payload")
+        blocks.append(Block(
+            depth, txs, timestamp, previous_hash, nonce, version,
+            block_hash, target=int.from_bytes(target, 'big')
+        ))
+    return blocks
+
+def pack_locator(locator):
+    return count_format.pack(len(locator)) + b''.join(locator)
+
+def unpack_locator(payload):
+    (num,) = count_format.unpack_from(payload, 0)
+    start = count_format.size
+    return [
+        payload[start + idx * hash_size:start + (idx + 1) * hash_size]
+        for idx in range(num)
+    ]
+
+def pack_tip(tip, address):
+    return tip_format.pack(
+        tip.depth, tip.hash, tip.work.to_bytes(hash_size, 'big')
+    ) + address.encode()
+
+def unpack_tip(payload):
+    '''
+    (tip, sender address)
+    '''
+    depth, tip_hash, work = tip_format.unpack_from(payload, 0)
+    return (
+        TipSummary(depth, tip_hash, int.from_bytes(work, 'big')),
+        payload[tip_format.size:].decode()
+    )
+
+'''
+Framing
+'''
+
+def recv_exact(sock, size):
+    '''
+    Read exactly size bytes, None on a clean end of stream
+    '''
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            if buf:
+                raise ConnectionError("connection closed mid-frame")
+            return None
+        buf += chunk
+    return bytes(buf)
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(frame_header.pack(len(payload), kind) + payload)
+
+def recv_frame(sock):
+    '''
+    (message type, payload), None on a clean end of stream
+    '''
+    header = recv_exact(sock, frame_header.size)
+    if header is None:
+        return None
+    size, kind = frame_header.unpack(header)
+    if size > max_payload:
+        raise ConnectionError(f"frame of {size} bytes refused")
+    payload = recv_exact(sock, size) if size else b''
+    if payload is None:
+        raise ConnectionError("connection closed mid-frame")
+    return kind, payload
+
+'''
+Remote side of a peer
+'''
+
+class RemotePeer:
+    '''
+    Full node in another process, as seen from ours. It
+    answers the calls blockgraph makes on its peers (tip,
+    send_blocks, send_transactions, inbox.offer, ...) over
+    a small pool of persistent connections.
+
+    [1]     Network failures and garbled replies are not
+            raised from these calls, see request_errors. A
+            peer that can't be reached looks like one with
+            nothing to offer: no blocks, no room for gossip.
+    '''
+
+    # Idle connections kept open at most
+    pool_size = 4
+    # Seconds before a request is given up on
+    timeout = 30.0
+
+    def __init__(self, address):
+        self.address = address
+        # Last tip announced by the peer, work -1 until
+        # we hear from it so that it is never synced from
+        self.tip = TipSummary(-1, None, -1)
+        self.idle = []
+        self.pool_lock = threading.Lock()
+        # Gossip relays call peer.inbox.offer
+        self.inbox = self
+
+    def _acquire(self):
+        with self.pool_lock:
+            if self.idle:
+                return self.idle.pop()
+        family, target = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(RemotePeer.timeout)
+        try:
+            sock.connect(target)
+        except OSError:
+            sock.close()
+            raise
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _release(self, sock):
+        with self.pool_lock:
+            if len(self.idle) < RemotePeer.pool_size:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    def request(self, kind, payload=b'', reply=True):
+        '''
+        Send one message, and wait for the reply frame
+        unless it is one-way. Raises OSError on failure.
+        '''
+        sock = self._acquire()
+        try:
+            send_frame(sock, kind, payload)
+            answer = recv_frame(sock) if reply else None
+            if reply and answer is None:
+                raise ConnectionError("peer closed the connection")
+        except BaseException:
+            sock.close()
+            raise
+        self._release(sock)
+        return answer
+
+    def refresh_tip(self):
+        '''
+        Ask for the current tip, see RemotePeer.[1]
+        '''
+        try:
+            _, payload = self.request(msg_get_tip)
+            self.tip, _ = unpack_tip(payload)
+        except request_errors:
+            pass
+        return self.tip
+
+    def announce(self, tip, address):
+        '''
+        Tell the peer about our new tip, one-way
+        '''
+        try:
+            self.request(msg_tip, pack_tip(tip, address), reply=False)
+        except OSError:
+            pass
+
+    def send_blocks(self, locator, limit=None):
+        '''
+        Same contract as FullNode.send_blocks, the node
+        sends fewer blocks if they don't fit in a frame
+        '''
+        # A limit of 0 is no limit
+        payload = count_format.pack(limit or 0) + pack_locator(locator)
+        try:
+            _, payload = self.request(msg_get_blocks, payload)
+            return unpack_blocks(payload)
+        except request_errors:
+            return []
+
+    def send_transactions(self):
+        try:
+            _, payload = self.request(msg_get_txs)
+            return unpack_txs(payload)[0]
+        except request_errors:
+            return []
+
+    def offer(self, txs):
+        '''
+        Same contract as blockgraph.Inbox.offer
+        '''
+        try:
+            _, payload = self.request(msg_txs, pack_txs(txs))
+            return count_format.unpack(payload)[0]
+        except request_errors:
+            return 0
+
+    def send_tx_statuses(self, tx_ids):
+        '''
+        Same contract as FullNode.send_tx_statuses, unknown
+        statuses if the node can't be reached
+        '''
+        tx_ids = list(tx_ids)
+        try:
+            reply = self.command("tx_statuses", tx_ids=tx_ids)
+        except request_errors:
+            reply = {}
+        statuses = {}
+        for tx_id in tx_ids:
+            state, block_hash, depth, confirmations = reply.get(
+                tx_id, ("unknown", None, None, 0)
+            )
+            if block_hash is not None:
+                block_hash = hash_from_hex(block_hash)
+            statuses[tx_id] = TxStatus(
+                state, block_hash, depth, confirmations
+            )
+        return statuses
+
+    def command(self, cmd, **kwargs):
+        '''
+        Control message to a node process, returns the
+        JSON reply. Failures are raised.
+        '''
+        kwargs["cmd"] = cmd
+        _, payload = self.request(msg_command, json.dumps(kwargs).encode())
+        return json.loads(payload)
+
+    def close(self):
+        with self.pool_lock:
+            idle, self.idle = self.idle, []
+        for sock in idle:
+            sock.close()
+
+'''
+Serving side
+'''
+
+class _Handler(socketserver.BaseRequestHandler):
+    '''
+    One persistent connection, requests are
+    answered in order until the peer hangs up
+    '''
+    def handle(self):
+        server = self.server.node_server
+        while True:
+            try:
+                frame = recv_frame(self.request)
+            except OSError:
+                return
+            if frame is None:
+                return
+            answer = server.dispatch(*frame)
+            if answer is not None:
+                send_frame(self.request, *answer)
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class NodeServer:
+    '''
+    Serves a FullNode to its peers at address, and pushes
+    the node's new tips to them
+    :param node: the FullNode of this process
+    :param address: address string to listen on
+    '''
+    def __init__(self, node, address):
+        self.node = node
+        self.address = address
+        family, target = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(target):
+                os.unlink(target)
+            self.server = _UnixServer(target, _Handler)
+        else:
+            self.server = _TCPServer(target, _Handler)
+        self.server.node_server = self
+        # Peers by address, to match tip announcements
+        self.peers = {}
+        self.mine_thread = None
+        self.mined = 0
+        # Tips are pushed from a thread of their own,
+        # the node announces them while holding its lock
+        self.announcements = Queue()
+        threading.Thread(target=self._push_tips, daemon=True).start()
+        subscribe_tips(self.on_tip)
+
+    def add_peer(self, address):
+        peer = RemotePeer(address)
+        self.peers[address] = peer
+        register_peer(peer)
+        return peer
+
+    def on_tip(self, node, tip):
+        if node is self.node:
+            self.announcements.put(tip)
+
+    def _push_tips(self):
+        while True:
+            tip = self.announcements.get()
+            # Only the latest of several queued tips matters
+            while not self.announcements.empty():
+                tip = self.announcements.get()
+            for peer in list(self.peers.values()):
+                peer.announce(tip, self.address)
+
+    def dispatch(self, kind, payload):
+        '''
+        (reply type, reply payload) of a request,
+        None for one-way messages
+        '''
+        node = self.node
+        if kind == msg_get_tip:
+            return msg_tip, pack_tip(node.tip, self.address)
+        if kind == msg_tip:
+            tip, sender = unpack_tip(payload)
+            peer = self.peers.get(sender)
+            if peer is not None:
+                peer.tip = tip
+                node.on_tip_announced(peer, tip)
+            return None
+        if kind == msg_get_blocks:
+            (limit,) = count_format.unpack_from(payload, 0)
+            blocks = node.send_blocks(
+                unpack_locator(payload[count_format.size:]), limit or None
+            )
+            return msg_blocks, pack_blocks(blocks, max_payload)
+        if kind == msg_get_txs:
+            return msg_txs, pack_txs(node.send_transactions())
+        if kind == msg_txs:
+            accepted = node.inbox.offer(unpack_txs(payload)[0])
+            return msg_ack, count_format.pack(accepted)
+        if kind == msg_command:
+            reply = self.command(**json.loads(payload))
+            return msg_reply, json.dumps(reply).encode()
+        raise ConnectionError(f"Unknown message type {kind}")
+
+    def command(self, cmd, **kwargs):
+        '''
+        Control messages of the cluster launcher
+        '''
+        if cmd == "mine":
+            if self.mining():
+                return dict(started=False)
+            for peer in self.peers.values():
+                peer.refresh_tip()
+            # Before the thread starts, a halt sent right
+            # after this command must not be lost
+            self.node.clear_stop()
+            # kwargs are those of FullNode.mine
+            self.mine_thread = threading.Thread(
+                target=self._mine, kwargs=kwargs
+            )
+            self.mine_thread.start()
+            return dict(started=True)
+        if cmd == "flush":
+            processed = 0
+            while True:
+                done = self.node.process_inbox()
+                if not done:
+                    return dict(processed=processed)
+                processed += done
+        if cmd == "sync":
+            return dict(changed=self.node.external_consensus())
+        if cmd == "status":
+            return self.status()
+        if cmd == "tx_statuses":
+            return {
+                tx_id: (
+                    status.state,
+                    None if status.block_hash is None
+                    else hash_to_hex(status.block_hash),
+                    status.depth, status.confirmations
+                )
+                for tx_id, status in
+                self.node.send_tx_statuses(kwargs["tx_ids"]).items()
+            }
+        if cmd == "halt":
+            self.node.stop()
+            return dict(halted=True)
+        if cmd == "pause":
+            self.node.pause()
+            return dict(paused=True)
+        if cmd == "resume":
+            self.node.resume()
+            return dict(paused=False)
+        if cmd == "stop":
+            self.node.stop()
+            # shutdown waits for serve_forever, which runs
+            # on another thread than this request
+            threading.Thread(target=self.server.shutdown).start()
+            return dict(stopped=True)
+        raise ValueError(f"Unknown command: {cmd}")
+
+    def _mine(self, **kwargs):
+        self.mined += self.node.mine(**kwargs)
+
+    def mining(self):
+        return self.mine_thread is not None and self.mine_thread.is_alive()
+
+    def status(self):
+        '''
+        JSON-able summary of the node, enough for
+        blockbench to measure a cluster run
+        '''
+        node = self.node
+        with node.lock:
+            blockchain = node.blockchain
+            chain = blockchain.chain
+            return dict(
+                address=self.address,
+                mining=self.mining(),
+                mined=self.mined,
+                depth=node.tip.depth,
+                hash=node.tip.hash.hex(),
+                genesis=chain[0].hash.hex(),
+                confirmed_txs=sum(len(blk.transactions) for blk in chain),
+                mempool=len(blockchain.mempool),
+                blocks=[block_hash.hex() for block_hash in blockchain.blocks],
+                reorg_depths=list(blockchain.reorg_depths),
+                hashes=node.miner.hashes,
+                wasted_time=node.wasted_time,
+                tip_changed_at=node.tip_changed_at,
+            )
+
+    def serve_forever(self):
+        self.server.serve_forever()
+        self.server.server_close()
+        family, target = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(target):
+            os.unlink(target)
+
+def serve_node(address, peer_addresses, workers=1, chain_config=None,
+               ready=None):
+    '''
+    Entry point of a node process: run a FullNode served
+    at address, with peers at peer_addresses, until it is
+    told to stop
+    :param chain_config: Blockchain class attributes to set
+        first, e.g. {"difficulty": 4}
+    :param ready: event set once the node is listening
+    '''
+    for name, value in (chain_config or {}).items():
+        setattr(Blockchain, name, value)
+    reset_network()
+    node = FullNode(miner=MiningEngine(workers))
+    server = NodeServer(node, address)
+    for peer_address in peer_addresses:
+        server.add_peer(peer_address)
+    if ready is not None:
+        ready.set()
+    try:
+        server.serve_forever()
+    finally:
+        node.miner.close()
+
+class LocalCluster:
+    '''
+    Full nodes in processes of their own on this machine,
+    driven over the wire protocol
+
+        with LocalCluster(16) as cluster:
+            cluster.send_transactions(txs)
+            cluster.flush_gossip()
+            cluster.mine(5, 5)
+            statuses = cluster.wait()
+
+    :param family: "unix" or "tcp" sockets
+    :param base_port: port of the first node with "tcp",
+        the others follow
+    :param workers: mining processes of every node
+    :param num_peers: random peers every node picks, it also
+        talks to the ones picking it, all the other nodes
+        by default
+    :param chain_config: Blockchain class attributes of
+        the nodes, see serve_node
+    '''
+
+    # Seconds to wait for a node process to listen
+    start_timeout = 60.0
+
+    def __init__(self, num_nodes, family="unix", base_port=18400,
+                 workers=1, num_peers=None, chain_config=None, seed=0):
+        self.num_nodes = num_nodes
+        self.workers = workers
+        self.chain_config = chain_config
+        self.rng = random.Random(seed)
+        self.socket_dir = None
+        if family == "unix":
+            self.socket_dir = tempfile.mkdtemp(prefix="blockwire-")
+            self.addresses = [
+                "unix:" + os.path.join(self.socket_dir, f"node{idx}.sock")
+                for idx in range(num_nodes)
+            ]
+        elif family == "tcp":
+            self.addresses = [
+                f"tcp:127.0.0.1:{base_port + idx}" for idx in range(num_nodes)
+            ]
+        else:
+            raise ValueError(f"Unknown socket family: {family}")
+        if num_peers is None or num_peers >= num_nodes - 1:
+            self.peer_lists = [
+                [addr for addr in self.addresses if addr != address]
+                for address in self.addresses
+            ]
+        else:
+            # Links go both ways, tips are only taken from
+            # known peers
+            links = [set() for _ in self.addresses]
+            for idx in range(num_nodes):
+                others = [other for other in range(num_nodes) if other != idx]
+                for other in self.rng.sample(others, num_peers):
+                    links[idx].add(other)
+                    links[other].add(idx)
+            self.peer_lists = [
+                [self.addresses[other] for other in sorted(peers)]
+                for peers in links
+            ]
+        self.processes = []
+        self.nodes = [RemotePeer(address) for address in self.addresses]
+
+    def start(self):
+        '''
+        Start the node processes, one after the other
+        so that later ones can sync from earlier ones
+        '''
+        ctx = multiprocessing.get_context("spawn")
+        for address, peers in zip(self.addresses, self.peer_lists):
+            ready = ctx.Event()
+            proc = ctx.Process(
+                target=serve_node,
+                args=(address, peers, self.workers, self.chain_config, ready)
+            )
+            proc.start()
+            self.processes.append(proc)
+            if not ready.wait(LocalCluster.start_timeout):
+                raise RuntimeError(f"Node at {address} did not start")
+        return self
+
+    def send_transactions(self, txs):
+        '''
+        Hand a batch to random nodes until one has room,
+        see blockgraph.register_transactions
+        '''
+        txs = list(txs)
+        accepted = 0
+        for node in self.rng.sample(self.nodes, len(self.nodes)):
+            if accepted == len(txs):
+                break
+            accepted += node.offer(txs[accepted:])
+        return accepted
+
+    def command_all(self, cmd, **kwargs):
+        return [node.command(cmd, **kwargs) for node in self.nodes]
+
+    def flush_gossip(self):
+        '''
+        Same as blockgraph.flush_gossip, across processes
+        '''
+        processed = 0
+        while True:
+            done = sum(
+                reply["processed"] for reply in self.command_all("flush")
+            )
+            if not done:
+                return processed
+            processed += done
+
+    def mine(self, sprints=5, sprint_time=5):
+        '''
+        Start longest_mine on every node, returns at once
+        '''
+        return self.command_all(
+            "mine", max_sprints=sprints, sprint_time=sprint_time,
+            stop_when_idle=True
+        )
+
+    def statuses(self):
+        return self.command_all("status")
+
+    def wait(self, poll=0.2):
+        '''
+        Wait for every node to be done mining,
+        returns their statuses
+        '''
+        while True:
+            statuses = self.statuses()
+            if not any(status["mining"] for status in statuses):
+                return statuses
+            time.sleep(poll)
+
+    def stop(self):
+        for node in self.nodes:
+            try:
+                node.command("stop")
+            except OSError:
+                pass
+            node.close()
+        for proc in self.processes:
+            proc.join(LocalCluster.start_timeout)
+            if proc.is_alive():
+                proc.terminate()
+        self.processes = []
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
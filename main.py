@@ -4,54 +4,35 @@ import multiprocessing
 from multiprocessing.pool import ThreadPool
 import threading
 import time
-import json
-import re
-from copy import deepcopy
 
 # Own imports
-from blocklogic import Block, Blockchain
-from blockgraph import FullNode, Client, full_nodes, clients
-
-def format_block_output(blk, max_line=35):
-    '''
-    Truncate the hashes a bit and 
-    append spaces to allow tabulation
-    for column-like display
-    '''
-    # Return empty block json if None
-    if not blk:
-        tx_lim = Blockchain.block_capacity
-        return(["".ljust(max_line) for _ in range(9 + tx_lim)])
-    # Do the formatting work
-    blk_dict = deepcopy(blk.__dict__)
-    hash_lim = Blockchain.difficulty + 10
-    blk_dict["hash"] = str(blk_dict["hash"])[:hash_lim]
-    blk_dict["previous_hash"] = str(blk_dict["previous_hash"])[:hash_lim]
-    blk_json = json.dumps(
-        blk_dict,
-        sort_keys=True,
-        indent=2
-    )
-    blk_json = re.split("\n", blk_json)
-    for idx in range(len(blk_json)):
-        blk_json[idx] = blk_json[idx].ljust(max_line)
-    return blk_json
+from blocklogic import Block
+from blockgraph import FullNode, Client, full_nodes, clients, flush_gossip
+from blockmining import MiningEngine
+from blockexport import export_blocks, save_blocks
+from blockreport import write_report
+from blockvalidation import ChainValidator
 
 if __name__=='__main__':
 
-    # Creating full nodes
-    n1 = FullNode()
-    n2 = FullNode()
-    n3 = FullNode()
-    n4 = FullNode()
+    # Creating full nodes, sharing the cores between
+    # their mining engines, and one validator so that
+    # blocks are validated once for all of them
+    workers = max(1, multiprocessing.cpu_count() // 4)
+    validator = ChainValidator()
+    n1 = FullNode(miner=MiningEngine(workers), validator=validator)
+    n2 = FullNode(miner=MiningEngine(workers), validator=validator)
+    n3 = FullNode(miner=MiningEngine(workers), validator=validator)
+    n4 = FullNode(miner=MiningEngine(workers), validator=validator)
 
     # Creating one client, e.g. wallet provider
     c1 = Client()
 
-    # Request some transactions to be made by client
-    tx_ids = np.random.choice(1000, 100)
-    for tx_id in tx_ids:
-        c1.send_transaction(f"Tx #{tx_id:04}")
+    # Request some transactions to be made by client,
+    # in one batch, and let them spread over the network
+    tx_ids = np.random.choice(1000, 100, replace=False)
+    c1.send_transactions(f"Tx #{tx_id:04}" for tx_id in tx_ids)
+    flush_gossip()
 
     # Full nodes get to work
     args = (5,5) # (sprints, seconds)
@@ -77,6 +58,12 @@ if __name__=='__main__':
     print("N2 chain length:\t" + str(len(n2.blockchain.chain)))
     print("N2 chain length:\t" + str(len(n3.blockchain.chain)))
     print("N2 chain length:\t" + str(len(n4.blockchain.chain)))
+
+    # Console log the hash rates and stop the engines
+    for idx, node in enumerate([n1, n2, n3, n4]):
+        print(f"N{idx+1} hash rate:\t{node.miner.hash_rate:.0f} H/s")
+        print(f"N{idx+1} wasted work:\t{node.wasted_time:.3f} s")
+        node.miner.close()
     
     nodes = []
     nodes.append(n1)
@@ -85,69 +72,6 @@ if __name__=='__main__':
     nodes.append(n4)
 
     # Format output nicely in .txt file
-    with open("blocks_result.txt", 'w') as f:
-
-        for n in range(len(nodes)):
-            print(f"Node {n}".ljust(35), end="\t|\t", file=f)
-        print("\n", end="", file=f)
-
-        max_length = len(nodes[0].blockchain.chain)
-        for node in nodes[1:]:
-            max_length = max(max_length, len(node.blockchain.chain))
-
-        # Print columns of blocks
-        for row in range(max_length):
-            # List of lines for all blocks on the same row/depth
-            blk_lists = []
-            for node in nodes:
-                if len(node.blockchain.chain) <= row:
-                    blk_lists.append(
-                        format_block_output(blk=None)
-                    )
-                else:
-                    blk_lists.append(
-                        format_block_output(node.blockchain.chain[row])
-                    )
-            # Print each line by going through all nodes each time
-            blk_num_lines = 9 + Blockchain.block_capacity
-            for line_num in range(blk_num_lines):
-                for node_idx in range(len(nodes)):
-                    try:
-                        print(blk_lists[node_idx][line_num].ljust(35), end="\t|\t", file=f)
-                    except:
-                        print("".ljust(35), end="\t|\t", file=f)
-                print("\n", end="", file=f)
-            # Append horizontal space
-            print("\n", end="", file=f)
-
-        # Horizontal space and _ separator line
-        print("".join(["_" for _ in range(43 * len(nodes))]), file=f)
-        
-        # Print transaction leftovers
-        txss = [deepcopy(node.blockchain.outstanding_transactions) for node in nodes]
-        for txs in txss:
-            print(
-                str(len(txs)).ljust(35),
-                end="\t|\t",
-                file=f
-            )
-        print("\n", end="", file=f)
-        
-        max_txs = len(txss[0])
-        for txs in txss[1:]:
-            max_txs = max(max_txs, len(txs))
-        for row in range(max_txs):
-            for txs in txss:
-                if len(txs) <= row:
-                    print(
-                        "".ljust(35),
-                        end="\t|\t",
-                        file=f
-                    )
-                else:
-                    print(
-                        txs[row].ljust(35),
-                        end="\t|\t",
-                        file=f
-                    )
-            print("\n", end="", file=f)
\ No newline at end of file
+    write_report(nodes, "blocks_result.txt")
+    # Columnar copy for analysis, see blockexport
+    save_blocks(export_blocks(nodes), "blocks_result.npy")
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blocklogic import Block, Blockchain
+
+@pytest.fixture(autouse=True)
+def easy_chain(monkeypatch):
+    '''
+    Difficulty low enough to mine blocks in the tests
+    '''
+    monkeypatch.setattr(Blockchain, "difficulty", 1)
+
+@pytest.fixture
+def extend():
+    '''
+    extend(blockchain, parent, num_blocks, tag) mines
+    num_blocks blocks on parent, one transaction each named
+    after tag, adds them and runs internal_consensus.
+    Returns them in chain order.
+    '''
+    def extend_chain(blockchain, parent, num_blocks, tag):
+        blocks = []
+        for idx in range(num_blocks):
+            block = Block(
+                parent.depth + 1, [f"{tag}{idx}"],
+                parent.timestamp + 10.0, parent.hash,
+                target=blockchain.next_target(parent)
+            )
+            block = Blockchain.proof_of_work(block)
+            assert blockchain.add_block(block, block.hash, parent)
+            blockchain.internal_consensus()
+            blocks.append(block)
+            parent = block
+        return blocks
+    return extend_chain
+
+@pytest.fixture
+def mine():
+    '''
+    mine(blockchain, parent, transactions) -> block on parent
+    with the target due there, a block interval after it
+    '''
+    def mine_block(blockchain, parent, transactions):
+        block = Block(
+            parent.depth + 1, transactions,
+            parent.timestamp + Blockchain.block_interval, parent.hash,
+            target=blockchain.next_target(parent)
+        )
+        return Blockchain.proof_of_work(block)
+    return mine_block
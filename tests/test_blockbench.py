@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from blockbench import compare, main, parse_args, run_benchmark
+from blocklogic import Blockchain
+
+def result(**metrics):
+    base = dict(
+        confirmed_tx_per_sec=10.0, blocks_per_sec=1.0, hash_rate=100.0,
+        stale_rate=0.1, mean_reorg_depth=1.0, time_to_consensus=2.0,
+        wasted_time=0.5,
+    )
+    base.update(metrics)
+    return dict(metrics=base)
+
+def test_compare_flags_only_changes_past_the_tolerance():
+    report = compare(
+        result(), result(hash_rate=96.0, stale_rate=0.2), tolerance=0.05
+    )
+    assert not report["hash_rate"]["regression"]
+    assert report["stale_rate"]["regression"]
+    assert report["hash_rate"]["change"] == -0.04
+
+def test_compare_from_zero_uses_the_direction():
+    report = compare(result(wasted_time=0.0), result(wasted_time=0.1))
+    assert report["wasted_time"]["change"] is None
+    assert report["wasted_time"]["regression"]
+
+def test_run_benchmark_mines_every_transaction(monkeypatch):
+    monkeypatch.setattr(Blockchain, "block_capacity", 3)
+    res = run_benchmark(
+        nodes=2, txs_per_client=4, difficulty=1,
+        sprints=3, sprint_time=5, seed=1
+    )
+    assert res["config"]["seed"] == 1
+    metrics = res["metrics"]
+    assert metrics["confirmed_txs"] == 4
+    assert metrics["blocks"] >= 2
+    assert metrics["converged"]
+
+def test_compare_exit_status(tmp_path):
+    base = tmp_path / "a.json"
+    new = tmp_path / "b.json"
+    base.write_text(json.dumps(result()))
+    new.write_text(json.dumps(result(hash_rate=50.0)))
+    assert main(["compare", str(base), str(base)]) == 0
+    assert main(["compare", str(base), str(new)]) == 1
+
+def test_processes_refuse_in_process_options(capsys):
+    assert parse_args(["run", "--processes"]).processes
+    for option in (
+        ["--export", "run.npy"], ["--metrics", "m.json"],
+        ["--validation-workers", "2"],
+    ):
+        with pytest.raises(SystemExit):
+            parse_args(["run", "--processes"] + option)
+        assert option[0] in capsys.readouterr().err
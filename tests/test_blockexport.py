@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from blockexport import (
+    block_intervals, export_blocks, fork_rates, load_blocks, main_chain,
+    save_blocks, stale_hashes, summary
+)
+from blocklogic import Blockchain
+
+def two_nodes(extend):
+    first = Blockchain()
+    genesis = first.last_block
+    main = extend(first, genesis, 3, "a")
+    fork = extend(first, genesis, 1, "b")
+    second = Blockchain()
+    assert second.adopt_chain(first.chain)
+    nodes = [
+        SimpleNamespace(blockchain=first), SimpleNamespace(blockchain=second)
+    ]
+    return nodes, main, fork
+
+def test_export_has_a_row_per_node_and_block(extend):
+    nodes, main, fork = two_nodes(extend)
+    blocks = export_blocks(nodes)
+    assert len(blocks) == 5 + 4
+    first = blocks[blocks['node'] == 0]
+    assert first['depth'].tolist() == [0, 1, 2, 3, 1]
+    assert first['main'].tolist() == [True] * 4 + [False]
+    assert bytes(first['hash'][3]) == main[-1].hash
+    assert bytes(first['previous_hash'][4]) == fork[0].previous_hash
+    assert first['tx_count'].tolist() == [0, 1, 1, 1, 1]
+
+def test_summaries(extend):
+    nodes, main, fork = two_nodes(extend)
+    blocks = export_blocks(nodes)
+    assert [bytes(h) for h in stale_hashes(blocks)] == [fork[0].hash]
+    assert main_chain(blocks, node=1)['depth'].tolist() == [0, 1, 2, 3]
+    assert block_intervals(blocks).tolist() == [10.0, 10.0]
+    assert fork_rates(blocks).tolist() == [0.25, 0.0]
+    overview = summary(blocks)
+    assert overview["nodes"] == 2
+    assert overview["depth"] == 3
+    assert overview["blocks"] == 4
+    assert overview["stale_blocks"] == 1
+    assert overview["mean_interval"] == 10.0
+    assert overview["mean_tx_count"] == 1.0
+
+def test_save_and_load(extend, tmp_path):
+    nodes, _, _ = two_nodes(extend)
+    blocks = export_blocks(nodes)
+    for name in ("run.npy", "run.npz"):
+        save_blocks(blocks, tmp_path / name)
+        loaded = load_blocks(tmp_path / name)
+        assert np.array_equal(loaded, blocks)
+    assert isinstance(load_blocks(tmp_path / "run.npy"), np.memmap)
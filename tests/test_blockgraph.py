@@ -0,0 +1,217 @@
+import threading
+import time
+
+import pytest
+
+import blockgraph
+from blockgraph import (
+    Client, FullNode, Inbox, TipSummary, flush_gossip, reset_network
+)
+from blockledger import Ledger
+from blocklogic import Block, Blockchain, CancelToken, transaction_id
+
+@pytest.fixture(autouse=True)
+def network():
+    '''
+    Every test starts from an empty network
+    '''
+    reset_network()
+    yield
+    reset_network()
+
+def test_new_node_downloads_the_chain():
+    first = FullNode()
+    Client().send_transaction("a")
+    assert first.longest_mine(num_sprints=1, sprint_time=5) == 1
+    second = FullNode()
+    assert second.blockchain.chain == first.blockchain.chain
+    assert second.tip == first.tip
+    assert second.tip.depth == 1
+
+def test_external_consensus_takes_the_deepest_tip():
+    miner = FullNode()
+    follower = FullNode()
+    Client().send_transaction("a")
+    assert miner.longest_mine(num_sprints=1, sprint_time=5) == 1
+    assert follower.external_consensus()
+    assert follower.tip == miner.tip
+    # The mined transaction left the follower's mempool
+    assert not follower.blockchain.mempool
+    assert not follower.external_consensus()
+
+def test_nodes_mine_concurrently():
+    nodes = [FullNode() for _ in range(3)]
+    client = Client()
+    for idx in range(12):
+        client.send_transaction(f"tx{idx}")
+    threads = [
+        threading.Thread(target=node.longest_mine, args=(4, 1))
+        for node in nodes
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for node in nodes:
+        node.external_consensus()
+    assert len({node.tip.depth for node in nodes}) == 1
+    assert nodes[0].tip.depth >= 1
+
+def test_sync_goes_page_by_page(extend, monkeypatch):
+    monkeypatch.setattr(FullNode, "sync_batch", 2)
+    follower = FullNode()
+    genesis = follower.blockchain.last_block
+    extend(follower.blockchain, genesis, 3, "b")
+    follower.publish_tip()
+    source = FullNode()
+    extend(source.blockchain, genesis, 7, "a")
+    source.publish_tip()
+    requests = []
+    send_blocks = source.send_blocks
+    def counted(locator, limit=None):
+        requests.append(limit)
+        return send_blocks(locator, limit)
+    monkeypatch.setattr(source, "send_blocks", counted)
+    # The first page has less work than our own branch,
+    # the next ones go on from it anyway
+    assert follower.external_consensus()
+    assert follower.blockchain.chain == source.blockchain.chain
+    assert requests == [2, 2, 2, 2]
+    assert FullNode().blockchain.chain == source.blockchain.chain
+
+def test_tip_announcements_reach_subscribers():
+    seen = []
+    blockgraph.subscribe_tips(lambda node, tip: seen.append((node, tip)))
+    miner = FullNode()
+    Client().send_transaction("a")
+    assert miner.longest_mine(num_sprints=1, sprint_time=5) == 1
+    assert seen[-1] == (miner, miner.tip)
+    assert miner.tip.depth == 1
+
+def test_tip_with_as_much_work_cancels_mining():
+    miner = FullNode()
+    other = FullNode()
+    token = CancelToken()
+    miner.mining_token = token
+    miner.mining_work = 30
+    miner.on_tip_announced(other, TipSummary(5, "x", 29))
+    assert not token.is_set()
+    miner.on_tip_announced(miner, TipSummary(3, "x", 30))
+    assert not token.is_set()
+    miner.on_tip_announced(other, TipSummary(2, "x", 30))
+    assert token.is_set()
+
+def test_client_verifies_mined_transactions():
+    miner = FullNode()
+    client = Client()
+    client.send_transaction("a")
+    assert client.verify_transaction("a") == 0
+    assert miner.longest_mine(num_sprints=1, sprint_time=5) == 1
+    assert client.verify_transaction("a") == 1
+    assert client.headers.last_header.hash == miner.tip.hash
+    assert client.verify_transaction("b") == 0
+
+def test_inbox_refuses_offers_past_its_capacity():
+    inbox = Inbox(3)
+    assert inbox.offer(["a", "b"]) == 2
+    assert inbox.offer(["c", "d"]) == 1
+    assert inbox.drain(2) == ["a", "b"]
+    assert inbox.offer(["d", "e", "f"]) == 2
+    assert inbox.drain(10) == ["c", "d", "e"]
+
+def test_full_inboxes_push_back(monkeypatch):
+    monkeypatch.setattr(FullNode, "inbox_capacity", 2)
+    FullNode()
+    FullNode()
+    assert Client().send_transactions(["a", "b", "c", "d", "e"]) == 4
+
+def test_gossip_reaches_every_node_once():
+    nodes = [FullNode() for _ in range(FullNode.gossip_fanout + 1)]
+    client = Client()
+    assert client.send_transactions(["a", "b"]) == 2
+    assert client.send_transactions(["a"]) == 1
+    assert flush_gossip() > 0
+    for node in nodes:
+        assert list(node.blockchain.mempool) == ["a", "b"]
+        assert len(node.inbox) == 0
+    assert flush_gossip() == 0
+
+def test_client_transfers_only_funded_amounts(monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    miner = FullNode()
+    client = Client()
+    assert client.balance("alice") == 10
+    assert not client.transfer("alice", "bob", 11)
+    assert client.transfer("alice", "bob", 4)
+    assert miner.longest_mine(num_sprints=1, sprint_time=5) == 1
+    assert client.balance("alice") == 6
+    assert client.balance("bob") == 4
+
+def test_mine_until_a_number_of_blocks():
+    miner = FullNode()
+    Client().send_transactions([f"tx{idx}" for idx in range(12)])
+    assert miner.mine(until_blocks=2, sprint_time=5) == 2
+    assert miner.tip.depth == 2
+    assert miner.mine(until_txs=1, sprint_time=5) == 1
+    assert miner.mine(max_sprints=0) == 0
+
+def wait_for_sprint(miner):
+    while miner.mining_token is None:
+        time.sleep(0.01)
+
+def test_pause_resume_and_stop(monkeypatch):
+    # Blocks that take far longer than the test to find
+    monkeypatch.setattr(Blockchain, "difficulty", 32)
+    miner = FullNode()
+    Client().send_transaction("a")
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(miner.mine(sprint_time=0.2))
+    )
+    thread.start()
+    wait_for_sprint(miner)
+    miner.pause()
+    time.sleep(0.3)
+    assert miner.mining_token is None
+    assert thread.is_alive()
+    miner.resume()
+    wait_for_sprint(miner)
+    miner.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert result == [0]
+    assert miner.wasted_time == 0.0
+
+def test_sprint_length_follows_the_hash_rate(monkeypatch):
+    miner = FullNode()
+    monkeypatch.setattr(type(miner.miner), "hash_rate", 1e6)
+    monkeypatch.setattr(Blockchain, "block_capacity", 2)
+    # 2 ** 20 hashes expected per block, about a second
+    full = Block(1, ["a", "b"], 1.0, bytes(32), target=2 ** 236 - 1)
+    half = Block(1, ["a"], 1.0, bytes(32), target=2 ** 236 - 1)
+    assert miner.sprint_length(full) == pytest.approx(0.5 * 2 ** 20 / 1e6)
+    assert miner.sprint_length(half) == FullNode.min_sprint_time
+    hard = Block(1, ["a", "b"], 1.0, bytes(32), target=2 ** 200)
+    assert miner.sprint_length(hard) == FullNode.max_sprint_time
+
+def test_client_asks_for_transaction_statuses(monkeypatch):
+    monkeypatch.setattr(Blockchain, "block_capacity", 1)
+    miner = FullNode()
+    client = Client()
+    client.send_transactions(["a", "b"])
+    assert miner.mine(until_txs=1, sprint_time=5) == 1
+    mined = miner.blockchain.last_block.transactions[0]
+    waiting = ({"a", "b"} - {mined}).pop()
+    assert client.confirmations(transaction_id(mined)) == 1
+    status = client.transaction_status(transaction_id(waiting))
+    assert status.state == "pending"
+    reset_network()
+    assert client.transaction_status(transaction_id(mined)).state == "unknown"
+
+def test_stop_before_mining_holds_until_cleared():
+    miner = FullNode()
+    Client().send_transaction("a")
+    miner.stop()
+    assert miner.mine(until_blocks=1, sprint_time=5) == 0
+    miner.clear_stop()
+    assert miner.mine(until_blocks=1, sprint_time=5) == 1
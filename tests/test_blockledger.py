@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+from blockledger import Ledger, transfer_error
+
+def transfer(sender, recipient, amount, nonce=0):
+    return {"from": sender, "to": recipient, "amount": amount, "nonce": nonce}
+
+def block(name, *txs):
+    return SimpleNamespace(hash=name, transactions=txs)
+
+def test_malformed_transfers():
+    assert transfer_error("plain") is None
+    assert transfer_error(transfer("a", "b", 1)) is None
+    assert transfer_error(transfer("a", 2, 1)) == "account"
+    assert transfer_error(transfer("a", "b", 0)) == "amount"
+    assert transfer_error(transfer("a", "b", 1.5)) == "amount"
+    assert transfer_error(transfer("a", "b", True)) == "amount"
+
+def test_connect_and_disconnect(monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    ledger = Ledger()
+    first = block("1", transfer("alice", "bob", 4), "plain")
+    second = block("2", transfer("bob", "carol", 3))
+    assert ledger.connect(first)
+    assert ledger.connect(second)
+    assert ledger.balances == {"alice": 6, "bob": 1, "carol": 3}
+    ledger.disconnect(second)
+    assert ledger.balances == {"alice": 6, "bob": 4}
+    ledger.disconnect(first)
+    assert ledger.balances == {"alice": 10}
+    assert ledger.undo == {}
+
+def test_overdrawing_block_changes_nothing(monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    ledger = Ledger()
+    bad = block(
+        "1", transfer("alice", "bob", 6), transfer("alice", "bob", 6, 1)
+    )
+    assert not ledger.connect(bad)
+    assert ledger.balances == {"alice": 10}
+    assert "1" not in ledger.undo
+
+def test_payable_spends_together(monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    ledger = Ledger()
+    txs = [
+        transfer("alice", "bob", 6), transfer("alice", "bob", 6, 1),
+        transfer("bob", "carol", 5), "plain", transfer("x", 1, 1)
+    ]
+    assert ledger.payable(txs, 10) == [txs[0], txs[2], txs[3]]
+    assert ledger.payable(txs, 1) == [txs[0]]
+    assert ledger.can_pay(txs[0])
+    assert not ledger.can_pay(transfer("bob", "alice", 1))
@@ -0,0 +1,412 @@
+import copy
+import pickle
+import time
+from collections import namedtuple
+from hashlib import sha256
+
+import pytest
+
+from blockledger import Ledger
+
+from blocklogic import (
+    Block, Blockchain, HeaderChain, Mempool, block_work, compute_merkle_root,
+    expected_target, merkle_proof, nonce_format, null_hash, retarget,
+    transaction_digest, transaction_id, verify_merkle_proof
+)
+
+def test_header_hash_goes_through_the_midstate():
+    block = Block(1, ["a", "b"], 1.5, "0", nonce=7)
+    midstate = block.midstate()
+    midstate.update(nonce_format.pack(7))
+    assert block.compute_hash() == midstate.digest()
+    assert block.compute_hash() == sha256(
+        block.header_prefix() + nonce_format.pack(7)
+    ).digest()
+
+def test_header_hash_covers_the_transactions():
+    block = Block(1, ["a", "b"], 1.5, "0")
+    other = Block(1, ["a", "c"], 1.5, "0")
+    assert block.compute_hash() != other.compute_hash()
+
+def test_legacy_hash_matches_old_chains():
+    # Genesis of the chains in blocks_result.txt
+    genesis = Block(0, [], 0, "0", version=Block.legacy_version)
+    assert genesis.hash.hex().startswith("36dd245bb41008")
+
+def test_blocks_are_immutable():
+    block = Block(1, ["a"], 1.5, null_hash)
+    with pytest.raises(AttributeError):
+        block.nonce = 3
+    with pytest.raises(AttributeError):
+        del block.hash
+    assert block.transactions == ("a",)
+    assert copy.deepcopy(block) is block
+
+def test_with_nonce_rehashes():
+    block = Block(1, ["a"], 1.5, null_hash)
+    other = block.with_nonce(5)
+    assert other.nonce == 5 and block.nonce == 0
+    assert other.hash == other.compute_hash() != block.hash
+    assert other != block
+
+def test_dict_and_pickle_round_trip():
+    block = Block(1, ["a", "b"], 1.5, null_hash, nonce=9)
+    blk_dict = block.to_dict()
+    assert blk_dict["previous_hash"] == "0"
+    assert blk_dict["hash"] == block.hash.hex()
+    restored = Block.from_dict(blk_dict)
+    assert restored == block
+    assert restored.previous_hash == null_hash
+    assert pickle.loads(pickle.dumps(block)) == block
+    assert len({block, restored}) == 1
+
+def test_fork_is_kept_off_the_chain(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 3, "a")
+    fork = extend(blockchain, genesis, 2, "b")
+    assert blockchain.chain == [genesis] + main
+    assert blockchain.extensions == [[genesis] + fork]
+    assert blockchain.blocks[fork[-1].hash] is fork[-1]
+
+def test_deeper_fork_reorganizes(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 2, "a")
+    fork = extend(blockchain, genesis, 3, "b")
+    assert blockchain.chain == [genesis] + fork
+    assert blockchain.extensions == [[genesis] + main]
+    assert not blockchain.on_main_chain(main[0])
+
+def test_equal_depth_keeps_first_seen(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 2, "a")
+    extend(blockchain, genesis, 2, "b")
+    assert blockchain.last_block == main[-1]
+
+def test_adopt_longer_chain(extend):
+    source = Blockchain()
+    genesis = source.last_block
+    extend(source, genesis, 3, "a")
+    blockchain = Blockchain()
+    extend(blockchain, blockchain.last_block, 1, "b")
+    assert blockchain.adopt_chain(source.chain)
+    assert blockchain.chain == source.chain
+
+def test_mempool_keeps_order_and_drops_duplicates():
+    mempool = Mempool(["a", "b"])
+    assert not mempool.add("a")
+    assert mempool.add({"x": 1})
+    assert mempool.peek(2) == ["a", "b"]
+    assert "b" in mempool
+    assert mempool.discard("b")
+    assert not mempool.discard("b")
+    mempool.remove_many(["a", "missing"])
+    assert list(mempool) == [{"x": 1}]
+
+def test_mempool_readds_at_the_front():
+    mempool = Mempool(["c"])
+    mempool.readd_many(["a", "b"])
+    assert list(mempool) == ["a", "b", "c"]
+
+def test_mined_transactions_leave_the_mempool(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    blockchain.add_new_transaction("a0")
+    blockchain.add_new_transaction("b0")
+    blockchain.add_new_transaction("c")
+    extend(blockchain, genesis, 1, "a")
+    assert blockchain.outstanding_transactions == ["b0", "c"]
+    # The reorganization mines b0 and puts a0 back in front
+    extend(blockchain, genesis, 2, "b")
+    assert blockchain.outstanding_transactions == ["a0", "c"]
+
+def test_locator_steps_back_to_genesis(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    blocks = [genesis] + extend(blockchain, genesis, 40, "a")
+    locator = blockchain.locator()
+    # Ten consecutive hashes, then doubling steps
+    assert locator[:10] == [blk.hash for blk in blocks[40:30:-1]]
+    assert locator[10:12] == [blocks[29].hash, blocks[25].hash]
+    assert locator[-1] == genesis.hash
+    assert len(locator) < 20
+
+def test_blocks_after_the_common_ancestor(extend):
+    source = Blockchain()
+    genesis = source.last_block
+    shared = extend(source, genesis, 5, "a")
+    ahead = extend(source, shared[-1], 4, "b")
+    follower = Blockchain()
+    follower.adopt_chain(source.chain[:6])
+    stale = extend(follower, shared[-1], 1, "c")
+    locator = follower.locator()
+    assert source.blocks_after(locator) == ahead
+    assert source.blocks_after(locator, limit=2) == ahead[:2]
+    assert follower.adopt_chain(source.blocks_after(locator))
+    assert follower.chain == source.chain
+    assert not follower.on_main_chain(stale[0])
+
+@pytest.mark.parametrize("num_leaves", [1, 2, 3, 5, 8])
+def test_merkle_proofs_of_every_leaf(num_leaves):
+    leaves = [transaction_digest(f"tx{idx}") for idx in range(num_leaves)]
+    root = compute_merkle_root(leaves)
+    for idx, leaf in enumerate(leaves):
+        proof = merkle_proof(leaves, idx)
+        assert len(proof) <= (num_leaves - 1).bit_length()
+        assert verify_merkle_proof(leaf, proof, root)
+        assert not verify_merkle_proof(transaction_digest("x"), proof, root)
+
+def test_repeated_last_leaf_changes_the_root():
+    leaves = [transaction_digest(name) for name in "abc"]
+    assert compute_merkle_root(leaves) != compute_merkle_root(leaves + leaves[-1:])
+    assert compute_merkle_root(leaves[:1]) == leaves[0]
+
+def test_block_inclusion_proof():
+    block = Block(1, ["a", "b", "c"], 1.5, null_hash)
+    proof = block.inclusion_proof("b")
+    assert verify_merkle_proof(transaction_digest("b"), proof, block.merkle_root)
+    assert block.inclusion_proof("d") is None
+    assert compute_merkle_root([]) == null_hash
+
+def test_header_chain_follows_the_longest_chain(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 3, "a")
+    headers = HeaderChain()
+    assert headers.extend(blockchain.headers_after(headers.locator()))
+    assert headers.last_header == main[-1].header()
+    assert not headers.extend(blockchain.headers_after(headers.locator()))
+    fork = extend(blockchain, main[0], 3, "b")
+    assert headers.extend(blockchain.headers_after(headers.locator()))
+    assert headers.last_header.hash == fork[-1].hash
+    assert main[1].hash not in headers.depths
+    proof = fork[1].inclusion_proof("b1")
+    assert headers.verify_inclusion("b1", fork[1].hash, proof) == 3
+    assert headers.verify_inclusion("a1", main[1].hash, proof) is None
+
+def test_header_chain_refuses_bad_headers(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    extend(blockchain, genesis, 2, "a")
+    headers = HeaderChain()
+    sent = blockchain.headers_after(headers.locator())
+    forged = sent[-1]._replace(nonce=sent[-1].nonce + 1)
+    assert not headers.extend(sent[:-1] + [forged])
+    assert not headers.extend(sent[1:])
+    assert headers.last_header.depth == 0
+
+Stamp = namedtuple('Stamp', ['depth', 'timestamp', 'target'])
+
+def test_retarget_scales_with_the_window_time():
+    first = Stamp(1, 0.0, None)
+    fast = Stamp(17, 80.0, None)
+    slow = Stamp(17, 240.0, None)
+    assert retarget(1000, first, fast, 10.0) == 500
+    assert retarget(1000, first, slow, 10.0) == 1500
+
+def test_retarget_is_clamped(monkeypatch):
+    monkeypatch.setattr(Blockchain, "max_retarget_factor", 4)
+    first = Stamp(1, 0.0, None)
+    assert retarget(1000, first, Stamp(17, 0.0, None), 10.0) == 250
+    assert retarget(1000, first, Stamp(17, 1e6, None), 10.0) == 4000
+
+def test_expected_target_only_moves_on_window_starts(monkeypatch):
+    monkeypatch.setattr(Blockchain, "retarget_interval", 4)
+    monkeypatch.setattr(Blockchain, "block_interval", 10.0)
+    stamps = [Stamp(depth, 5.0 * depth, 1000) for depth in range(8)]
+    assert expected_target(stamps[1], stamps.__getitem__) == 1000
+    # Blocks 1 to 3 came in 10 s instead of 20 s
+    assert expected_target(stamps[3], stamps.__getitem__) == 500
+
+def test_blocks_must_carry_the_due_target(monkeypatch, extend):
+    monkeypatch.setattr(Blockchain, "retarget_interval", 4)
+    blockchain = Blockchain()
+    main = extend(blockchain, blockchain.last_block, 3, "a")
+    due = blockchain.next_target(main[-1])
+    assert due == main[-1].target
+    block = Blockchain.proof_of_work(Block(
+        4, ["x"], main[-1].timestamp + 10.0, main[-1].hash,
+        target=due // 2
+    ))
+    assert not blockchain.add_block(block, block.hash, main[-1])
+    assert blockchain.last_block == main[-1]
+
+def transfer(sender, recipient, amount, nonce=0):
+    return {"from": sender, "to": recipient, "amount": amount, "nonce": nonce}
+
+def test_overdrawing_block_is_refused_on_the_tip(mine, monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    first = mine(blockchain, genesis, [transfer("alice", "bob", 6)])
+    assert blockchain.add_block(first, first.hash, genesis)
+    second = mine(blockchain, first, [transfer("alice", "bob", 6, 1)])
+    assert not blockchain.add_block(second, second.hash, first)
+    assert second.hash in blockchain.invalid
+    assert blockchain.last_block == first
+    assert blockchain.ledger.balances == {"alice": 4, "bob": 6}
+
+def test_invalid_branch_is_dropped(extend, mine, monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 2, "a")
+    # The fork overdraws alice on its second block
+    first = mine(blockchain, genesis, [transfer("alice", "bob", 6)])
+    assert blockchain.add_block(first, first.hash, genesis)
+    second = mine(blockchain, first, [transfer("alice", "bob", 6, 1)])
+    assert blockchain.add_block(second, second.hash, first)
+    child = mine(blockchain, second, ["c0"])
+    assert blockchain.add_block(child, child.hash, second)
+    # Switching fails on second: the branch is rolled back
+    # and the chain is left as it was
+    assert not blockchain.internal_consensus()
+    assert blockchain.last_block == main[-1]
+    assert not blockchain.has_block(second.hash)
+    assert not blockchain.has_block(child.hash)
+    assert {second.hash, child.hash} <= blockchain.invalid
+    assert first.hash in blockchain.tips
+    assert blockchain.ledger.balance("alice") == 10
+    # Descendants of the invalid block are refused
+    late = mine(blockchain, child, ["c1"])
+    assert not blockchain.add_block(late, late.hash, child)
+
+def test_reorganization_moves_the_balances(extend, mine, monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    paid = mine(blockchain, genesis, [transfer("alice", "bob", 6)])
+    assert blockchain.add_block(paid, paid.hash, genesis)
+    assert blockchain.ledger.balance("bob") == 6
+    extend(blockchain, genesis, 2, "b")
+    assert blockchain.ledger.balances == {"alice": 10}
+
+def test_mempool_refuses_unfunded_transfers(monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    blockchain = Blockchain()
+    assert not blockchain.add_new_transaction(transfer("bob", "alice", 1))
+    assert blockchain.add_new_transactions([
+        transfer("alice", "bob", 6), transfer("alice", "bob", 6, 1), "a"
+    ]) == 3
+    assert blockchain.select_transactions(3) == [
+        transfer("alice", "bob", 6), "a"
+    ]
+
+def test_transaction_status_follows_reorganizations(extend):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 2, "a")
+    blockchain.add_new_transaction("b0")
+    statuses = blockchain.transaction_statuses(
+        [transaction_id(tx) for tx in ("a0", "b0", "z")]
+    )
+    assert list(statuses.values()) == [
+        ("confirmed", main[0].hash, 1, 2),
+        ("pending", None, None, 0),
+        ("unknown", None, None, 0),
+    ]
+    fork = extend(blockchain, genesis, 3, "b")
+    assert blockchain.transaction_status(transaction_id("b0")) == (
+        "confirmed", fork[0].hash, 1, 3
+    )
+    assert blockchain.transaction_status(transaction_id("a1")).state == (
+        "pending"
+    )
+    assert blockchain.find_transaction("b2") == fork[2]
+    assert blockchain.find_transaction("a1") is None
+
+def test_replayed_transaction_is_refused(extend, mine):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    first = extend(blockchain, genesis, 1, "a")[0]
+    replay = mine(blockchain, first, ["a0"])
+    assert not blockchain.add_block(replay, replay.hash, first)
+    assert blockchain.last_block == first
+    assert replay.hash in blockchain.invalid
+    assert not blockchain.add_new_transaction("a0")
+
+def test_transactions_mined_on_both_branches_stay_out(mine):
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = mine(blockchain, genesis, ["x", "a"])
+    assert blockchain.add_block(main, main.hash, genesis)
+    fork = [mine(blockchain, genesis, ["x"])]
+    fork.append(mine(blockchain, fork[0], ["b"]))
+    for parent, blk in zip([genesis] + fork, fork):
+        assert blockchain.add_block(blk, blk.hash, parent)
+    assert blockchain.internal_consensus()
+    assert blockchain.last_block == fork[-1]
+    assert list(blockchain.mempool) == ["a"]
+
+def test_dicts_without_a_version_are_legacy_blocks():
+    old = {
+        "depth": 0, "transactions": [], "timestamp": 0,
+        "previous_hash": "0", "nonce": 0
+    }
+    genesis = Block.from_dict(old)
+    assert genesis.version == Block.legacy_version
+    assert genesis.hash.hex().startswith("36dd245bb41008")
+
+def grow(blockchain, parent, num_blocks, step, tag):
+    '''
+    Add num_blocks blocks on parent, step seconds apart
+    '''
+    blocks = []
+    for idx in range(num_blocks):
+        blk = Blockchain.proof_of_work(Block(
+            parent.depth + 1, [f"{tag}{idx}"], parent.timestamp + step,
+            parent.hash, target=blockchain.next_target(parent)
+        ))
+        assert blockchain.add_block(blk, blk.hash, parent)
+        blocks.append(blk)
+        parent = blk
+    blockchain.internal_consensus()
+    return blocks
+
+def test_block_work():
+    assert block_work(2 ** 256 - 1) == 1
+    assert block_work(2 ** 255 - 1) == 2
+    assert block_work(2 ** 252 - 1) == 16
+
+def test_chain_with_more_work_wins_over_a_deeper_one(monkeypatch):
+    monkeypatch.setattr(Blockchain, "retarget_interval", 2)
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = grow(blockchain, genesis, 5, 10.0, "a")
+    # Blocks found fast, the fork retargets to harder blocks
+    fork = grow(blockchain, genesis, 4, 1.0, "b")
+    assert fork[-1].target == genesis.target // 4
+    assert blockchain.chain_work(fork[-1]) > blockchain.chain_work(main[-1])
+    assert blockchain.last_block == fork[-1]
+    headers = HeaderChain()
+    assert headers.extend(blockchain.headers_after(headers.locator()))
+    assert headers.last_header.hash == fork[-1].hash
+
+def test_timestamps_are_bounded(extend):
+    blockchain = Blockchain()
+    main = extend(blockchain, blockchain.last_block, 3, "a")
+    parent = main[-1]
+    for timestamp in (main[1].timestamp, time.time() + 3 * 60 * 60):
+        blk = Blockchain.proof_of_work(Block(
+            parent.depth + 1, ["x"], timestamp, parent.hash,
+            target=blockchain.next_target(parent)
+        ))
+        assert not blockchain.add_block(blk, blk.hash, parent)
+    assert blockchain.last_block == parent
+
+def test_transaction_twice_in_a_block_is_refused(mine, monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 20})
+    pay = transfer("alice", "bob", 6)
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    twice = mine(blockchain, genesis, [pay, pay])
+    assert not blockchain.add_block(twice, twice.hash, genesis)
+    assert twice.hash in blockchain.invalid
+    # Adopted chains are connected block by block too
+    follower = Blockchain()
+    follower.adopt_chain([genesis, twice], validated=True)
+    for chain in (blockchain, follower):
+        assert chain.last_block == genesis
+        assert chain.ledger.balances == {"alice": 20}
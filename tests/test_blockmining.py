@@ -0,0 +1,36 @@
+import pytest
+
+from blocklogic import Block, Blockchain, CancelToken
+from blockmining import MiningEngine
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_engine_finds_a_proof(workers):
+    blockchain = Blockchain()
+    block = Block(1, ["a"], 1.0, blockchain.last_block.hash)
+    with MiningEngine(workers=workers) as engine:
+        mined = engine.proof_of_work(block)
+    assert mined.transactions == block.transactions
+    assert Blockchain.is_valid_proof(mined, mined.hash)
+    assert engine.last_hashes >= 1
+    assert engine.hashes == engine.last_hashes
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_engine_gives_up_after_work_time(workers, monkeypatch):
+    monkeypatch.setattr(Blockchain, "difficulty", 64)
+    blockchain = Blockchain()
+    block = Block(1, ["a"], 1.0, blockchain.last_block.hash)
+    with MiningEngine(workers=workers) as engine:
+        assert engine.proof_of_work(block, work_time=0.05) is None
+    assert engine.last_hashes > 0
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_cancelled_token_stops_the_work(workers, monkeypatch):
+    monkeypatch.setattr(Blockchain, "difficulty", 64)
+    blockchain = Blockchain()
+    block = Block(1, ["a"], 1.0, blockchain.last_block.hash)
+    token = CancelToken()
+    token.cancel()
+    with MiningEngine(workers=workers) as engine:
+        assert engine.proof_of_work(block, cancel=token) is None
+    assert Blockchain.proof_of_work(block, cancel=token) is None
+    assert token.cancelled_at is not None
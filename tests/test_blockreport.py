@@ -0,0 +1,73 @@
+import csv
+import json
+from types import SimpleNamespace
+
+from blockledger import Ledger
+from blocklogic import Blockchain
+from blockreport import column_width, tx_text, write_report
+
+def report_nodes(extend):
+    first = Blockchain()
+    second = Blockchain()
+    extend(first, first.last_block, 2, "a")
+    first.add_new_transaction("left")
+    return [
+        SimpleNamespace(blockchain=first), SimpleNamespace(blockchain=second)
+    ]
+
+def test_columns_report_is_side_by_side(tmp_path, extend):
+    nodes = report_nodes(extend)
+    path = tmp_path / "report.txt"
+    write_report(nodes, path)
+    lines = path.read_text().split("\n")
+    assert lines[0] == (
+        "Node 0".ljust(column_width) + "\t|\t"
+        + "Node 1".ljust(column_width) + "\t|\t"
+    )
+    block_lines = 11 + Blockchain.block_capacity
+    # Header, three rows of blocks with a blank line each
+    # then the separator
+    separator = 1 + 3 * (block_lines + 1)
+    assert lines[separator] == "_" * 86
+    assert lines[separator + 1].split("\t|\t")[:2] == [
+        "1".ljust(column_width), "0".ljust(column_width)
+    ]
+    assert lines[separator + 2].startswith("left")
+    assert '"depth": 2' in lines[1 + 2 * (block_lines + 1) + 1]
+
+def test_jsonl_report_has_one_record_per_block(tmp_path, extend):
+    nodes = report_nodes(extend)
+    path = tmp_path / "report.jsonl"
+    write_report(nodes, path, "jsonl")
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    blocks = [rec for rec in records if "depth" in rec]
+    assert [(rec["node"], rec["depth"]) for rec in blocks] == [
+        (0, 0), (1, 0), (0, 1), (0, 2)
+    ]
+    assert records[-2:] == [
+        {"node": 0, "mempool": ["left"]}, {"node": 1, "mempool": []}
+    ]
+
+def test_csv_report(tmp_path, extend):
+    nodes = report_nodes(extend)
+    path = tmp_path / "report.csv"
+    write_report(nodes, path, "csv")
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 4
+    assert rows[-1]["depth"] == "2"
+    assert rows[-1]["transactions"] == "a1"
+    assert rows[-1]["hash"] == nodes[0].blockchain.last_block.hash.hex()
+
+def test_transfers_are_written_as_json(tmp_path, monkeypatch):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    blockchain = Blockchain()
+    pay = {"from": "alice", "to": "bob", "amount": 1, "nonce": 0}
+    assert blockchain.add_new_transaction(pay)
+    assert tx_text(pay) == (
+        '{"amount":1,"from":"alice","nonce":0,"to":"bob"}'
+    )
+    assert tx_text("plain") == "plain"
+    path = tmp_path / "report.txt"
+    write_report([SimpleNamespace(blockchain=blockchain)], path)
+    assert path.read_text().splitlines()[-1].startswith(tx_text(pay))
@@ -0,0 +1,59 @@
+from blockexport import export_blocks, summary
+from blocksim import Simulator
+
+def run(seed, **kwargs):
+    sim = Simulator(
+        num_nodes=8, hash_rate=1.0, num_peers=3, seed=seed, **kwargs
+    )
+    metrics = sim.run(until_blocks=60)
+    del metrics["wall_time"]
+    return sim, metrics
+
+def test_a_seed_reproduces_the_run():
+    first, metrics = run(seed=3)
+    second, again = run(seed=3)
+    assert metrics == again
+    assert [node.tip.hash for node in first.nodes] == [
+        node.tip.hash for node in second.nodes
+    ]
+    assert run(seed=4)[1] != metrics
+
+def test_nodes_converge_once_deliveries_settle():
+    sim, metrics = run(seed=1)
+    assert metrics["mined"] == 60
+    assert metrics["converged"]
+    assert metrics["blocks"] + metrics["stale_blocks"] == 60
+    assert len({node.tip.hash for node in sim.nodes}) == 1
+
+def test_peer_links_are_symmetric():
+    sim = Simulator(num_nodes=10, num_peers=2, seed=5)
+    for node in sim.nodes:
+        assert node not in node.peers
+        assert len(node.peers) >= 2
+        for peer in node.peers:
+            assert node in peer.peers
+
+def test_slow_links_make_forks():
+    _, metrics = run(seed=2, latency=5.0, jitter=5.0)
+    assert metrics["stale_blocks"] > 0
+    assert metrics["reorgs"] > 0
+
+def test_runs_can_be_exported():
+    sim, metrics = run(seed=2, latency=5.0, jitter=5.0)
+    overview = summary(export_blocks(sim.nodes))
+    assert overview["nodes"] == 8
+    assert overview["blocks"] == metrics["mined"]
+    assert overview["stale_blocks"] == metrics["stale_blocks"]
+
+def test_stale_blocks_are_known_from_the_tips_of_their_branches():
+    sim, metrics = run(seed=2, latency=5.0, jitter=5.0)
+    assert metrics["converged"]
+    chain = sim.nodes[0].known_blocks()[0]
+    known_stale = set()
+    for node in sim.nodes:
+        node_chain, stale = node.known_blocks()
+        assert node_chain == chain
+        known_stale.update(blk.hash for blk in stale)
+    # Each one was the tip of its miner once
+    assert known_stale == set(sim.tree.blocks) - {blk.hash for blk in chain}
+    assert len(known_stale) == metrics["stale_blocks"]
@@ -0,0 +1,79 @@
+import json
+
+from blocklogic import Block, Blockchain
+from blockstats import (
+    Histogram, Metrics, dump_metrics, fork_stats, null_metrics,
+    prometheus_text
+)
+
+def test_histogram_buckets_are_cumulative():
+    hist = Histogram(buckets=(1, 2))
+    for value in (0.5, 1, 1.5, 3):
+        hist.observe(value)
+    assert hist.cumulative() == [(1, 2), (2, 3), (float('inf'), 4)]
+    assert hist.count == 4
+    assert hist.sum == 6.0
+
+def test_series_are_told_apart_by_labels():
+    metrics = Metrics({"node": "n1"})
+    metrics.inc("blocks_rejected", labels={"reason": "proof"})
+    metrics.inc("blocks_rejected", labels={"reason": "proof"})
+    metrics.inc("blocks_rejected", labels={"reason": "duplicate"})
+    metrics.set("mempool_size", 3)
+    snapshot = metrics.to_dict()
+    counters = {
+        s["labels"]["reason"]: s["value"] for s in snapshot["counters"]
+    }
+    assert counters == {"proof": 2, "duplicate": 1}
+    assert snapshot["gauges"][0]["value"] == 3
+    assert snapshot["labels"] == {"node": "n1"}
+
+def test_prometheus_text_groups_nodes():
+    first = Metrics({"node": "n1"})
+    second = Metrics({"node": "n2"})
+    first.inc("syncs")
+    second.inc("syncs", 2)
+    with first.timer("sync_request_seconds"):
+        pass
+    lines = prometheus_text([first, second]).splitlines()
+    assert lines.count("# TYPE blockchain_syncs_total counter") == 1
+    assert 'blockchain_syncs_total{node="n1"} 1' in lines
+    assert 'blockchain_syncs_total{node="n2"} 2' in lines
+    assert 'blockchain_sync_request_seconds_count{node="n1"} 1' in lines
+
+def test_dump_metrics_as_json(tmp_path):
+    metrics = Metrics()
+    metrics.inc("syncs")
+    path = tmp_path / "metrics.json"
+    dump_metrics([metrics], path)
+    assert json.loads(path.read_text())[0]["counters"][0]["value"] == 1
+
+def test_null_metrics_record_nothing():
+    null_metrics.inc("syncs")
+    with null_metrics.timer("sync_request_seconds"):
+        pass
+    assert not null_metrics.enabled
+    assert null_metrics.counters == {}
+    assert null_metrics.histograms == {}
+
+def test_blockchain_counts_accepted_and_rejected_blocks():
+    metrics = Metrics()
+    blockchain = Blockchain(metrics=metrics)
+    block = Block(1, ["a"], 1.0, blockchain.last_block.hash)
+    block = Blockchain.proof_of_work(block)
+    assert blockchain.add_block_longest(block, block.hash)
+    assert not blockchain.add_block_longest(block, block.hash)
+    counters = {
+        (name, labels): value
+        for (name, labels), value in metrics.counters.items()
+    }
+    assert counters[("blocks_accepted", (("branch", "longest"),))] == 1
+    assert counters[("blocks_rejected", (("reason", "previous_hash"),))] == 1
+
+def test_fork_stats_of_several_nodes():
+    stats = fork_stats(6, 2, [[1, 2], [], [1]])
+    assert stats == dict(
+        stale_blocks=2, stale_rate=0.25, reorgs=3,
+        reorg_depths={"1": 2, "2": 1}, mean_reorg_depth=4 / 3,
+    )
+    assert fork_stats(0, 0, [])["stale_rate"] == 0.0
@@ -0,0 +1,184 @@
+import os
+
+from blockledger import Ledger
+from blocklogic import Blockchain, block_work, transaction_id
+from blockstore import BlockStore, tx_record
+
+def build_store(path, num_blocks, extend):
+    blockchain = Blockchain(store=BlockStore(path))
+    extend(blockchain, blockchain.last_block, num_blocks, "tx")
+    store = blockchain.main_chain
+    blocks = list(store)
+    store.close()
+    return blocks
+
+def test_reopen_keeps_the_chain(tmp_path, extend):
+    blocks = build_store(str(tmp_path), 5, extend)
+    blockchain = Blockchain(store=BlockStore(str(tmp_path)))
+    assert blockchain.last_block == blocks[-1]
+    assert blockchain.get_block(blocks[2].hash) == blocks[2]
+    assert blockchain.has_block(blocks[0].hash)
+    assert blockchain.find_transaction("tx2") == blocks[3]
+    # Work of blocks only in the store, from the tip's
+    work = block_work(blocks[0].target)
+    assert blockchain.chain_work(blocks[2]) == 3 * work
+    assert blockchain.chain_work(blocks[-1]) == 6 * work
+    blockchain.main_chain.close()
+
+def test_reorganization_rewrites_the_tail(tmp_path, extend):
+    blockchain = Blockchain(store=BlockStore(str(tmp_path)))
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 3, "a")
+    fork = extend(blockchain, main[0], 3, "b")
+    blockchain.main_chain.close()
+    store = BlockStore(str(tmp_path))
+    assert list(store) == [genesis, main[0]] + fork
+    assert store.find(main[1].hash) is None
+    store.close()
+
+def test_torn_final_record_is_dropped(tmp_path, extend):
+    blocks = build_store(str(tmp_path), 5, extend)
+    # A crash in the middle of an append, before its index
+    # entry was written
+    with open(tmp_path / "blocks.dat", "ab") as f:
+        f.write(b"\x40\x00\x00\x00torn")
+    with open(tmp_path / "txs.dat", "ab") as f:
+        f.write(b"torn")
+    blockchain = Blockchain(store=BlockStore(str(tmp_path)))
+    assert list(blockchain.main_chain) == blocks
+    assert os.path.getsize(tmp_path / "txs.dat") % tx_record.size == 0
+    # Appends go on from the recovered end
+    new = extend(blockchain, blockchain.last_block, 1, "new")
+    blockchain.main_chain.close()
+    store = BlockStore(str(tmp_path))
+    assert list(store) == blocks + new
+    store.close()
+
+def test_entries_past_the_segment_are_dropped(tmp_path, extend):
+    blocks = build_store(str(tmp_path), 5, extend)
+    # Segment bytes the OS lost although the index
+    # already points at them
+    size = os.path.getsize(tmp_path / "blocks.dat")
+    with open(tmp_path / "blocks.dat", "r+b") as f:
+        f.truncate(size - 3)
+    store = BlockStore(str(tmp_path))
+    assert list(store) == blocks[:-1]
+    assert transaction_id("tx4") not in store.tx_heights()
+    store.close()
+    blockchain = Blockchain(store=BlockStore(str(tmp_path)))
+    assert blockchain.find_transaction("tx4") is None
+    assert blockchain.find_transaction("tx3") == blocks[-2]
+    blockchain.main_chain.close()
+
+def test_heights_by_hash_follow_the_tail(tmp_path, extend):
+    blocks = build_store(str(tmp_path), 3, extend)
+    store = BlockStore(str(tmp_path))
+    # Opening doesn't read the index
+    assert store.heights is None
+    assert [store.find(blk.hash) for blk in blocks] == [0, 1, 2, 3]
+    assert store.find(bytes(32)) is None
+    blockchain = Blockchain(store=store)
+    fork = extend(blockchain, blocks[1], 3, "b")
+    assert store.find(blocks[2].hash) is None
+    assert store.find(blocks[3].hash) is None
+    assert [store.find(blk.hash) for blk in fork] == [2, 3, 4]
+    store.close()
+
+def transfer(sender, recipient, amount, nonce=0):
+    return {"from": sender, "to": recipient, "amount": amount, "nonce": nonce}
+
+def test_reopen_restores_the_ledger_from_a_checkpoint(
+    tmp_path, mine, monkeypatch
+):
+    monkeypatch.setattr(Ledger, "genesis_balances", {"alice": 10})
+    monkeypatch.setattr(Blockchain, "checkpoint_interval", 2)
+    blockchain = Blockchain(store=BlockStore(str(tmp_path)))
+    for nonce in range(5):
+        parent = blockchain.last_block
+        blk = mine(blockchain, parent, [transfer("alice", "bob", 1, nonce)])
+        assert blockchain.add_block(blk, blk.hash, parent)
+    assert blockchain.checkpoint_height == 4
+    blockchain.main_chain.close()
+    store = BlockStore(str(tmp_path))
+    assert store.load_checkpoint()[0] == 4
+    reopened = Blockchain(store=store)
+    assert reopened.ledger.balances == {"alice": 5, "bob": 5}
+    # Undo records came along, blocks below the checkpoint
+    # can still be disconnected
+    assert reopened.ledger.can_undo(5)
+    store.close()
+
+def test_reorganizations_past_the_undo_records_are_refused(
+    extend, monkeypatch
+):
+    monkeypatch.setattr(Ledger, "undo_depth", 2)
+    blockchain = Blockchain()
+    genesis = blockchain.last_block
+    main = extend(blockchain, genesis, 3, "a")
+    fork = extend(blockchain, genesis, 4, "b")
+    assert blockchain.last_block == main[-1]
+    assert fork[-1].hash not in blockchain.blocks
+    assert fork[0].hash in blockchain.invalid
+
+def test_reopening_looks_transactions_up_in_the_table(
+    tmp_path, extend, mine, monkeypatch
+):
+    blocks = build_store(str(tmp_path), 5, extend)
+    def read_all(store):
+        raise AssertionError("txs.dat read in full")
+    monkeypatch.setattr(BlockStore, "tx_heights", read_all)
+    blockchain = Blockchain(store=BlockStore(str(tmp_path)))
+    assert blockchain.find_transaction("tx2") == blocks[3]
+    parent = blockchain.last_block
+    replay = mine(blockchain, parent, ["tx2"])
+    assert not blockchain.add_block(replay, replay.hash, parent)
+    new = mine(blockchain, parent, ["new"])
+    assert blockchain.add_block(new, new.hash, parent)
+    assert blockchain.find_transaction("new") == new
+    blockchain.main_chain.close()
+
+def tx_height(store, tx):
+    return store.tx_height(bytes.fromhex(transaction_id(tx)))
+
+def test_transaction_table_grows_and_follows_the_tail(tmp_path, mine):
+    blockchain = Blockchain()
+    blocks = [blockchain.last_block]
+    for height in range(1, 4):
+        blocks.append(mine(blockchain, blocks[-1], [
+            f"tx{height}.{idx}" for idx in range(300)
+        ]))
+    store = BlockStore(str(tmp_path))
+    store.extend(blocks)
+    # 900 transactions, more than half of the first table
+    for blk in blocks:
+        for tx in blk.transactions:
+            assert tx_height(store, tx) == blk.depth
+    del store[2:]
+    store.append(mine(blockchain, blocks[1], ["other"]))
+    store.close()
+    store = BlockStore(str(tmp_path))
+    assert tx_height(store, "tx1.299") == 1
+    assert tx_height(store, "tx2.0") is None
+    assert tx_height(store, "tx3.299") is None
+    assert tx_height(store, "other") == 2
+    store.close()
+
+def test_tree_keeps_the_last_consensus_blocks(tmp_path, extend, monkeypatch):
+    monkeypatch.setattr(Blockchain, "tree_depth", 8)
+    blockchain = Blockchain(store=BlockStore(str(tmp_path)))
+    genesis = blockchain.last_block
+    blocks = extend(blockchain, genesis, 100, "a")
+    for tree in (blockchain.blocks, blockchain.children, blockchain.work):
+        assert len(tree) <= 2 * Blockchain.tree_depth + 1
+    old = blocks[9]
+    assert old.hash not in blockchain.blocks
+    assert blockchain.get_block(old.hash) == old
+    assert blockchain.chain_work(old) == sum(
+        block_work(blk.target) for blk in [genesis] + blocks[:10]
+    )
+    # Stale branches off pruned blocks still go in the tree
+    stale = extend(blockchain, old, 1, "b")[0]
+    assert blockchain.last_block == blocks[-1]
+    assert blockchain.extensions == [[old, stale]]
+    assert old.hash not in blockchain.tips
+    blockchain.main_chain.close()
@@ -0,0 +1,148 @@
+import blockvalidation
+from blocklogic import Block, Blockchain
+from blockvalidation import ChainValidator, check_block, load_legacy_chain
+
+def source_chain(extend, num_blocks):
+    source = Blockchain()
+    extend(source, source.last_block, num_blocks, "a")
+    return source
+
+def forged(blk):
+    '''
+    Same block but for a hash that isn't its own
+    '''
+    return Block(
+        blk.depth, blk.transactions, blk.timestamp, blk.previous_hash,
+        blk.nonce, blk.version, bytes(32), target=blk.target
+    )
+
+def test_valid_chain_passes(extend):
+    source = source_chain(extend, 4)
+    follower = Blockchain()
+    with ChainValidator() as validator:
+        blocks, reason = validator.validate(follower, source.chain)
+    assert reason is None
+    assert blocks == source.chain[1:]
+    assert follower.adopt_chain(blocks, validated=True)
+    assert follower.chain == source.chain
+
+def test_blocks_before_the_invalid_one_are_kept(extend):
+    source = source_chain(extend, 4)
+    chain = list(source.chain)
+    chain[3] = forged(chain[3])
+    with ChainValidator() as validator:
+        blocks, reason = validator.validate(Blockchain(), chain)
+    assert blocks == chain[1:3]
+    assert reason == "proof"
+
+def test_links_are_checked(extend):
+    source = source_chain(extend, 4)
+    chain = source.chain
+    with ChainValidator() as validator:
+        blocks, reason = validator.validate(
+            Blockchain(), chain[:2] + chain[3:]
+        )
+        assert (blocks, reason) == ([chain[1]], "previous_hash")
+        assert validator.validate(Blockchain(), chain[2:]) == (
+            [], "unknown_base"
+        )
+
+def test_check_block_rules(monkeypatch):
+    monkeypatch.setattr(Blockchain, "block_capacity", 2)
+    parent = Blockchain().last_block
+    full = Blockchain.proof_of_work(
+        Block(1, ["a", "b", "c"], 1.0, parent.hash)
+    )
+    assert check_block(full, Blockchain.block_capacity) == "capacity"
+    twice = Blockchain.proof_of_work(Block(1, ["a", "a"], 1.0, parent.hash))
+    assert check_block(twice, Blockchain.block_capacity) == "duplicate_tx"
+
+def test_validated_blocks_are_not_checked_again(extend, monkeypatch):
+    source = source_chain(extend, 4)
+    checked = []
+    def counting_check(blk, capacity):
+        checked.append(blk)
+        return None
+    monkeypatch.setattr(blockvalidation, "check_block", counting_check)
+    with ChainValidator() as validator:
+        validator.validate(Blockchain(), source.chain[:3])
+        assert validator.validate(Blockchain(), source.chain) == (
+            source.chain[1:], None
+        )
+    assert checked == source.chain[1:]
+
+def test_proofs_in_worker_processes(extend, monkeypatch):
+    monkeypatch.setattr(ChainValidator, "min_parallel", 0)
+    monkeypatch.setattr(ChainValidator, "chunk_size", 2)
+    source = source_chain(extend, 5)
+    chain = list(source.chain)
+    chain[4] = forged(chain[4])
+    with ChainValidator(2) as validator:
+        assert validator.validate(Blockchain(), source.chain) == (
+            source.chain[1:], None
+        )
+        assert validator.validate(Blockchain(), chain) == (
+            chain[1:4], "proof"
+        )
+
+def test_cached_hash_with_other_transactions_is_refused(extend):
+    source = source_chain(extend, 3)
+    chain = list(source.chain)
+    real = chain[2]
+    chain[2] = Block(
+        real.depth, ["other"], real.timestamp, real.previous_hash,
+        real.nonce, real.version, real.hash, target=real.target
+    )
+    with ChainValidator() as validator:
+        validator.validate(Blockchain(), source.chain)
+        assert validator.validate(Blockchain(), chain) == (
+            chain[1:2], "hash"
+        )
+
+def test_cached_hash_with_a_repeated_transaction_is_refused(mine):
+    source = Blockchain()
+    genesis = source.last_block
+    real = mine(source, genesis, ["a", "b", "c"])
+    assert source.add_block(real, real.hash, genesis)
+    source.internal_consensus()
+    repeated = Block(
+        real.depth, ["a", "b", "c", "c"], real.timestamp, real.previous_hash,
+        real.nonce, real.version, real.hash, target=real.target
+    )
+    with ChainValidator() as validator:
+        validator.validate(Blockchain(), source.chain)
+        assert validator.validate(Blockchain(), [genesis, repeated]) == (
+            [], "hash"
+        )
+
+def legacy_chain(num_blocks):
+    blockchain = Blockchain(legacy=True)
+    blocks = [blockchain.last_block]
+    for idx in range(num_blocks):
+        parent = blocks[-1]
+        blocks.append(Blockchain.proof_of_work(Block(
+            parent.depth + 1, [f"Tx #{idx:04}"], parent.timestamp + 10.0,
+            parent.hash, version=Block.legacy_version
+        )))
+    return blocks
+
+def test_legacy_chain_dicts_load():
+    blocks = legacy_chain(3)
+    dumped = []
+    for blk in blocks:
+        blk_dict = blk.to_dict()
+        # Dumped before blocks had a version or a target
+        del blk_dict["version"], blk_dict["target"]
+        dumped.append(blk_dict)
+    blockchain, reason = load_legacy_chain(dumped)
+    assert reason is None
+    assert blockchain.chain == blocks
+    assert blockchain.chain[0].hash.hex().startswith("36dd245bb41008")
+
+def test_legacy_chain_stops_at_the_first_invalid_block():
+    blocks = legacy_chain(3)
+    blocks[2] = forged(blocks[2])
+    blockchain, reason = load_legacy_chain(blocks)
+    assert reason == "proof"
+    assert blockchain.chain == blocks[:2]
+    assert load_legacy_chain(blocks[1:])[1] == "genesis"
@@ -0,0 +1,111 @@
+import socket
+import threading
+
+from blockgraph import FullNode, TipSummary, reset_network
+from blocklogic import Blockchain, transaction_id
+from blockwire import (
+    NodeServer, RemotePeer, pack_blocks, pack_locator, pack_tip,
+    pack_txs, recv_frame, send_frame, unpack_blocks, unpack_locator,
+    unpack_tip, unpack_txs
+)
+
+def test_blocks_round_trip(extend):
+    blockchain = Blockchain()
+    blocks = [blockchain.last_block]
+    blocks += extend(blockchain, blocks[-1], 3, "a")
+    decoded = unpack_blocks(pack_blocks(blocks))
+    assert decoded == blocks
+    for blk, back in zip(blocks, decoded):
+        assert back.transactions == blk.transactions
+        assert back.merkle_root == blk.merkle_root
+        assert back.compute_hash() == blk.hash
+        assert (back.depth, back.timestamp, back.nonce, back.target) == (
+            blk.depth, blk.timestamp, blk.nonce, blk.target
+        )
+        assert back.previous_hash == blk.previous_hash
+
+def test_blocks_are_packed_up_to_a_size(extend):
+    blockchain = Blockchain()
+    blocks = extend(blockchain, blockchain.last_block, 3, "a")
+    size = len(pack_blocks(blocks[:2]))
+    assert unpack_blocks(pack_blocks(blocks, size)) == blocks[:2]
+    # At least one block, whatever its size
+    assert unpack_blocks(pack_blocks(blocks, 1)) == blocks[:1]
+
+def test_no_blocks_round_trip():
+    assert unpack_blocks(pack_blocks([])) == []
+
+def test_payloads_round_trip():
+    txs = ["a", {"from": "x", "to": "y", "amount": 1}, [1, 2]]
+    assert unpack_txs(pack_txs(txs))[0] == txs
+    locator = [bytes([idx]) * 32 for idx in range(3)]
+    assert unpack_locator(pack_locator(locator)) == locator
+    tip = TipSummary(7, b"\x01" * 32, 2 ** 200 + 5)
+    assert unpack_tip(pack_tip(tip, "unix:/tmp/n0")) == (tip, "unix:/tmp/n0")
+
+def test_frames_over_a_socket():
+    left, right = socket.socketpair()
+    with left, right:
+        send_frame(left, 5, b"payload")
+        send_frame(left, 2)
+        assert recv_frame(right) == (5, b"payload")
+        assert recv_frame(right) == (2, b"")
+        left.close()
+        assert recv_frame(right) is None
+
+def test_remote_peer_talks_to_a_node_server(tmp_path, extend):
+    reset_network()
+    node = FullNode()
+    blocks = extend(node.blockchain, node.blockchain.last_block, 3, "a")
+    node.publish_tip()
+    address = f"unix:{tmp_path}/n0.sock"
+    server = NodeServer(node, address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    peer = RemotePeer(address)
+    try:
+        assert peer.refresh_tip() == node.tip
+        genesis = node.blockchain.chain[0]
+        assert peer.send_blocks([genesis.hash]) == blocks
+        assert peer.send_blocks([genesis.hash], 2) == blocks[:2]
+        assert peer.offer(["x", "y"]) == 2
+        assert peer.command("flush") == dict(processed=2)
+        assert peer.send_transactions() == ["x", "y"]
+        assert peer.command("status")["depth"] == 3
+        statuses = peer.send_tx_statuses(
+            [transaction_id("a2"), transaction_id("x")]
+        )
+        assert list(statuses.values()) == [
+            ("confirmed", blocks[2].hash, 3, 1), ("pending", None, None, 0)
+        ]
+        assert peer.command("stop") == dict(stopped=True)
+    finally:
+        peer.close()
+        thread.join(5)
+        reset_network()
+    assert not thread.is_alive()
+    # Unreachable peers look like peers with nothing to offer
+    assert peer.send_blocks([genesis.hash]) == []
+    assert peer.offer(["z"]) == 0
+
+def test_garbled_replies_look_like_failures(tmp_path):
+    address = f"unix:{tmp_path}/garbled.sock"
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(f"{tmp_path}/garbled.sock")
+    listener.listen()
+    def answer_garbage():
+        conn, _ = listener.accept()
+        with conn:
+            while recv_frame(conn) is not None:
+                send_frame(conn, 4, b"\x05\x00\x00\x00junk")
+    thread = threading.Thread(target=answer_garbage)
+    thread.start()
+    peer = RemotePeer(address)
+    try:
+        assert peer.send_blocks([bytes(32)]) == []
+        assert peer.send_transactions() == []
+        assert peer.refresh_tip() == TipSummary(-1, None, -1)
+    finally:
+        peer.close()
+        thread.join(5)
+        listener.close()